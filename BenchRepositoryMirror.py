@@ -0,0 +1,132 @@
+#! /usr/bin/python3
+'''
+Benchmark the RepositoryMirror.py fetch engines (serial, threaded, async).
+Builds a synthetic repository of random .deb files, serves it over HTTP from
+a local server which adds a fixed delay to every request to mimic a distant
+upstream, and times a full -fetch of a fresh mirror with each engine.
+With -p N the fetch is shared by N processes run with -shard i/N at once and
+the mirror database is checked for debs that were fetched more than once.
+'''
+
+import os
+import sys
+import gzip
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+import functools
+import sqlite3
+import http.server
+from time import perf_counter as gettime, sleep
+
+RM = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'RepositoryMirror.py')
+
+def mkRepository(top, dist, npkgs, size):
+    '''
+    Create a synthetic repository at top with one distribution dist which has
+    npkgs random .deb files of up to size bytes in each of main amd64/all
+    '''
+    rel = []
+    for arch in ('amd64', 'all'):
+        entries = ''
+        for i in range(npkgs):
+            name = 'pkg-%s-%d' % (arch, i)
+            fname = 'pool/main/p/%s/%s_1.0-1_%s.deb' % (name, name, arch)
+            data = os.urandom(size//2 + (i * 7919) % (size//2 + 1))
+            os.makedirs(os.path.join(top, os.path.dirname(fname)), exist_ok=True)
+            with open(os.path.join(top, fname), 'wb') as f:
+                f.write(data)
+            entries += ('Package: %s\nVersion: 1.0-1\nArchitecture: %s\n'
+                'Filename: %s\nSize: %d\nMD5sum: %s\n\n' %
+                (name, arch, fname, len(data), hashlib.md5(data).hexdigest()))
+        pname = 'main/binary-%s/Packages.gz' % arch
+        data = gzip.compress(entries.encode(), mtime=0)
+        path = os.path.join(top, 'dists', dist, pname)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        rel.append(' %s %8d %s\n' % (hashlib.md5(data).hexdigest(), len(data), pname))
+    with open(os.path.join(top, 'dists', dist, 'Release'), 'w') as f:
+        f.write('Origin: Bench\nSuite: %s\nCodename: %s\nArchitectures: amd64\n'
+            'Components: main\nDescription: Synthetic benchmark repository\nMD5Sum:\n'
+            % (dist, dist) + ''.join(rel))
+    # RepositoryMirror uses the plain Release file when there is a detached signature
+    with open(os.path.join(top, 'dists', dist, 'Release.gpg'), 'w') as f:
+        f.write('unsigned\n')
+
+class SlowHandler(http.server.SimpleHTTPRequestHandler):
+    ''' Serve files after a delay of latency seconds '''
+    protocol_version = 'HTTP/1.1'
+    latency = 0.
+
+    def log_message(self, *a):
+        pass
+
+    def do_GET(self):
+        sleep(SlowHandler.latency)
+        super().do_GET()
+
+def run(cmd, nshards=1):
+    '''
+    Run RepositoryMirror.py with arguments cmd, with -shard i/nshards in nshards
+    processes at once if nshards > 1 - returns (elapsed seconds, output)
+    '''
+    start = gettime()
+    procs = [subprocess.Popen([sys.executable, RM] + cmd +
+        (['-shard', '%d/%d' % (i, nshards)] if nshards > 1 else []),
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        for i in range(1, nshards + 1)]
+    out = ''.join(p.communicate()[0] for p in procs)
+    return gettime() - start, out
+
+def duplicates(lmirror):
+    ''' Return the number of debs fetched more than once into lmirror '''
+    con = sqlite3.connect(os.path.join(lmirror, '.mirror.db'))
+    n = con.execute("SELECT count(*) - count(DISTINCT path) FROM fetches "
+        "WHERE ok AND path LIKE 'pool/%'").fetchone()[0]
+    con.close()
+    return n
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark RepositoryMirror fetch engines')
+    parser.add_argument('-n', dest='npkgs', type=int, default=200,
+        help='number of packages per architecture')
+    parser.add_argument('-s', dest='size', type=int, default=32*1024,
+        help='maximum package size in bytes')
+    parser.add_argument('-l', dest='latency', type=float, default=0.02,
+        help='delay in seconds added to every request')
+    parser.add_argument('-j', dest='workers', type=int, default=16,
+        help='concurrent fetches for the threaded and async engines')
+    parser.add_argument('-p', dest='nshards', type=int, default=1,
+        help='number of processes sharing the fetch with -shard')
+    parser.add_argument('-e', dest='engines', default='serial threaded async',
+        help='engines to benchmark')
+    args = parser.parse_args()
+
+    SlowHandler.latency = args.latency
+    with tempfile.TemporaryDirectory(prefix='bench') as top:
+        upstream = os.path.join(top, 'upstream')
+        mkRepository(upstream, 'bench', args.npkgs, args.size)
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+            functools.partial(SlowHandler, directory=upstream))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        print("%d packages of up to %d bytes, %.3f seconds latency per request" %
+            (2*args.npkgs, args.size, args.latency))
+        print("%-10s %10s %10s" % ('engine', 'seconds', 'files/s'))
+        for engine in args.engines.split():
+            cfg = os.path.join(top, engine + '.cfg')
+            with open(cfg, 'w') as f:
+                f.write('[setup]\nrepository: http://127.0.0.1:%d\ndistributions: bench\n'
+                    'components: main\nlmirror: %s\nengine: %s\nworkers: %d\n' %
+                    (server.server_address[1], os.path.join(top, engine), engine, args.workers))
+            run(['-c', cfg, '-create'])
+            elapsed, out = run(['-c', cfg, '-fetch'], args.nshards)
+            ok = 'is up to date' in run(['-c', cfg, '-norefresh'])[1]
+            dups = duplicates(os.path.join(top, engine))
+            print("%-10s %10.2f %10.1f%s%s" % (engine, elapsed, 2*args.npkgs/elapsed,
+                '' if ok else '  (mirror incomplete!)',
+                '  (%d debs fetched twice!)' % dups if dups else ''))
+        server.shutdown()
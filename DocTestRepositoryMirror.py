@@ -50,6 +50,127 @@ True
 >>> j = RepositoryMirror.RepositoryMirror(repo='jessie-test',dists=['jessie'],lmirror='tmp/jessie-mirror')
 >>> j
 RepositoryMirror(repo='jessie-test', dists=['jessie'], comps=['main', 'contrib', 'non-free'], archs=['amd64', 'all'], lmirror='tmp/jessie-mirror')
+
+# Test dependency closure of package lists
+>>> RepositoryMirror.parseDepends('libc6 (>= 2.14), perl:any | awk [amd64] <!nocheck>')
+[['libc6'], ['perl', 'awk']]
+>>> entries = [('mutt', 'pool/m/mutt.deb', '0', '10', {'Depends': 'libc6, mail-transport-agent'}),
+...     ('libc6', 'pool/l/libc6.deb', '0', '20', {}),
+...     ('exim4', 'pool/e/exim4.deb', '0', '30', {'Provides': 'mail-transport-agent'}),
+...     ('postfix', 'pool/p/postfix.deb', '0', '40', {'Provides': 'mail-transport-agent'}),
+...     ('vim', 'pool/v/vim.deb', '0', '50', {'Recommends': 'vim-runtime | vim-tiny'}),
+...     ('vim-tiny', 'pool/v/vim-tiny.deb', '0', '60', {})]
+>>> sorted(RepositoryMirror.depClosure(['mutt', 'vim'], entries))
+['exim4', 'libc6', 'mutt', 'vim', 'vim-tiny']
+>>> sorted(RepositoryMirror.depClosure(['postfix', 'mutt'], entries))
+['libc6', 'mutt', 'postfix']
+
+# Test version retention
+>>> [RepositoryMirror.compareVersions(a, b) > 0 for a, b in [('1.10-1', '1.9-1'), ('1.0~rc1-1', '1.0-1'),
+...     ('1:0.9', '2.0'), ('2.0-1+deb8u1', '2.0-1'), ('1.0', '1.0-0')]]
+[True, False, True, True, False]
+>>> entries = [('bash', 'pool/b/bash_4.3-11.deb', '0', '10', {'Version': '4.3-11', 'Architecture': 'amd64'}),
+...     ('bash', 'pool/b/bash_4.3-11+deb8u1.deb', '0', '10', {'Version': '4.3-11+deb8u1', 'Architecture': 'amd64'}),
+...     ('bash', 'pool/b/bash_4.3-9.deb', '0', '10', {'Version': '4.3-9', 'Architecture': 'amd64'}),
+...     ('bash', 'pool/b/bash_4.3-9_i386.deb', '0', '10', {'Version': '4.3-9', 'Architecture': 'i386'})]
+>>> [e[1] for e in RepositoryMirror.newestVersions(entries, 2)]
+['pool/b/bash_4.3-11.deb', 'pool/b/bash_4.3-11+deb8u1.deb', 'pool/b/bash_4.3-9_i386.deb']
+
+# Test sharding and leases
+>>> RepositoryMirror.parseShard('2/3')
+(2, 3)
+>>> sorted(set(RepositoryMirror.shardOf('pool/main/p/pkg%d.deb' % i, 3) for i in range(30)))
+[1, 2, 3]
+>>> import os, tempfile
+>>> tmp = tempfile.TemporaryDirectory()
+>>> a, b = RepositoryMirror.Leases(tmp.name), RepositoryMirror.Leases(tmp.name)
+>>> a.acquire('pool/x.deb'), b.acquire('pool/x.deb')
+(True, False)
+>>> os.utime(a.path('pool/x.deb'), (0, 0)) # a has hung
+>>> b.acquire('pool/x.deb')
+Taking over stale lease on pool/x.deb
+True
+>>> b.release('pool/x.deb'); a.acquire('pool/x.deb')
+True
+>>> tmp.cleanup()
+
+# Test -serve addresses
+>>> RepositoryMirror.parseAddress('8080'), RepositoryMirror.parseAddress('localhost:3142')
+(('', 8080), ('localhost', 3142))
+
+# Test the fetch journal
+>>> tmp = tempfile.TemporaryDirectory()
+>>> j = RepositoryMirror.Journal(tmp.name)
+>>> for name in ('a.deb', 'b.deb'):
+...     with open(os.path.join(tmp.name, name), 'w') as f:
+...         _ = f.write(name)
+...     j.record(os.path.join(tmp.name, name), 'md5-' + name)
+>>> os.remove(os.path.join(tmp.name, 'b.deb'))
+>>> _ = os.write(j.fd, b'["c.deb", 1') # torn by a crash
+>>> other = RepositoryMirror.Journal(tmp.name)
+>>> other.replay(), j.replay() # while another run has it open
+({}, {})
+>>> other.close(); j.replay()
+{'a.deb': 'md5-a.deb'}
+>>> j.compact(); j.replay()
+{}
+>>> j.close(); tmp.cleanup()
+
+# Test change manifests
+>>> tmp = tempfile.TemporaryDirectory()
+>>> m = RepositoryMirror.Manifest(tmp.name)
+>>> for path in ('dists/d/Release', 'dists/d/main/Packages.gz', 'pool/a.deb', 'pool/b.deb'):
+...     os.makedirs(os.path.dirname(os.path.join(tmp.name, path)), exist_ok=True)
+...     with open(os.path.join(tmp.name, path), 'w') as f:
+...         _ = f.write(path)
+...     m.put(os.path.join(tmp.name, path), path != 'pool/b.deb')
+>>> m.remove(os.path.join(tmp.name, 'pool/old.deb')); m.remove(os.path.join(tmp.name, 'dists/d/Packages'))
+>>> m.remove(os.path.join(tmp.name, 'pool/b.deb')) # added then removed
+>>> name = m.write('http://example') # doctest: +ELLIPSIS
+Wrote manifest ... - 0 files added, 3 replaced, 2 removed
+>>> import json
+>>> [(e['op'], e['path']) for e in json.load(open(os.path.join(tmp.name, 'manifests', name)))['files']]
+[('replace', 'pool/a.deb'), ('replace', 'dists/d/main/Packages.gz'), ('replace', 'dists/d/Release'), ('remove', 'dists/d/Packages'), ('remove', 'pool/old.deb')]
+>>> open(os.path.join(tmp.name, 'manifests', 'index')).read().split() == [name]
+True
+>>> tmp.cleanup()
+
+# Test access log popularity
+>>> log = ['10.0.0.%d - - [19/Oct/2026:10:00:00 +0000] "GET /debian/pool/main/b/bash/bash_4.3-11_amd64.deb HTTP/1.1" %s 1 "-" "APT"' % (i, s)
+...     for i, s in enumerate(['200', '304', '404'])] + [
+...     '10.0.0.9 - - [19/Oct/2026:10:00:01 +0000] "GET /debian/dists/jessie/Release HTTP/1.1" 200 1',
+...     '10.0.0.9 - - [19/Oct/2026:10:00:02 +0000] "GET /debian/pool/main/libc6_2.19-18_amd64.deb HTTP/1.1" 206 1']
+>>> sorted(RepositoryMirror.logRequests(log).items())
+[('bash', 2), ('libc6', 1)]
+
+# Test HTTP request trace histograms
+>>> t = RepositoryMirror.Trace()
+>>> t.record('http://a.example/pool/x.deb', 200, 20000, {'dns': .001, 'connect': .002, 'ttfb': .02, 'transfer': .01})
+>>> t.record('http://a.example/pool/y.deb', 206, 1000000, {'ttfb': .5, 'transfer': 2.}, True, 3000000)
+>>> t.record('http://b.example/pool/z.deb', 404, 0, {'ttfb': .05})
+>>> t.report(True)
+ host a.example: 2 requests (1 reused, 0 failed) 1020000 bytes - dns 0.5 connect 1.0 first byte 260.0 transfer 1005.0 (disk 0.0) ms/request = 507463 bytes/s
+   first byte <30ms:1 <1s:1
+   throughput <1MB/s:1 <10MB/s:1
+ host b.example: 1 requests (1 failed) 0 bytes - dns 0.0 connect 0.0 first byte 50.0 transfer 0.0 (disk 0.0) ms/request
+ size <16M: 1 requests (1 reused, 0 failed) 1000000 bytes - dns 0.0 connect 0.0 first byte 500.0 transfer 2000.0 (disk 0.0) ms/request = 500000 bytes/s
+   first byte <1s:1
+   throughput <1MB/s:1
+ size <64K: 2 requests (1 failed) 20000 bytes - dns 0.5 connect 1.0 first byte 35.0 transfer 5.0 (disk 0.0) ms/request = 2000000 bytes/s
+   first byte <30ms:1
+   throughput <10MB/s:1
+
+# Test the throughput of earlier fetches -plan estimates with
+>>> tmp = tempfile.TemporaryDirectory()
+>>> db = RepositoryMirror.MirrorDB(tmp.name)
+>>> db.throughput() == None
+True
+>>> db.recordFetch(os.path.join(tmp.name, 'pool/a.deb'), 'http://x/pool/a.deb', 3000, 2., True)
+>>> db.recordFetch(os.path.join(tmp.name, 'pool/b.deb'), 'http://x/pool/b.deb', 1000, 1., True) # concurrently
+>>> db.recordFetch(os.path.join(tmp.name, 'dists/d/Release'), 'http://x/dists/d/Release', 10, 1., True)
+>>> round(db.throughput())
+2000
+>>> db.close(); tmp.cleanup()
 """
 
 import RepositoryMirror
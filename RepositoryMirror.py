@@ -6,28 +6,25 @@ the local mirror. Can report the changes and size of the download required for
 updating and optionally update the local mirror.
 '''
 
-import urllib.request
+import urllib.parse
 import os
-import unittest
 import argparse
 import sys
-import tempfile
-import bz2
-import gzip
 import shutil
 import hashlib
 import stat
-#import time
+import threading
+import random
+import sqlite3
+import time
+import json
+import re
+import functools
+import fcntl
 from configparser import ConfigParser
 # Handle python version dependancies...
 from sys import version
 
-verbose = False
-extra_verbose = False
-dry_run = False
-very_dry_run = False
-check_md5sum = True
-
 os.umask(0o22)
 
 
@@ -39,10 +36,11 @@ else:
     from time import time as gettime
 
 
-def checkFile(file, size=None, md5sum=None):
+def checkFile(file, size=None, md5sum=None, verbose=False):
     '''
     Return True if the file is present and matches given size and/or md5sum
     If None is given that field is NOT checked
+    verbose - say when the file is missing
     '''
     try:
         if not os.access(file, os.R_OK):
@@ -69,6 +67,1088 @@ def checkFile(file, size=None, md5sum=None):
     except OSError:
         return False
 
+def parseSize(s):
+    ''' Return size in bytes of a string N[KMG] e.g. 64M '''
+    s = s.strip()
+    units = { 'K' : 1024, 'M' : 1024*1024, 'G' : 1024*1024*1024 }
+    if s[-1:].upper() in units:
+        return int(s[:-1]) * units[s[-1:].upper()]
+    return int(s)
+
+def parseDuration(s):
+    ''' Return seconds in a string N[smhd] - N on its own is hours '''
+    str2unit = { 's' : 1, 'm' : 60, 'h' : 3600, 'd' : 3600*24 }
+    unit = s[-1:]
+    if unit in str2unit:
+        return int(s[:-1]) * str2unit[unit]
+    return int(s) * 3600
+
+def statSignature(file):
+    ''' Return [size, mtime_ns, inode] of file or None if it is missing '''
+    try:
+        st = os.stat(file)
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+    except OSError:
+        return None
+
+def setReadOnly(file, src=None):
+    '''
+    Make file read only for everyone. Skipped if it already is, or if it is a hard link
+    of src - the file of a file: repository it was linked from, which is not ours to change.
+    '''
+    st = os.stat(file)
+    if src != None and st.st_nlink > 1:
+        try:
+            if os.path.samestat(st, os.stat(src)):
+                return
+        except OSError:
+            pass
+    ro = stat.S_IRUSR|stat.S_IRGRP|stat.S_IROTH
+    if stat.S_IMODE(st.st_mode) != ro:
+        os.chmod(file, ro)
+
+def localPath(url):
+    '''
+    Return the local file path for a file: URL or None if url is not local.
+    Supports the non-standard syntax "file:abc/def" meaning file at abc/def
+    '''
+    if not url.startswith('file:'):
+        return None
+    p = url[len('file:'):]
+    if p.startswith('//'):
+        host, sep, p = p[2:].partition('/')
+        if host not in ('', 'localhost'):
+            return None
+        p = '/' + p
+    return urllib.parse.unquote(p)
+
+def copyData(sf, df):
+    '''
+    Copy the rest of open file sf into open file df, inside the kernel where possible.
+    Tries copy_file_range() then sendfile() and falls back to a user space copy
+    if neither is supported between the two files.
+    '''
+    fin, fout = sf.fileno(), df.fileno()
+    for kcopy in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, kcopy):
+            continue
+        done = 0
+        try:
+            while True:
+                if kcopy == 'sendfile':
+                    n = os.sendfile(fout, fin, None, CacheFile.COPYSIZE)
+                else:
+                    n = os.copy_file_range(fin, fout, CacheFile.COPYSIZE)
+                if n == 0:
+                    return
+                done += n
+        except OSError:
+            if done > 0:
+                raise
+    shutil.copyfileobj(sf, df, CacheFile.BUFSIZE)
+
+def fetchAll(cfiles, workers):
+    '''
+    Fetch all the given CacheFiles concurrently using up to workers threads.
+    Returns list of the fetch() results in the same order as cfiles
+    '''
+    import concurrent.futures
+    if workers <= 1 or len(cfiles) <= 1:
+        return [cf.fetch() for cf in cfiles]
+    with concurrent.futures.ThreadPoolExecutor(workers) as ex:
+        return list(ex.map(lambda cf: cf.fetch(), cfiles))
+
+class Throttle:
+    '''
+    Hold some work, e.g. bytes read or requests sent, to rate units per second
+    (0 => unlimited). Time left idle is not saved up for a later burst.
+    '''
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.next = gettime() # when the next unit of work is due
+        self.lock = threading.Lock()
+
+    def delay(self, n):
+        ''' Account for n more units of work - return seconds to wait before doing them '''
+        if self.rate <= 0:
+            return 0.
+        with self.lock:
+            now = gettime()
+            start = max(self.next, now)
+            self.next = start + n/self.rate
+        return start - now
+
+    def wait(self, n):
+        ''' Account for n more units of work - sleep until they are within the rate '''
+        delay = self.delay(n)
+        if delay > 0:
+            time.sleep(delay)
+
+class HostLimits:
+    ''' Limits on the requests to one host shared by all fetches:
+connections - concurrent requests, 0 => unlimited
+rate - requests per second, 0 => unlimited
+    '''
+
+    connections = 8
+    rate = 0.
+    hosts = {} # host:port -> HostLimits
+    lock = threading.Lock()
+
+    def __init__(self):
+        self.slots = threading.BoundedSemaphore(HostLimits.connections) \
+            if HostLimits.connections > 0 else None
+        self.throttle = Throttle(HostLimits.rate)
+
+    def of(url):
+        ''' Return the HostLimits of the host of url '''
+        host = urllib.parse.urlsplit(url).netloc
+        with HostLimits.lock:
+            limits = HostLimits.hosts.get(host)
+            if limits == None:
+                limits = HostLimits.hosts[host] = HostLimits()
+        return limits
+
+    def __enter__(self):
+        if self.slots:
+            self.slots.acquire()
+        self.throttle.wait(1)
+        return self
+
+    def __exit__(self, *exc):
+        if self.slots:
+            self.slots.release()
+
+class Trace:
+    ''' Timing of each HTTP request made to fetch files (-trace FILE)
+Every request is broken down into the seconds of its DNS lookup, connect, time to first
+byte (request sent until the response headers are read) and transfer of the body - with
+write, the part of that spent writing it to disk - along with its bytes, status and
+whether it reused a keep-alive connection (only known to the async engine: urllib does not
+say). They are aggregated into histograms of the
+time to first byte and of the throughput per upstream host and per file size bucket,
+so that a slow upstream can be told from a slow link or slow disks. With a file each
+request is appended to it as a line of JSON, followed by the histograms on close().
+    '''
+
+    # (upper bound, label) of the buckets of the histograms, the last one has no bound
+    LATENCY = ((.01, '<10ms'), (.03, '<30ms'), (.1, '<100ms'), (.3, '<300ms'), (1., '<1s'),
+        (3., '<3s'), (None, '>=3s')) # time to first byte
+    RATE = ((1e5, '<100KB/s'), (1e6, '<1MB/s'), (1e7, '<10MB/s'), (1e8, '<100MB/s'),
+        (None, '>=100MB/s')) # throughput of the transfer
+    SIZES = ((64*1024, '<64K'), (1024*1024, '<1M'), (16*1024*1024, '<16M'), (None, '>=16M'))
+    TIMES = ('dns', 'connect', 'ttfb', 'transfer', 'write')
+
+    def __init__(self, file=None):
+        self.file = file # JSON lines trace written if set
+        self.fp = None
+        self.hists = {} # ('host', host) or ('size', bucket) -> histogram dict
+        self.lock = threading.Lock()
+
+    def bucket(buckets, value):
+        ''' Return the index of the bucket of value in buckets '''
+        for i, (bound, label) in enumerate(buckets):
+            if bound == None or value < bound:
+                return i
+
+    def record(self, url, status, size, timing, reused=None, file_size=None):
+        ''' Add a request for url which got HTTP status (None if it failed before one) and
+        size bytes, with its seconds in dict timing by Trace.TIMES - reused is whether it was
+        sent on a kept-alive connection, None if that is not known, and file_size is that of
+        the whole file if the request was for a part of it '''
+        r = {'time': round(time.time(), 3), 'url': url, 'host': urllib.parse.urlsplit(url).netloc,
+            'status': status, 'bytes': size}
+        if reused != None:
+            r['reused'] = reused
+        for t in Trace.TIMES:
+            r[t] = round(timing.get(t, 0.), 6)
+        with self.lock:
+            sized = Trace.SIZES[Trace.bucket(Trace.SIZES, file_size if file_size else size)][1]
+            for key in (('host', r['host']), ('size', sized)):
+                h = self.hists.get(key)
+                if h == None:
+                    h = self.hists[key] = dict({t: 0. for t in Trace.TIMES}, requests=0,
+                        bytes=0, reused=None, errors=0, latency=[0]*len(Trace.LATENCY),
+                        rate=[0]*len(Trace.RATE))
+                h['requests'] += 1
+                h['bytes'] += size
+                if reused != None:
+                    h['reused'] = (h['reused'] or 0) + reused
+                for t in Trace.TIMES:
+                    h[t] += r[t]
+                if status == None or status >= 400:
+                    h['errors'] += 1
+                if status not in (200, 206):
+                    continue
+                h['latency'][Trace.bucket(Trace.LATENCY, r['ttfb'])] += 1
+                if r['transfer'] > 0:
+                    h['rate'][Trace.bucket(Trace.RATE, size / r['transfer'])] += 1
+            if self.file:
+                if not self.fp:
+                    self.fp = open(self.file, 'a')
+                self.fp.write(json.dumps(r) + '\n')
+
+    def report(self, histograms=False):
+        ''' Print the mean times and throughput of each host and file size - with their
+        histograms if histograms '''
+        def histogram(buckets, counts):
+            return ' '.join('%s:%d' % (b[1], n) for b, n in zip(buckets, counts) if n)
+        for (kind, name), h in sorted(self.hists.items()):
+            n = h['requests']
+            print(" %s %s: %d requests (%s%d failed) %d bytes - dns %.1f connect %.1f "
+                "first byte %.1f transfer %.1f (disk %.1f) ms/request%s" % (kind, name, n,
+                "%d reused, " % h['reused'] if h['reused'] != None else "", h['errors'], h['bytes'], 1000*h['dns']/n, 1000*h['connect']/n,
+                1000*h['ttfb']/n, 1000*h['transfer']/n, 1000*h['write']/n,
+                " = %.0f bytes/s" % (h['bytes']/h['transfer']) if h['transfer'] > 0 else ""))
+            if histograms and any(h['latency']):
+                print("   first byte " + histogram(Trace.LATENCY, h['latency']))
+            if histograms and any(h['rate']):
+                print("   throughput " + histogram(Trace.RATE, h['rate']))
+
+    def close(self):
+        ''' Write the histograms to the trace file and close it '''
+        with self.lock:
+            if self.fp:
+                self.fp.write(json.dumps({'histograms': [dict(h, kind=kind, name=name)
+                    for (kind, name), h in sorted(self.hists.items())]}) + '\n')
+                self.fp.close()
+                self.fp = None
+
+RETRY_CODES = (408, 425, 429, 500, 502, 503, 504) # HTTP statuses worth retrying
+
+def transient(error):
+    '''
+    Return True if a fetch that failed with exception error may work if retried:
+    network errors, timeouts and HTTP RETRY_CODES, but not e.g. 404 or a missing local file
+    '''
+    import urllib.error
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code in RETRY_CODES
+    if isinstance(error, (FileNotFoundError, IsADirectoryError, PermissionError)):
+        return False
+    return isinstance(error, (OSError, EOFError))
+
+def retryDelay(attempt, error=None):
+    '''
+    Return seconds to wait before retry attempt 1, 2, ... - exponential backoff from
+    CacheFile.retry_base up to CacheFile.retry_max with full jitter, so that many
+    failed fetches do not all come back at once, but at least any Retry-After
+    seconds the server asked for
+    '''
+    delay = random.uniform(0, min(CacheFile.retry_max, CacheFile.retry_base * 2**(attempt - 1)))
+    headers = getattr(error, 'headers', None)
+    after = headers.get('retry-after', '') if headers else ''
+    if after.strip().isdigit():
+        delay = max(delay, min(float(after), CacheFile.retry_max))
+    return delay
+
+def tracedOpener():
+    '''
+    Return a urllib.request opener whose HTTP and HTTPS connections add to the dict
+    timing of each Request (see tracedOpen()) the seconds of the 'dns' lookup of its host
+    and of the 'connect's to its addresses. A mirror makes it once and uses it for all
+    its requests. urllib makes a new connection for every request so none is reused
+    '''
+    import socket
+    import http.client
+    import urllib.request
+
+    class TimedConnection(http.client.HTTPConnection):
+        def __init__(self, *a, timing=None, **kw):
+            super().__init__(*a, **kw)
+            self.timing = timing
+
+        def connect(self):
+            ''' Look up the host then connect to each of its addresses in turn, timing both '''
+            timing = self.timing if self.timing != None else {}
+            host = self.host
+            start = gettime()
+            infos = socket.getaddrinfo(host, self.port, 0, socket.SOCK_STREAM)
+            resolved = gettime()
+            timing['dns'] = timing.get('dns', 0.) + resolved - start
+            try:
+                for i, info in enumerate(infos):
+                    self.host = info[4][0]
+                    try:
+                        return super().connect()
+                    except OSError:
+                        if i == len(infos) - 1:
+                            raise
+            finally:
+                self.host = host # for the TLS handshake of an HTTPS connection
+                timing['connect'] = timing.get('connect', 0.) + gettime() - resolved
+
+    class TimedHTTPSConnection(http.client.HTTPSConnection, TimedConnection):
+        ''' Its TCP connection is made by TimedConnection.connect() '''
+        def __init__(self, *a, timing=None, **kw):
+            super().__init__(*a, **kw)
+            self.timing = timing
+
+    class HTTPHandler(urllib.request.HTTPHandler):
+        def http_open(self, req):
+            return self.do_open(functools.partial(TimedConnection,
+                timing=getattr(req, 'timing', None)), req)
+
+    class HTTPSHandler(urllib.request.HTTPSHandler):
+        def __init__(self, context=None):
+            super().__init__(context=context)
+            self.context = context
+
+        def https_open(self, req):
+            return self.do_open(functools.partial(TimedHTTPSConnection,
+                timing=getattr(req, 'timing', None)), req, context=self.context)
+
+    return urllib.request.build_opener(HTTPHandler, HTTPSHandler)
+
+def tracedOpen(opener, req, timing, timeout=None):
+    '''
+    Open req (a URL or Request) with tracedOpener() opener adding to dict timing the seconds
+    of the 'dns' lookups, 'connect's and the time to first byte 'ttfb' - until the response
+    headers have been read. timeout - seconds a connect or read may block, None => no limit
+    '''
+    import urllib.request
+    if isinstance(req, str):
+        req = urllib.request.Request(req)
+    req.timing = timing
+    start = gettime()
+    try:
+        return opener.open(req, timeout=timeout)
+    finally:
+        timing['ttfb'] = gettime() - start - timing.get('dns', 0.) - timing.get('connect', 0.)
+
+def idleIO():
+    '''
+    Put the calling thread in the idle I/O scheduling class (ionice -c 3) so it only
+    uses the disks when nothing else wants them. Where ionice is not available the
+    thread's nice value is raised instead. Returns True if the idle class was set.
+    '''
+    import subprocess
+    tid = threading.get_native_id()
+    try:
+        subprocess.run(['ionice', '-c', '3', '-p', str(tid)], check=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return True
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    try:
+        os.setpriority(os.PRIO_PROCESS, tid, 19)
+    except OSError:
+        pass
+    return False
+
+def shardOf(fname, n):
+    ''' Return the shard 1..n the deb with Filename fname belongs to - the same on every host '''
+    return int(hashlib.md5(fname.encode()).hexdigest()[:8], 16) % n + 1
+
+def parseShard(s):
+    ''' Parse i/N into the tuple (i, N) with 1 <= i <= N '''
+    m = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', s)
+    if not m or not 1 <= int(m.group(1)) <= int(m.group(2)):
+        raise ValueError("shard must be i/N with 1 <= i <= N: %s" % s)
+    return int(m.group(1)), int(m.group(2))
+
+class Leases:
+    ''' Lease files in <lmirror>/.leases which stop cooperating processes fetching the same deb
+A lease is a file named by the md5 of the deb's Filename, created with O_EXCL and holding
+its owner's host and pid. The owner touches it while the fetch is in progress, so a lease
+not touched for timeout seconds belongs to a process which has died or hung and is taken
+over by renaming it away (only one process can win the rename) and creating a new one.
+    '''
+
+    DIR = '.leases'
+    timeout = 600 # seconds after which an untouched lease is stale
+
+    def __init__(self, lmirror):
+        self.dir = os.path.join(lmirror, Leases.DIR)
+        os.makedirs(self.dir, exist_ok=True)
+        self.owner = '%s.%d' % (os.uname().nodename, os.getpid())
+        self.held = set()
+        self.lock = threading.Lock()
+        self.keeper = None
+
+    def path(self, fname):
+        return os.path.join(self.dir, hashlib.md5(fname.encode()).hexdigest())
+
+    def acquire(self, fname):
+        ''' Return True if the lease on fname was taken - a stale one is taken over '''
+        path = self.path(fname)
+        for attempt in range(2):
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+                os.write(fd, ('%s %s\n' % (self.owner, fname)).encode())
+                os.close(fd)
+                with self.lock:
+                    self.held.add(path)
+                    if self.keeper == None:
+                        self.keeper = threading.Thread(target=self.keepAlive, daemon=True)
+                        self.keeper.start()
+                return True
+            except FileExistsError:
+                pass
+            try:
+                if time.time() - os.stat(path).st_mtime < Leases.timeout:
+                    return False
+                stale = '%s.%s' % (path, self.owner)
+                os.rename(path, stale)
+                if time.time() - os.stat(stale).st_mtime < Leases.timeout:
+                    # lost a race - put back the lease another process has just taken
+                    try:
+                        os.link(stale, path)
+                    except OSError:
+                        pass
+                    os.unlink(stale)
+                    return False
+                os.unlink(stale)
+                print("Taking over stale lease on %s" % fname)
+            except OSError:
+                return False
+        return False
+
+    def release(self, fname):
+        path = self.path(fname)
+        with self.lock:
+            self.held.discard(path)
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def keepAlive(self):
+        ''' Touch the leases held every quarter of the timeout so they are not taken over '''
+        while True:
+            time.sleep(Leases.timeout/4)
+            with self.lock:
+                held = list(self.held)
+            for path in held:
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+
+def flockFile(path, exclusive=True, blocking=True):
+    '''
+    Open path (creating it) and flock(2) it exclusive or shared.
+    Returns the file descriptor - closing it releases the lock - or None if
+    not blocking and another open file holds a conflicting lock
+    '''
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) |
+            (0 if blocking else fcntl.LOCK_NB))
+        return fd
+    except BlockingIOError:
+        os.close(fd)
+        return None
+
+class PoolLocks:
+    ''' flock(2) locks in <lmirror>/.locks which stop runs against the same mirror fetching into
+the same part of the pool at once. Debs are shared between BUCKETS lock files by the md5 of
+their Filename. Unlike leases they are released by the kernel when a run dies, but only
+work between processes whose file system supports flock.
+    '''
+
+    DIR = '.locks'
+    BUCKETS = 256
+
+    def __init__(self, lmirror):
+        self.dir = os.path.join(lmirror, PoolLocks.DIR)
+        os.makedirs(self.dir, exist_ok=True)
+        self.held = {} # bucket lock file -> [its fd, number of debs of it being fetched]
+        self.lock = threading.Lock()
+
+    def bucket(self, fname):
+        return os.path.join(self.dir, '%02x' %
+            (int(hashlib.md5(fname.encode()).hexdigest()[:8], 16) % PoolLocks.BUCKETS))
+
+    def acquire(self, fname, blocking=False):
+        '''
+        Lock the bucket of fname - returns False if not blocking and another run has it.
+        A bucket is locked once by a process, however many of its threads are fetching
+        debs of it, and unlocked when the last of them calls release().
+        '''
+        path = self.bucket(fname)
+        with self.lock:
+            h = self.held.get(path)
+            if h == None:
+                fd = flockFile(path, blocking=False)
+                if fd != None:
+                    h = self.held[path] = [fd, 0]
+            if h != None:
+                h[1] += 1
+                return True
+        if not blocking:
+            return False
+        fd = flockFile(path) # no thread of this process can have it until this returns
+        with self.lock:
+            self.held[path] = [fd, 1]
+        return True
+
+    def release(self, fname):
+        path = self.bucket(fname)
+        with self.lock:
+            h = self.held.get(path)
+            if h == None:
+                return
+            h[1] -= 1
+            if h[1] == 0:
+                del self.held[path]
+                os.close(h[0])
+
+class Journal:
+    ''' Append-only record in <lmirror>/.journal of every file a run puts in place, one JSON
+line [path, size, mtime_ns, inode, md5sum] each, written as the file is renamed into place.
+It is emptied once a run completes, so a journal with entries is from an interrupted run:
+replay() returns those whose files are still as they were recorded. Each line is a single
+O_APPEND write so a crash can at worst leave a torn last line, which is ignored.
+Every run holds a shared flock on it, so one that can briefly make it exclusive knows no
+other run is still writing it and can replay or empty it.
+    '''
+
+    NAME = '.journal'
+
+    def __init__(self, lmirror):
+        self.lmirror = lmirror
+        self.path = os.path.join(lmirror, Journal.NAME)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        fcntl.flock(self.fd, fcntl.LOCK_SH)
+
+    def alone(self):
+        ''' Return True if no other run has the journal open '''
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            alone = True
+        except BlockingIOError:
+            alone = False # and the failed conversion dropped the shared lock
+        fcntl.flock(self.fd, fcntl.LOCK_SH)
+        return alone
+
+    def record(self, file, md5sum=None):
+        try:
+            st = os.stat(file)
+        except OSError:
+            return
+        os.write(self.fd, (json.dumps([os.path.relpath(file, self.lmirror), st.st_size,
+            st.st_mtime_ns, st.st_ino, md5sum]) + '\n').encode())
+
+    def replay(self):
+        '''
+        Return {path: md5sum} of the recorded files which are unchanged since - none while
+        another run could be writing the journal
+        '''
+        if not self.alone():
+            return {}
+        files = {}
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        path, size, mtime_ns, ino, md5sum = json.loads(line)
+                    except ValueError:
+                        continue
+                    files[path] = (size, mtime_ns, ino, md5sum)
+        except OSError:
+            return {}
+        present = {}
+        for path, (size, mtime_ns, ino, md5sum) in files.items():
+            if statSignature(os.path.join(self.lmirror, path)) == [size, mtime_ns, ino]:
+                present[path] = md5sum
+        return present
+
+    def compact(self):
+        ''' Empty the journal once a run has completed, unless another run is writing it '''
+        if self.alone():
+            os.ftruncate(self.fd, 0)
+
+    def close(self):
+        os.close(self.fd)
+
+def sha256File(file):
+    ''' Return the SHA256 hex digest of file or None if it cannot be read '''
+    m = hashlib.sha256()
+    try:
+        with open(file, 'rb') as f:
+            for b in iter(lambda: f.read(CacheFile.SEGBUFSIZE), b''):
+                m.update(b)
+    except OSError:
+        return None
+    return m.hexdigest()
+
+class Manifest:
+    ''' Changes a run makes to the dists/ and pool/ trees of the mirror, for downstream mirrors
+to apply with -apply-manifest. Written as <lmirror>/manifests/<stamp>.json - the time, the
+repository and "files": a list of {"op": "add"|"replace"|"remove", "path", "size", "sha256"}
+ordered so that a mirror applying it in turn never has an index file which lists a file it
+does not have yet: pool files put in place, then index files with each distribution's Release
+files last, then index files and pool files removed - and "previous", the manifest before it.
+manifests/index lists them oldest first; they are deleted manifest_keep seconds after they
+were written.
+    '''
+
+    DIR = 'manifests'
+    INDEX = 'index'
+    TREES = ('dists', 'pool')
+    RELEASE_FILES = ('Release', 'Release.gpg', 'InRelease')
+
+    def __init__(self, lmirror, keep=7*24*3600):
+        self.lmirror = lmirror
+        self.keep = keep # seconds manifests are kept
+        self.dir = os.path.join(lmirror, Manifest.DIR)
+        self.changes = {} # path relative to the mirror -> 'add', 'replace' or 'remove'
+        self.lock = threading.Lock()
+
+    def put(self, file, existed=True):
+        ''' Note file put in place - replacing an existing file if existed '''
+        path = os.path.relpath(file, self.lmirror)
+        with self.lock:
+            op = self.changes.get(path)
+            self.changes[path] = 'add' if op == 'add' or (op == None and not existed) else 'replace'
+
+    def remove(self, file):
+        ''' Note file deleted from its place '''
+        path = os.path.relpath(file, self.lmirror)
+        with self.lock:
+            if self.changes.get(path) == 'add':
+                del self.changes[path]
+            else:
+                self.changes[path] = 'remove'
+
+    def compare(self, old, new, top):
+        '''
+        Note the changes made to directory top of the mirror (e.g. dists/<dist>) by making it
+        directory new instead of old (None if there was none) - files are compared by inode
+        '''
+        def files(d):
+            found = {}
+            for root, dirs, names in os.walk(d):
+                for name in names:
+                    path = os.path.join(root, name)
+                    found[os.path.relpath(path, d)] = os.lstat(path).st_ino
+            return found
+        before = files(old) if old else {}
+        for name, ino in files(new).items():
+            if before.get(name) != ino:
+                self.put(os.path.join(self.lmirror, top, name), name in before)
+        for name in before:
+            if not os.path.lexists(os.path.join(new, name)):
+                self.remove(os.path.join(self.lmirror, top, name))
+
+    def order(item):
+        path, op = item
+        pool = path.startswith('pool/')
+        if op == 'remove':
+            return (3 if pool else 2, False, path)
+        return (0 if pool else 1, os.path.basename(path) in Manifest.RELEASE_FILES, path)
+
+    def write(self, repository):
+        '''
+        Write the changes noted as a new manifest and add it to the index, deleting manifests
+        older than manifest_keep. Returns its name or None if there were no changes
+        '''
+        changes = sorted(((p, op) for p, op in self.changes.items()
+            if p.split(os.sep)[0] in Manifest.TREES), key=Manifest.order)
+        if not changes:
+            return None
+        entries = []
+        for path, op in changes:
+            e = {'op': op, 'path': path}
+            if op != 'remove':
+                file = os.path.join(self.lmirror, path)
+                e['sha256'] = sha256File(file)
+                if e['sha256'] == None:
+                    continue # gone again
+                e['size'] = os.path.getsize(file)
+            entries.append(e)
+        os.makedirs(self.dir, exist_ok=True)
+        name = time.strftime('%Y%m%d-%H%M%S') + '-%d.json' % os.getpid()
+        index = os.path.join(self.dir, Manifest.INDEX)
+        fd = flockFile(index + '.lock')
+        try:
+            try:
+                with open(index) as f:
+                    names = f.read().split()
+            except OSError:
+                names = []
+            tmp = os.path.join(self.dir, '.' + name)
+            with open(tmp, 'w') as f:
+                json.dump({'time': time.time(), 'repository': repository,
+                    'previous': names[-1] if names else None, 'files': entries}, f, indent=0)
+            os.rename(tmp, os.path.join(self.dir, name))
+            now = time.time()
+            for n in list(names):
+                path = os.path.join(self.dir, n)
+                if not os.path.exists(path) or \
+                        now - os.path.getmtime(path) >= self.keep:
+                    names.remove(n)
+                    if os.path.exists(path):
+                        os.unlink(path)
+            names.append(name)
+            with open(index + '.new', 'w') as f:
+                f.write(''.join(n + '\n' for n in names))
+            os.rename(index + '.new', index)
+        finally:
+            os.close(fd)
+        self.changes = {}
+        print("Wrote manifest %s - %d files added, %d replaced, %d removed" % (name,
+            sum(e['op'] == 'add' for e in entries), sum(e['op'] == 'replace' for e in entries),
+            sum(e['op'] == 'remove' for e in entries)))
+        return name
+
+def parseAddress(s):
+    ''' Parse [host:]port into the tuple (host, port) - host '' is every interface '''
+    m = re.fullmatch(r'\s*(?:([^:]*):)?(\d+)\s*', s)
+    if not m or not 0 < int(m.group(2)) < 65536:
+        raise ValueError("address must be [host:]port: %s" % s)
+    return m.group(1) or '', int(m.group(2))
+
+class MirrorHandler:
+    ''' Serve the dists/, pool/ and manifests/ trees of the mirror of server.mirror, fetching
+a missing deb which a Package file lists from upstream before sending it (-serve)
+A mixin for http.server.SimpleHTTPRequestHandler - serve() combines them so that only
+-serve imports http.server
+    '''
+    TREES = ('dists', 'pool', 'manifests')
+
+    def mirrorPath(self):
+        ''' Return the request's path relative to the mirror, None if it is outside dists/, pool/
+        and manifests/ '''
+        path = os.path.normpath(urllib.parse.unquote(urllib.parse.urlsplit(self.path).path))
+        path = path.lstrip('/')
+        if path.split('/')[0] not in MirrorHandler.TREES:
+            return None
+        return path
+
+    def fill(self):
+        ''' Make sure the file requested is in the mirror - returns False if an error was sent '''
+        path = self.mirrorPath()
+        if path == None:
+            self.send_error(404)
+            return False
+        mirror = self.server.mirror
+        if path.startswith('pool/') and not os.path.exists(mirror.getDebPath(path)):
+            ok = mirror.fillDeb(path)
+            if ok == None:
+                self.send_error(404, "Not in any Package file")
+                return False
+            if not ok:
+                self.send_error(502, "Unable to fetch from upstream")
+                return False
+        return True
+
+    def do_GET(self):
+        if self.fill():
+            super().do_GET()
+
+    def do_HEAD(self):
+        if self.fill():
+            super().do_HEAD()
+
+    def log_message(self, format, *a):
+        if self.server.mirror.options.verbose:
+            super().log_message(format, *a)
+
+# request and status of an Apache/nginx common or combined log format line
+ACCESS_RE = re.compile(r'"(?:GET|HEAD) (\S+) HTTP/[\d.]+" (\d{3}) ')
+
+def logRequests(lines, counts=None):
+    '''
+    Count the successful requests for pool/ debs in access log lines by package name
+    Returns counts - {package name: requests}
+    '''
+    if counts == None:
+        counts = {}
+    for line in lines:
+        m = ACCESS_RE.search(line)
+        if not m or m.group(2) not in ('200', '206', '304'):
+            continue
+        path = urllib.parse.unquote(urllib.parse.urlsplit(m.group(1)).path)
+        if '/pool/' not in path or not path.endswith('.deb'):
+            continue
+        name = os.path.basename(path).split('_')[0]
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+def readPkgIndex(rfile, ctype):
+    '''
+    Decompress and parse Package file rfile of compression type ctype.
+    Returns a list of the (Package, Filename, MD5sum, Size, fields) of each entry
+    where fields is a dict of its PkgEntry.FIELDS.
+    Only uses picklable values so it may run in a worker process
+    '''
+    import bz2
+    import gzip
+    if ctype.endswith('bz2'):
+        fp = bz2.BZ2File(rfile, 'r')
+    elif ctype.endswith('gzip'):
+        fp = gzip.open(rfile, 'r')
+    else:
+        fp = open(rfile, 'rb')
+    entries = []
+    with fp:
+        while True:
+            p = PkgEntry.getPkgEntry(fp)
+            if p == None:
+                break
+            entries.append((p.name, p.fname, p.md5sum, p.size, p.fields))
+    return entries
+
+def parseDepends(s):
+    '''
+    Parse a Depends/Pre-Depends/Recommends/Provides field into a list of dependencies,
+    each a list of alternative package names. Versions, architecture qualifiers and
+    restrictions are dropped.
+    '''
+    deps = []
+    for group in s.split(','):
+        alts = []
+        for a in group.split('|'):
+            a = re.sub(r'\(.*?\)|\[.*?\]|<.*?>', '', a).strip()
+            if a:
+                alts.append(a.split(':')[0])
+        if alts:
+            deps.append(alts)
+    return deps
+
+def depClosure(names, entries, fields=('Pre-Depends', 'Depends', 'Recommends')):
+    '''
+    Return the set of package names needed to install all of names, from the
+    (Package, Filename, MD5sum, Size, fields) entries of a distribution's Package files.
+    A dependency already satisfied by a package in the set - directly or via its
+    Provides - adds nothing, otherwise the first alternative that is a real package
+    is added, else the first package which provides it.
+    '''
+    stanzas = {} # name -> list of fields dicts (one per version/architecture)
+    providers = {} # virtual name -> list of packages providing it
+    for e in entries:
+        stanzas.setdefault(e[0], []).append(e[4])
+        for alts in parseDepends(e[4].get('Provides', '')):
+            providers.setdefault(alts[0], []).append(e[0])
+
+    closure = set()
+    provided = set()
+    todo = []
+    def add(n):
+        if n not in closure:
+            closure.add(n)
+            todo.append(n)
+            for f in stanzas[n]:
+                provided.update(a[0] for a in parseDepends(f.get('Provides', '')))
+    for n in names:
+        if n in stanzas:
+            add(n)
+    while todo:
+        n = todo.pop()
+        for f in stanzas[n]:
+            for field in fields:
+                for alts in parseDepends(f.get(field, '')):
+                    if any(a in closure or a in provided for a in alts):
+                        continue
+                    real = [a for a in alts if a in stanzas]
+                    if real:
+                        add(real[0])
+                        continue
+                    prov = [p for a in alts for p in sorted(providers.get(a, []))]
+                    if prov:
+                        add(prov[0])
+    return closure
+
+def compareVersions(a, b):
+    '''
+    Compare Debian package versions a and b as dpkg does
+    Returns < 0 if a is older than b, 0 if they are the same, > 0 if a is newer
+    '''
+    def split(v):
+        epoch, sep, rest = v.partition(':') if ':' in v else ('0', '', v)
+        upstream, sep, revision = rest.rpartition('-') if '-' in rest else (rest, '', '')
+        return int(epoch or '0'), upstream, revision
+
+    def order(c):
+        if c == '' or c in '0123456789':
+            return 0
+        if c.isascii() and c.isalpha():
+            return ord(c)
+        if c == '~':
+            return -1
+        return ord(c) + 256
+
+    def verrevcmp(a, b):
+        digits = '0123456789'
+        i = j = 0
+        while i < len(a) or j < len(b):
+            first_diff = 0
+            while (i < len(a) and a[i] not in digits) or (j < len(b) and b[j] not in digits):
+                ac, bc = order(a[i:i+1]), order(b[j:j+1])
+                if ac != bc:
+                    return ac - bc
+                i += 1
+                j += 1
+            while a[i:i+1] == '0':
+                i += 1
+            while b[j:j+1] == '0':
+                j += 1
+            while i < len(a) and a[i] in digits and j < len(b) and b[j] in digits:
+                if not first_diff:
+                    first_diff = ord(a[i]) - ord(b[j])
+                i += 1
+                j += 1
+            if i < len(a) and a[i] in digits:
+                return 1
+            if j < len(b) and b[j] in digits:
+                return -1
+            if first_diff:
+                return first_diff
+        return 0
+
+    ea, ua, ra = split(a)
+    eb, ub, rb = split(b)
+    if ea != eb:
+        return ea - eb
+    return verrevcmp(ua, ub) or verrevcmp(ra, rb)
+
+def newestVersions(entries, keep):
+    '''
+    Return the (Package, Filename, MD5sum, Size, fields) entries without all but
+    the newest keep versions of each package and architecture
+    '''
+    groups = {}
+    for e in entries:
+        groups.setdefault((e[0], e[4].get('Architecture')), []).append(e)
+    newest = functools.cmp_to_key(lambda x, y:
+        compareVersions(y[4].get('Version', '0'), x[4].get('Version', '0')))
+    kept = set()
+    for versions in groups.values():
+        kept.update(id(e) for e in sorted(versions, key=newest)[:keep])
+    return [e for e in entries if id(e) in kept]
+
+class MirrorError(Exception):
+    ''' A RepositoryMirror cannot go on - e.g. its configuration is unusable '''
+
+class Options:
+    ''' Options of a RepositoryMirror: the command line flags and the settings of a configuration file
+A program using the module as a library gives each RepositoryMirror its own Options, so
+mirrors with different options can be run side by side in threads:
+    verbose, extra_verbose - print more of what is done
+    dry_run - print the changes to the mirror instead of making them (temporary files are made)
+    very_dry_run - do not even make temporary files
+    onlypkgs - check debs by size only, not by md5sum (the default)
+    plan - fetch the Release and Package files to plan a run but leave the mirror as it is
+           (debs are checked by size only)
+    settings - {attribute: value} of RepositoryMirror settings which override the class defaults
+    tuning - {(class, attribute): value} of the settings of the other classes - these are
+             the same for every mirror in the process and are only set by apply()
+    '''
+
+    def __init__(self, verbose=False, dry_run=False, very_dry_run=False, onlypkgs=True,
+            extra_verbose=False, settings=None, plan=False):
+        self.verbose = verbose
+        self.extra_verbose = extra_verbose
+        self.dry_run = dry_run or very_dry_run
+        self.very_dry_run = very_dry_run
+        self.plan = plan
+        self.onlypkgs = onlypkgs or plan
+        self.settings = settings if settings != None else {}
+        self.tuning = {}
+
+    def read(cfgFile, **flags):
+        ''' Return Options with flags and the settings of the [setup] section of configuration
+        file cfgFile if it can be read '''
+        o = Options(**flags)
+        if not os.access(cfgFile, os.R_OK):
+            return o
+        cfg = ConfigParser()
+        cfg.read(cfgFile)
+        setup = cfg['setup']
+        s, t = o.settings, o.tuning
+        r = setup.get('repository', None)
+        if r:
+            s['upstreams'] = r.split()
+            s['repository'] = s['upstreams'][0]
+        for name in ('distributions', 'components', 'architectures', 'access_logs'):
+            if setup.get(name, None):
+                s[name] = setup.get(name).split()
+        for name in ('tdir', 'lmirror', 'engine', 'delta_source', 'debpatch', 'trace_file'):
+            if name in setup:
+                s[name] = setup.get(name)
+        if 'workers' in setup:
+            s['workers'] = setup.getint('workers')
+        for name in ('snapshots', 'manifests'):
+            if name in setup:
+                s[name] = setup.getboolean(name)
+        for name in ('status_max_age', 'prune_grace', 'snapshot_keep', 'scrub_period',
+                'popularity_half_life', 'manifest_keep'):
+            if setup.get(name, None):
+                s[name] = parseDuration(setup.get(name))
+        if 'scrub_rate' in setup:
+            s['scrub_rate'] = parseSize(setup.get('scrub_rate'))
+        if s.get('engine', RepositoryMirror.engine) not in RepositoryMirror.engines:
+            print("Unknown engine '%s' - using serial" % s['engine'])
+            s['engine'] = 'serial'
+        for cls, name, key, get in ((CacheFile, 'hardlink', 'hardlink', setup.getboolean),
+                (CacheFile, 'segments', 'segments', setup.getint),
+                (CacheFile, 'retries', 'retries', setup.getint),
+                (CacheFile, 'retry_base', 'retry_base', setup.getfloat),
+                (CacheFile, 'retry_max', 'retry_max', setup.getfloat),
+                (CacheFile, 'timeout', 'timeout', setup.getfloat),
+                (HostLimits, 'connections', 'host_connections', setup.getint),
+                (HostLimits, 'rate', 'host_rate', setup.getfloat),
+                (UpstreamPool, 'DEMOTE_FAILS', 'breaker_fails', setup.getint)):
+            if key in setup:
+                t[(cls, name)] = get(key)
+        if 'segment_min' in setup:
+            t[(CacheFile, 'segment_min')] = parseSize(setup.get('segment_min'))
+        if setup.get('lease_timeout', None):
+            t[(Leases, 'timeout')] = parseDuration(setup.get('lease_timeout'))
+        if setup.get('breaker_time', None):
+            t[(UpstreamPool, 'DEMOTE_TIME')] = float(parseDuration(setup.get('breaker_time')))
+        pL = {}
+        s['closure'], s['keep_versions'] = set(), {}
+        for d in s.get('distributions', RepositoryMirror.distributions):
+            pkglist = setup.get('packages-' + d, None)
+            if o.verbose:
+                print("pkglist for ", d, "is", pkglist)
+            if pkglist:
+                pL[d] = pkglist
+            if setup.getboolean('closure-' + d, setup.getboolean('closure', False)):
+                s['closure'].add(d)
+            keep = setup.getint('keep_versions-' + d, setup.getint('keep_versions', 0))
+            if keep > 0:
+                s['keep_versions'][d] = keep
+        if len(pL) > 0:
+            s['pkgLists'] = pL
+        return o
+
+    def apply(self):
+        '''
+        Make the settings the defaults of every mirror in the process and set the tuning,
+        which is process-global: a mirror's Options cannot give it tuning of its own
+        '''
+        for name, value in self.settings.items():
+            setattr(RepositoryMirror, name, value)
+        for (cls, name), value in self.tuning.items():
+            setattr(cls, name, value)
+
+class MirrorState:
+    ''' What RepositoryMirror.checkState() found - true if the mirror needs updating:
+    changed - Release and index files changed upstream
+    failed - Release and index files missing which could not be fetched
+    missing - debs the Package files list which are missing from the pool
+    missing_bytes - their total size
+    '''
+
+    def __init__(self, updated=False, changed=0, failed=0, missing=0, missing_bytes=0):
+        self.updated = updated
+        self.changed = changed
+        self.failed = failed
+        self.missing = missing
+        self.missing_bytes = missing_bytes
+
+    def __bool__(self):
+        return bool(self.updated)
+
+    def __repr__(self):
+        return 'MirrorState(updated=%r, changed=%d, failed=%d, missing=%d, missing_bytes=%d)' % (
+            self.updated, self.changed, self.failed, self.missing, self.missing_bytes)
+
 class RepositoryMirror:
     ''' Debian Repository Mirroror - check state and optionally update
 Check a debian repository at a given URL. Repository consists of directory structure at repo:
@@ -99,23 +1179,32 @@ Dictionaries:
     debfiles - DebFile => Debian Package info
     '''
 
-    def __init__(self, repo=None, dists=None, comps=None, archs=None, lmirror=None):
+    def __init__(self, repo=None, dists=None, comps=None, archs=None, lmirror=None, options=None):
         ''' Mirror subset of a debian repository - configurable subset of distributions/components/architectures
     repo - base URL of repository
     dists - distributions
     comps - components
     archs - architectures
     lmirror - local directory to mirror
+    options - Options of this mirror, its settings override the class defaults
         '''
 
-        self.repo = repo = repo if repo else RepositoryMirror.repository
-        self.dists = dists if dists else RepositoryMirror.distributions
-        self.comps = comps if comps else RepositoryMirror.components
-        self.archs = archs if archs else RepositoryMirror.architectures
-        self.lmirror = lmirror if lmirror else RepositoryMirror.lmirror
+        self.options = options = options if options else Options()
+        for name, value in options.settings.items():
+            setattr(self, name, value)
+        self.tprefix = self.tdir
+        self.repo = repo = repo if repo else self.repository
+        if repo == self.repository and self.upstreams:
+            self.upstreams = UpstreamPool(self.upstreams)
+        else:
+            self.upstreams = UpstreamPool([repo])
+        self.dists = dists if dists else self.distributions
+        self.comps = comps if comps else self.components
+        self.archs = archs if archs else self.architectures
+        self.lmirror = lmirror if lmirror else self.lmirror
         self.debList = {} # package file -> list of deb entries
-        if RepositoryMirror.pkgLists:
-            self.parsePkgLists(RepositoryMirror.pkgLists)
+        if self.pkgLists:
+            self.parsePkgLists(self.pkgLists)
         else:
             self.pkgLists = None
         self.updated = False
@@ -124,51 +1213,73 @@ Dictionaries:
         self.relfiles = {}
         self.pkgfiles = {}
         self.debfiles = {}
+        self.cfiles = {} # (dist, file name) -> CacheFile
+        self.db = None # MirrorDB once skeletonCheck() has found the mirror
+        self.leases = None # Leases shared with the other shards' processes
+        self.poolLocks = None # PoolLocks shared with other runs against the mirror
+        self.mirrorLock = None # fd holding the whole mirror lock
+        self.lock = threading.Lock()
+        self.others = 0 # debs left to other processes
+        self.timedout = 0 # debs not fetched as the timeout expired
+        self.deferred = [] # debs whose pool bucket another run had locked
+        self.deltas = [0, 0, 0] # debs rebuilt from deltas, bytes of deltas fetched, bytes of those debs
+        self.staging = {} # distribution -> snapshot directory being staged
+        self.created = set() # snapshot directories this run started
+        self.published = {} # distribution -> snapshot directory published by this run
+        self.served = {} # Filename -> PkgEntry of every deb -serve can fetch
+        self.filling = {} # Filename -> Future of a -serve fetch in progress
+        self.indexLock = threading.Lock() # held while -serve reads or swaps its index of debs
+        self.refreshLock = threading.Lock() # held while -serve re-reads the Package files
+        self.journal = None # Journal of the files put in place by this run
+        self.manifest = None # Manifest of the changes this run makes to the mirror
+        self.tempDir = None # TemporaryDirectory made by skeletonCheck()
+        self.trace = Trace(self.trace_file) # timing of the HTTP requests made
+        self.opener = None # tracedOpener() the HTTP requests are made with, once one is
+        self.resumed = {} # path -> md5sum of the files put in place by an interrupted run
         self.cnt = 0
 
     cfgFile="RM.cfg"
     repository = 'http://web/security.debian.org'
+    upstreams = None # equivalent repositories to spread fetches over
     distributions = 'wheezy/updates squeeze/updates jessie/updates'.split()
     components = 'main contrib non-free'.split()
     architectures = 'amd64 all'.split()
     tdir = 'tmp' # temporary directory prefix
     lmirror = os.path.basename(repository)
     pkgLists = None # By default will mirror *all* deb packages
+    closure = set() # distributions whose package lists include dependencies
+    keep_versions = {} # distribution -> number of versions of each package to mirror
+    workers = 4 # concurrent fetches / Package file readers
+    STATUS = '.status.json' # snapshot of the last check
+    QUARANTINE = '.quarantine' # orphaned debs waiting to be deleted
+    LOCK = '.lock' # whole mirror lock held while Release and Package files are published
+    SNAPSHOTS = '.snapshots' # dists/<dist> are symlinks to snapshots of them in here
+    snapshots = False # stage refreshed Release and Package files and publish them at once
+    snapshot_keep = 24*3600 # seconds superseded snapshots are kept
+    prune_grace = 7*24*3600 # seconds orphaned debs are kept in quarantine
+    status_max_age = 24*3600 # seconds a status snapshot can be used for
+    scrub_period = 7*24*3600 # seconds in which every deb is re-verified by -scrub
+    scrub_rate = 0 # bytes/s -scrub may read, 0 => unlimited
+    engines = ('serial', 'threaded', 'async')
+    engine = 'serial' # how missing .deb files are fetched
+    shard = None # (i, N) - fetch shard i of the work shared by N cooperating processes
+    SERVE_RECHECK = 60 # seconds between -serve checks for newly published Release files
+    access_logs = [] # web server access logs of the mirror read for package popularity
+    popularity_half_life = 7*24*3600 # seconds in which a request's weight halves
+    delta_source = None # URL of a debdelta archive to fetch deltas from old to new debs
+    debpatch = 'debpatch' # command to rebuild a deb from an old one and a delta
+    manifests = False # write a manifest of each run's changes for downstream mirrors
+    manifest_keep = 7*24*3600 # seconds manifests are kept
+    trace_file = None # JSON lines file the timing of every HTTP request is appended to
 
     def dump_info(self):
         '''Print details of the configuration'''
         print(self)
-        self.skeletonCheck(False)
+        self.skeletonCheck(False, state=False)
 
     def config(cf=cfgFile):
-        ''' Set up configuration - optionally read from RM.cfg'''
-        if not os.access(RepositoryMirror.cfgFile, os.R_OK):
-            return
-
-        cfg = ConfigParser()
-        cfg.read(RepositoryMirror.cfgFile)
-        setup = cfg['setup']
-        RepositoryMirror.repository = setup.get('repository', RepositoryMirror.repository)
-        d = setup.get('distributions', None)
-        if d:
-            RepositoryMirror.distributions = d.split()
-        d = setup.get('components', None)
-        if d:
-            RepositoryMirror.components = d.split()
-        d = setup.get('architectures', None)
-        if d:
-            RepositoryMirror.architectures = d.split()
-        RepositoryMirror.tdir = setup.get('tdir', RepositoryMirror.tdir)
-        RepositoryMirror.lmirror = setup.get('lmirror', RepositoryMirror.lmirror)
-        pL = {}
-        for d in RepositoryMirror.distributions:
-            print("Checking distribution '", d, " : 'packages-'" + d, "'", sep='')
-            pkglist = setup.get('packages-' + d, None)
-            print("pkglist for ", d, "is", pkglist)
-            if pkglist:
-                pL[d] = pkglist
-        if len(pL) > 0:
-            RepositoryMirror.pkgLists = pL
+        ''' Set up configuration of the whole process - optionally read from RM.cfg'''
+        Options.read(RepositoryMirror.cfgFile).apply()
 
     def parsePkgLists(self, pkgLists):
         '''
@@ -179,39 +1290,40 @@ Dictionaries:
     which will have all the packages that have been installed on the current debian box:
        awk '/^Package: / { print $2; }' /var/lib/dpkg/status > pkg-list
         '''
-        global args
-
         self.pkgLists = pkgLists
         for k in pkgLists:
             pf = pkgLists[k]
             if not os.access(pf, os.R_OK):
-                print("Unable to read package file: ", pf)
-                sys.exit(1)
+                raise MirrorError("Unable to read package file: %s" % pf)
             fp = open(pf, 'rt')
             pkg_names = set()
             for l in fp:
                 for p in l.split():
                     pkg_names.add(p)
             fp.close()
-            if args.verbose:
+            if self.options.verbose:
                 print("Read %d names from %s package list %s" %
                     (len(pkg_names), k, pf))
             self.debList[k] = pkg_names
 
 
+    def distDir(self, dist):
+        ''' Return the directory the files of distribution dist are put in - its snapshot being staged if any '''
+        return self.staging.get(dist) or os.path.join(self.lmirror, 'dists', dist)
+
     def getPackagePath(self, dist, pkg):
         ''' Return a Package path for the given distribution/component/architecture'''
 
         #print("getPackagePath(%s, %s, %s, %s, %s, %s)" % (self.lmirror, 'dists', dist, comp, 'binary-'
         #    + arch,  'Packages.bz2'))
         #p = os.path.join(self.lmirror, 'dists', dist, comp, 'binary-' + arch,  'Packages.bz2')
-        p = os.path.join(self.lmirror, 'dists', dist, pkg.name)
+        p = os.path.join(self.distDir(dist), pkg.name)
         return p
 
     def getReleasePath(self, dist=distributions[0], file_name='Release'):
         ''' Return a Release file path for the given distribution'''
 
-        p = os.path.join(self.lmirror, 'dists', dist, file_name)
+        p = os.path.join(self.distDir(dist), file_name)
         return p
 
     def getReleaseURL(self, dist=distributions[0], file_name='Release'):
@@ -221,10 +1333,14 @@ Dictionaries:
         return url
 
     def mkCacheFile(self, dist, fname):
-        ''' Return a Cache file for a given distribution file '''
-
-        rURL = self.getReleaseURL(dist, fname)
-        cfile = CacheFile(rURL, self.getReleasePath(dist, fname))
+        ''' Return the Cache file for a given distribution file
+        The same CacheFile is returned for each request so it is only fetched once '''
+
+        cfile = self.cfiles.get((dist, fname))
+        if cfile == None:
+            rURL = self.getReleaseURL(dist, fname)
+            cfile = CacheFile(rURL, self.getReleasePath(dist, fname), mirror=self)
+            self.cfiles[(dist, fname)] = cfile
         return cfile
 
     def getDebPath(self, filename):
@@ -240,6 +1356,73 @@ Dictionaries:
         url = self.repo + '/dists/' + dist + '/' + pkg.name
         return url
 
+    def getByHashURL(self, dist, pkg):
+        ''' Return the by-hash URL of a Package file with a SHA256 in its Release '''
+        return '%s/dists/%s/%s/by-hash/SHA256/%s' % (self.repo, dist,
+            os.path.dirname(pkg.name), pkg.sha256)
+
+    def fetchIndex(self, rel, pkg):
+        '''
+        Fetch the Package (or other index) file pkg of Release rel into its CacheFile.
+        If the Release has Acquire-By-Hash it is fetched by its SHA256 from by-hash/, which
+        cannot have changed since the Release was fetched, falling back to its name.
+        '''
+        cfile = pkg.cfile
+        if rel.byHash and pkg.sha256:
+            url = cfile.url
+            cfile.url = self.getByHashURL(rel.name, pkg)
+            ok = cfile.fetch()
+            cfile.url = url
+            if ok:
+                return True
+            print("Unable to fetch %s by-hash - fetching %s" % (pkg.name, url))
+            cfile.fetched = None
+        return cfile.fetch()
+
+    def updateIndex(self, rel, pkg):
+        '''
+        Move the fetched index file pkg of Release rel into place and publish it by-hash.
+        Returns the result of CacheFile.update()
+        '''
+        old = statSignature(pkg.cfile.ofile)
+        if not pkg.cfile.update():
+            return False
+        self.publishByHash(rel, pkg, old[2] if old else None)
+        return True
+
+    def publishByHash(self, rel, pkg, superseded=None):
+        '''
+        If Release rel has Acquire-By-Hash, hard link index file pkg as by-hash/SHA256/<sha256>
+        beside it as upstream does. by-hash files of older versions are kept for clients
+        with an older Release until snapshot_keep seconds after they were superseded -
+        the one with inode superseded has just been replaced.
+        '''
+        if not rel.byHash or not pkg.sha256 or self.options.dry_run or self.options.plan:
+            return
+        path = pkg.cfile.ofile
+        hdir = os.path.join(os.path.dirname(path), 'by-hash', 'SHA256')
+        try:
+            os.makedirs(hdir, exist_ok=True)
+            hpath = os.path.join(hdir, pkg.sha256)
+            if not os.path.exists(hpath):
+                os.link(path, hpath)
+                if self.manifest:
+                    self.manifest.put(hpath, False)
+            now = time.time()
+            for name in os.listdir(hdir):
+                if name == pkg.sha256:
+                    continue
+                old = os.path.join(hdir, name)
+                st = os.lstat(old)
+                if st.st_ino == superseded:
+                    os.utime(old, (now, now))
+                elif now - st.st_mtime >= self.snapshot_keep:
+                    os.unlink(old)
+                    if self.manifest:
+                        self.manifest.remove(old)
+        except OSError as e:
+            print("Unable to publish %s by-hash: %s" % (path, e))
+
     def getDebURL(self, filename):
         ''' Return a Debian Package URL for the Filename'''
 
@@ -251,20 +1434,17 @@ Dictionaries:
         Check the Release Entry file pname on the local mirror
         '''
         pkg = rel.otherFiles[pname]
-        if verbose:
+        if self.options.verbose:
             print('checkRelEntryFile(rel=%s comp=%s arch=%s size=%s, md5sum=%s)'
                 % (rel.name, pkg.comp, pkg.arch, pkg.size, pkg.md5sum))
         path = self.getPackagePath(rel.name, pkg)
         url = self.getPackageURL(rel.name, pkg)
-        pkg.cfile = cfile = CacheFile(url, ofile=path)
-        if check_md5sum:
-            md5sum = pkg.md5sum
-        else:
-            md5sum = None
+        pkg.cfile = cfile = CacheFile(url, ofile=path, mirror=self)
+        md5sum = pkg.md5sum
         if not cfile.check(size=pkg.size, md5sum=md5sum):
             if update:
                 try:
-                    cfile.fetch()
+                    self.fetchIndex(rel, pkg)
                     pfile = cfile.tfile
                     pkg.modified = True
                     pkg.missing = False
@@ -273,15 +1453,17 @@ Dictionaries:
             else:
                 pkg.missing = True
         else:
-            if verbose:
+            if self.options.verbose:
                 print("checkRelEntryFile(path=%s url=%s) - ok" % (path, url))
             pfile = cfile.ofile
             pkg.modified = False
             pkg.missing = False
+            if update:
+                self.publishByHash(rel, pkg)
 
         if pkg.missing:
             print(' Warning: %s - Release Entry file %s missing' % (rel.name, pname))
-            if verbose:
+            if self.options.verbose:
                 print("Release entry file (path=%s url=%s) - missing" % (path, url))
         return pkg
 
@@ -291,26 +1473,23 @@ Dictionaries:
         '''
 
         pkg = rel.pkgFiles[pname]
-        if verbose:
+        if self.options.verbose:
             print('checkPackage(rel=%s comp=%s arch=%s size=%s, md5sum=%s)'
                 % (rel.name, pkg.comp, pkg.arch, pkg.size, pkg.md5sum))
         path = self.getPackagePath(rel.name, pkg)
         url = self.getPackageURL(rel.name, pkg)
-        pkg.cfile = cfile = CacheFile(url, ofile=path)
-        if check_md5sum:
-            md5sum = pkg.md5sum
-        else:
-            md5sum = None
+        pkg.cfile = cfile = CacheFile(url, ofile=path, mirror=self)
+        md5sum = pkg.md5sum
         if not cfile.check(size=pkg.size, md5sum=md5sum):
             if update:
                 try:
-                    cfile.fetch()
+                    self.fetchIndex(rel, pkg)
                     pfile = cfile.tfile
                     pkg.modified = True
-                    if checkFile(pfile, size=pkg.size, md5sum=md5sum):
+                    if cfile.verify(size=pkg.size, md5sum=md5sum):
                         pkg.missing = False
-                        cfile.update()
-                        pfile = cfile.ofile
+                        self.updateIndex(rel, pkg)
+                        pfile = cfile.tfile if self.options.plan else cfile.ofile
                     else:
                         print("Updated Package file %s doesn't match" % pkg.name)
                         pkg.missing = True
@@ -319,23 +1498,71 @@ Dictionaries:
             else:
                 pkg.missing = True
         else:
-            if verbose:
+            if self.options.verbose:
                 print("checkPackage(path=%s url=%s) - ok" % (path, url))
             pfile = cfile.ofile
             pkg.modified = False
             pkg.missing = False
+            if update:
+                self.publishByHash(rel, pkg)
 
         if pkg.missing:
             print(' Warning: %s - package file %s missing' % (rel.name, pname))
-            if verbose:
+            if self.options.verbose:
                 print("package file (path=%s url=%s) - missing" % (path, url))
             return pkg
-        if verbose:
-            print("processing Package file %s" % pfile)
-        pkg.rdPkgFile(pfile)
+        pkg.pfile = pfile
         return pkg
 
-    def skeletonCheck(self, create=False):
+    def readPackages(self, pkgs):
+        '''
+        Read in the .deb entries of all the given (present) PkgFile's
+        Decompressing and parsing is done in parallel by a pool of processes - started by
+        a fork server (or spawned) rather than forked, as forking a process running other
+        threads (-serve, library callers) may copy a lock some thread holds
+        '''
+        import concurrent.futures, multiprocessing
+        if self.workers <= 1 or len(pkgs) <= 1:
+            entries = [readPkgIndex(pkg.pfile, pkg.ctype) for pkg in pkgs]
+        else:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            with concurrent.futures.ProcessPoolExecutor(min(self.workers, len(pkgs)),
+                    mp_context=multiprocessing.get_context(method)) as ex:
+                entries = list(ex.map(readPkgIndex,
+                    [pkg.pfile for pkg in pkgs], [pkg.ctype for pkg in pkgs]))
+        for r in self.relfiles.values():
+            if r.deblist != None and r.name in self.closure:
+                self.closeDebList(r, [x for pkg, e in zip(pkgs, entries)
+                    if pkg.relfile is r for x in e])
+        for pkg, e in zip(pkgs, entries):
+            if self.options.verbose:
+                print("processing Package file %s" % pkg.pfile)
+            if self.db and not self.options.plan:
+                self.db.setRefs(pkg.relfile.name, pkg, e, self.livePath(pkg.cfile.ofile))
+            keep = self.keep_versions.get(pkg.relfile.name)
+            if keep:
+                n = len(e)
+                e = newestVersions(e, keep)
+                if n > len(e):
+                    print("%s: keeping newest %d versions - skipping %d older debs" %
+                        (pkg.name, keep, n - len(e)))
+            pkg.rdPkgFile(pkg.pfile, e)
+
+    def closeDebList(self, rel, entries):
+        '''
+        Extend the package list of Release rel with all the packages its packages depend on
+        (Pre-Depends, Depends and Recommends) in its Package files entries
+        '''
+        listed = rel.deblist
+        rel.deblist = depClosure(listed, entries)
+        extra = rel.deblist - listed
+        size = sum(int(e[3]) for e in entries if e[0] in extra)
+        print("%s: dependencies add %d packages %d bytes to the %d listed" %
+            (rel.name, len(extra), size, len(listed)))
+        if self.options.verbose:
+            print(" " + " ".join(sorted(extra)))
+
+    def skeletonCheck(self, create=False, state=True):
         '''Checks the mirror skeleton directores are present and possibly create them
         If not present and create=True it will attempt to create the directories
         It returns false if not present and create=False. If create=True it attempts to create them
@@ -344,10 +1571,13 @@ Dictionaries:
             repro/dists/<dist>/ - for each <dist> defined.
 
             Creates tempdir - used for temporary/cache files
-            Sets CacheFile.tdir - used as prefix for all CacheFile creations
+            Sets self.tdir - used as prefix for all the mirror's CacheFile creations
+            state - open the mirror database and journal (replaying an interrupted run's),
+                    False for read only commands such as -info which must not create them.
+                    -plan opens the database readonly, if there is one, but not the journal.
         '''
-        v, n, nn = verbose, dry_run, very_dry_run
-        if nn: n = True
+        import tempfile
+        v, n, nn = self.options.verbose, self.options.dry_run, self.options.very_dry_run
 
         if create == False:
             if v:
@@ -359,7 +1589,7 @@ Dictionaries:
             for d in self.dists:
                 dpath = os.path.join(self.lmirror, 'dists', d)
                 if os.path.isdir(dpath) == False:
-                    if verbose:
+                    if self.options.verbose:
                         print(("Missing mirror release directory: %s\n" +
                             " - use -create to force it's creation") % dpath)
                     return False
@@ -380,13 +1610,13 @@ Dictionaries:
                         return False
 
         try:
-            tdir = os.path.join(self.lmirror, RepositoryMirror.tdir + 'XXXX')
+            tdir = os.path.join(self.lmirror, self.tprefix + 'XXXX')
             if nn:
                 print("mkdirs %s" % tdir)
                 self.tdir = tdir
             else:
                 self.tempDir = tempfile.TemporaryDirectory(
-                            prefix=RepositoryMirror.tdir,
+                            prefix=self.tprefix,
                             dir=self.lmirror)
                 self.tdir = self.tempDir.name
         except OSError:
@@ -394,7 +1624,26 @@ Dictionaries:
             return False
 
         if v: print("Created Temporary Directory %s" % self.tdir)
-        CacheFile.tdir = self.tdir
+
+        if state and not nn and os.path.isdir(self.lmirror) and not (self.options.plan and
+                not os.path.exists(os.path.join(self.lmirror, MirrorDB.NAME))):
+            try:
+                self.db = MirrorDB(self.lmirror, readonly=self.options.plan)
+            except sqlite3.Error as e:
+                print("Unable to open mirror database in %s: %s" % (self.lmirror, e))
+                return False
+        if state and not n and not self.options.plan and os.path.isdir(self.lmirror):
+            if self.manifests:
+                self.manifest = Manifest(self.lmirror, self.manifest_keep)
+            self.journal = Journal(self.lmirror)
+            self.resumed = self.journal.replay()
+            if self.resumed:
+                print("Resuming an interrupted run - %d files it put in place are unchanged"
+                    % len(self.resumed))
+                for path, md5sum in self.resumed.items():
+                    path = os.path.join(self.lmirror, path)
+                    if md5sum and self.db and not self.db.verified(path, md5sum=md5sum):
+                        self.db.recordFile(path, md5sum)
 
         return True
 
@@ -404,80 +1653,603 @@ Update Mirror's State by reading repository's state
 Loops through the distributions specified and computes change_dists list
 of distribution and releaseCacheFile lists. If update is true will refresh
 the Mirror's release details from the source repository
+Returns a MirrorState of what was found - true if the mirror needs updating
         '''
-        global args
+        import concurrent.futures
         cnt = 0 # no. of changed files
         missing = 0 # missing bytes of files
+        state = MirrorState()
         self.missing = False
 
         if update == False:
             print('Not refreshing info from original repository')
+        else:
+            if len(self.upstreams.urls) > 1:
+                self.repo = self.upstreams.probe(
+                    'dists/' + self.dists[0] + '/Release')
+                print('Using upstream %s for Release and Package files' % self.repo)
+                if self.options.verbose:
+                    print(self.upstreams, end='')
+            if self.snapshots and not self.options.dry_run and not self.options.plan:
+                self.stageDists()
+            # All variants of every Release file are fetched together
+            fetchAll([self.mkCacheFile(d, f) for d in self.dists
+                for f in ('Release.gpg', 'InRelease', 'Release')], self.workers)
         for d in self.dists:
-            if args.verbose:
+            if self.options.verbose:
                 print('Checking Release %s' % d)
             relfile = self.checkRelease(d, update)
             if not relfile.present:
                 print(' Warning: %s - Release file missing' % d)
                 self.missing = True;
+                state.failed += 1
             elif relfile.changed:
-                if args.verbose:
+                if self.options.verbose:
                     print('%s - Release file changed ' % d)
                 self.changed_dists.append([d, relfile.cfile])
                 self.updated = True
+                state.changed += 1
             else:
-                if args.verbose:
+                if self.options.verbose:
                     print('%s - Release file unchanged ' % d)
 
+        # Check and fetch all the index files of all the releases concurrently
+        jobs = []
+        for r in self.relfiles.values():
+            if r.present:
+                jobs += [(self.checkPackage, r, p) for p in r.pkgFiles]
+                jobs += [(self.checkRelEntryFile, r, o) for o in r.otherFiles]
+        if self.workers <= 1 or len(jobs) <= 1:
+            for fn, r, p in jobs:
+                fn(r, p, update)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(self.workers) as ex:
+                for f in [ex.submit(fn, r, p, update) for fn, r, p in jobs]:
+                    f.result()
+        self.readPackages([pkg for r in self.relfiles.values() if r.present
+            for pkg in r.pkgFiles.values() if not pkg.missing])
+
         for r in self.relfiles.values():
             if not r.present:
                 print('Skipping Release %s as Release file %s is missing' % (r.name, r.cfile.ofile))
                 continue
-            if args.verbose:
+            if self.options.verbose:
                 print('Examining release file %s (%s)' % (r.name, r.cfile.ofile))
             for p in r.pkgFiles:
-                if args.verbose:
+                if self.options.verbose:
                     print('Examining pkg file %s ' % (p))
-                pkg = self.checkPackage(r, p, update)
+                pkg = r.pkgFiles[p]
                 if pkg.missing:
                     self.updated = True
                     self.missing = True
+                    state.failed += 1
                     cnt += 1
                     continue
                 if update and pkg.modified:
                     self.updated = True
-                    pkg.cfile.update()
+                    state.changed += 1
                 if pkg.total_missing > 0:
                     self.updated = True
                     missing += pkg.total_missing
+                state.missing += pkg.cnt
                 cnt += pkg.cnt
                 print('Package %s - cnt %d missing %d' % (pkg.name, pkg.cnt, pkg.total_missing))
             for o in r.otherFiles:
-                if args.verbose:
+                if self.options.verbose:
                     print('Examining other file %s ' % (o))
-                pkg = self.checkRelEntryFile(r, o, update)
+                pkg = r.otherFiles[o]
                 if pkg.missing:
                     self.updated = True
                     self.missing = True
+                    state.failed += 1
                     cnt += 1
                     continue
                 if update and pkg.modified:
                     self.updated = True
-                    pkg.cfile.update()
+                    state.changed += 1
+                    self.updateIndex(r, pkg)
                     print('Updating File %s' % (pkg.name ))
                 #if pkg.total_missing > 0:
                 #    self.updated = True
                 #    missing += pkg.total_missing
                 #cnt += pkg.cnt
                 #print('Other File %s - needs updating' % (pkg.name ))
-            if args.verbose:
+            if self.options.verbose:
                 print('Release %s - total %d' % (r.name, len(r.pkgFiles)))
             r.cnt = cnt
             self.cnt += cnt
             cnt = 0
 
-        if args.verbose:
+        if self.options.verbose:
             print('%d changed files - %d bytes missing for downloading' % (self.cnt, missing))
-        return self.updated
+        state.updated, state.missing_bytes = self.updated, missing
+        return state
+
+    def snapshotDir(self, dist):
+        ''' Return the directory holding the snapshots of distribution dist '''
+        return os.path.join(self.lmirror, RepositoryMirror.SNAPSHOTS, dist.replace('/', '_'))
+
+    def switchDist(self, dist, snapshot):
+        ''' Atomically point the dists/<dist> symlink at directory snapshot '''
+        live = os.path.join(self.lmirror, 'dists', dist)
+        tmp = '%s.%d.new' % (live, os.getpid())
+        os.symlink(os.path.relpath(snapshot, os.path.dirname(live)), tmp)
+        os.rename(tmp, live)
+
+    def stageDists(self):
+        '''
+        Start a new snapshot of each distribution for checkState() to refresh its Release
+        and Package files in. It is a hard linked copy of the published one - the files are
+        only ever replaced by rename so they can be shared. A distribution whose dists/<dist>
+        is still a directory is moved into the first snapshot. The snapshot an interrupted
+        run was staging is carried on with instead, unless a newer one has been published.
+        '''
+        stamp = time.strftime('%Y%m%d-%H%M%S') + '-%d' % os.getpid()
+        for d in self.dists:
+            live = os.path.join(self.lmirror, 'dists', d)
+            stage = self.resumableStage(d)
+            if stage:
+                print("Resuming %s snapshot %s of an interrupted run" % (d, os.path.basename(stage)))
+                self.staging[d] = stage
+                continue
+            os.makedirs(self.snapshotDir(d), exist_ok=True)
+            stage = self.newSnapshot(d, stamp)
+            if os.path.isdir(live) and not os.path.islink(live):
+                shutil.copytree(live, stage, symlinks=True, copy_function=os.link)
+                os.rename(live, live + '.old')
+                self.switchDist(d, stage)
+                shutil.rmtree(live + '.old')
+                print("Moved %s into snapshot %s" % (live, stage))
+                stage = self.newSnapshot(d, stamp)
+            if os.path.isdir(live):
+                shutil.copytree(live, stage, symlinks=True, copy_function=os.link)
+            else:
+                os.makedirs(stage)
+            self.staging[d] = stage
+            self.created.add(stage)
+
+    def newSnapshot(self, dist, stamp):
+        ''' Return the path of a snapshot of dist named after stamp that does not exist yet '''
+        stage = os.path.join(self.snapshotDir(dist), stamp)
+        n = 0
+        while os.path.lexists(stage):
+            n += 1
+            stage = os.path.join(self.snapshotDir(dist), '%s.%d' % (stamp, n))
+        return stage
+
+    def resumableStage(self, dist):
+        '''
+        Return the newest snapshot of dist that the journal shows an interrupted run was
+        staging, if it is newer than the published one, else None
+        '''
+        sdir = os.path.relpath(self.snapshotDir(dist), self.lmirror) + os.sep
+        names = set(path[len(sdir):].split(os.sep)[0] for path in self.resumed
+            if path.startswith(sdir))
+        live = os.path.join(self.lmirror, 'dists', dist)
+        current = os.path.basename(os.path.realpath(live)) if os.path.islink(live) else ''
+        names = [n for n in names if n > current and
+            os.path.isdir(os.path.join(self.snapshotDir(dist), n))]
+        return os.path.join(self.snapshotDir(dist), max(names)) if names else None
+
+    def discardStaged(self):
+        '''
+        Remove the snapshots this run started staging which have no changes - their files
+        are the published ones. The others are left for resumableStage() to carry on with.
+        '''
+        for d in [d for d in self.staging if self.staging[d] in self.created and
+                not self.stagedChanges(d)]:
+            stage = self.staging.pop(d)
+            shutil.rmtree(stage, ignore_errors=True)
+            r = self.relfiles.get(d)
+            if r == None:
+                continue
+            live = os.path.join(self.lmirror, 'dists', d)
+            for cf in [r.sig, getattr(r, 'cfile', None)] + [getattr(pkg, 'cfile', None)
+                    for pkg in list(r.pkgFiles.values()) + list(r.otherFiles.values())]:
+                if cf and cf.ofile.startswith(stage + os.sep):
+                    cf.ofile = os.path.join(live, os.path.relpath(cf.ofile, stage))
+            if r.rfile.startswith(stage + os.sep):
+                r.rfile = os.path.join(live, os.path.relpath(r.rfile, stage))
+
+    def stagedChanges(self, dist):
+        '''
+        Return True if checkState() changed any of dist's files in its staged snapshot, or
+        the snapshot resumed from an interrupted run has a different Release file
+        '''
+        r = self.relfiles.get(dist)
+        if r == None:
+            return False
+        live = os.path.join(self.lmirror, 'dists', dist)
+        return r.changed or any(statSignature(os.path.join(self.staging[dist], f)) !=
+            statSignature(os.path.join(live, f)) for f in ('Release', 'InRelease')) or \
+            any(getattr(f, 'modified', False)
+                for f in list(r.pkgFiles.values()) + list(r.otherFiles.values()))
+
+    def publishDists(self, changed_only=False, lazy=False):
+        '''
+        Publish each staged snapshot whose Release file is present and whose Package files
+        are all present with every deb they list in the pool, by switching dists/<dist> to
+        it. Unchanged ones this run started are discarded. changed_only => only discard them.
+        lazy => the debs need not be in the pool as -serve fetches them when requested.
+        Superseded snapshots older than snapshot_keep are removed.
+        Returns True if none was left unpublished.
+        '''
+        self.discardStaged()
+        if changed_only:
+            return True
+        ok = True
+        for d in list(self.staging):
+            r = self.relfiles[d]
+            missing = [pkg.name for pkg in r.pkgFiles.values() if pkg.missing]
+            if r.present and not missing and not lazy:
+                missing = [fn for pkg in r.pkgFiles.values() for fn, deb in pkg.pkgs.items()
+                    if not checkFile(self.getDebPath(fn), size=int(deb.size),
+                        verbose=self.options.verbose)]
+            if not r.present or missing:
+                print("Not publishing %s - %d files missing - the next run carries on with it"
+                    % (d, len(missing)))
+                self.staging.pop(d) # left for resumableStage()
+                ok = False
+                continue
+            if r.sig and r.sig.tfile and os.path.exists(r.sig.tfile):
+                r.sig.update()
+            live = os.path.join(self.lmirror, 'dists', d)
+            old = os.path.realpath(live) if os.path.islink(live) else None
+            self.switchDist(d, self.staging[d])
+            if self.manifest:
+                self.manifest.compare(old, self.staging[d], os.path.join('dists', d))
+            if old:
+                os.utime(old) # superseded now
+            print("Published %s snapshot %s" % (d, os.path.basename(self.staging[d])))
+            self.published[d] = self.staging.pop(d)
+            self.expireSnapshots(d)
+        return ok
+
+    def expireSnapshots(self, dist):
+        ''' Remove the snapshots of dist superseded more than snapshot_keep seconds ago '''
+        live = os.path.realpath(os.path.join(self.lmirror, 'dists', dist))
+        sdir = self.snapshotDir(dist)
+        now = time.time()
+        for name in os.listdir(sdir):
+            path = os.path.join(sdir, name)
+            if path == live or path in self.staging.values():
+                continue
+            if now - os.lstat(path).st_mtime >= self.snapshot_keep:
+                if self.options.verbose:
+                    print("Removing %s snapshot %s" % (dist, name))
+                shutil.rmtree(path, ignore_errors=True)
+
+    def livePath(self, path):
+        ''' Return path in a snapshot staged or published by this run as a path under dists/ '''
+        for d, snapshot in list(self.staging.items()) + list(self.published.items()):
+            if path.startswith(snapshot + os.sep):
+                return os.path.join(self.lmirror, 'dists', d, os.path.relpath(path, snapshot))
+        return path
+
+    def debsSignature(self, fnames):
+        ''' Return digest of the stat signatures of the debs with Filenames fnames '''
+        m = hashlib.md5()
+        for fn in fnames:
+            m.update(('%s %s\n' % (fn, statSignature(self.getDebPath(fn)))).encode())
+        return m.hexdigest()
+
+    def saveStatus(self):
+        '''
+        Write a snapshot of the state found by checkState() to <lmirror>/.status.json
+        For each distribution it has the stat signature of the Release file, and of each
+        Package/Translation file with its count/bytes of missing debs, the number of its debs
+        and a digest of their stat signatures. The Filenames are not repeated - the mirror
+        database has them. This lets quickStatus() repeat the answer by only stat'ing files.
+        '''
+        if self.options.dry_run or not os.path.isdir(self.lmirror):
+            return
+        dists = {}
+        for d, r in self.relfiles.items():
+            rfile = self.livePath(r.cfile.ofile)
+            rel = { 'release' : rfile, 'stat' : statSignature(rfile),
+                'present' : r.present, 'indices' : {} }
+            for name, pkg in list(r.pkgFiles.items()) + list(r.otherFiles.items()):
+                pfile = self.livePath(pkg.cfile.ofile)
+                e = { 'file' : pfile, 'stat' : statSignature(pfile),
+                    'missing' : pkg.missing }
+                if name in r.pkgFiles and not pkg.missing:
+                    missing = [d for d in pkg.pkgs.values() if d.missing]
+                    e['debs'] = len(pkg.pkgs)
+                    e['cnt'] = len(missing)
+                    e['bytes'] = sum(int(d.size) for d in missing)
+                    e['signature'] = self.debsSignature(sorted(pkg.pkgs))
+                rel['indices'][name] = e
+            dists[d] = rel
+        status = { 'time' : time.time(), 'repository' : self.repo,
+            'lmirror' : self.lmirror, 'dists' : dists }
+        path = os.path.join(self.lmirror, RepositoryMirror.STATUS)
+        try:
+            with open(path + '.new', 'w') as f:
+                json.dump(status, f)
+            os.rename(path + '.new', path)
+        except OSError as e:
+            print("Unable to save status snapshot %s: %s" % (path, e.strerror))
+
+    def quickStatus(self):
+        '''
+        Set the state of the mirror (updated, missing, cnt) from the snapshot saved by the
+        last run without reading any Release/Package files or debs.
+        The debs of each Package file are those the mirror database records it referencing.
+        Returns False if there is no snapshot or database, the snapshot is older than
+        status_max_age or any file it covers has changed since - then checkState() has to
+        be used.
+        '''
+        if self.db == None:
+            return False
+        path = os.path.join(self.lmirror, RepositoryMirror.STATUS)
+        try:
+            with open(path) as f:
+                status = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if time.time() - status['time'] > self.status_max_age \
+            or status['lmirror'] != self.lmirror or set(status['dists']) != set(self.dists):
+            return False
+
+        lines = []
+        updated, missing, cnt = False, False, 0
+        for d in self.dists:
+            rel = status['dists'][d]
+            if statSignature(rel['release']) != rel['stat']:
+                return False
+            if not rel['present']:
+                lines.append(' Warning: %s - Release file missing' % d)
+                missing = True
+                continue
+            for name, e in rel['indices'].items():
+                if statSignature(e['file']) != e['stat']:
+                    return False
+                if e['missing']:
+                    lines.append(' Warning: %s - file %s missing' % (d, name))
+                    updated = missing = True
+                    cnt += 1
+                    continue
+                if 'debs' not in e:
+                    continue
+                fnames = self.db.refPaths(e['file'])
+                if len(fnames) != e['debs'] or self.debsSignature(fnames) != e['signature']:
+                    return False
+                if e['cnt'] > 0:
+                    updated = True
+                cnt += e['cnt']
+                lines.append('Package %s - cnt %d missing %d' % (name, e['cnt'], e['bytes']))
+
+        print('Status from snapshot of %s' % time.ctime(status['time']))
+        for l in lines:
+            print(l)
+        self.updated, self.missing, self.cnt = updated, missing, cnt
+        return True
+
+    def liveDebs(self):
+        '''
+        Return set of the Filenames of all the debs the Package files read by this run list
+        plus those referenced, as recorded in the mirror database, by every other Package
+        file still in the mirror - those of other configurations sharing it, which may
+        mirror other components or architectures of the same distributions
+        '''
+        live = set()
+        read = set()
+        for r in self.relfiles.values():
+            for pkg in r.pkgFiles.values():
+                live.update(pkg.pkgs)
+                read.add(os.path.relpath(self.livePath(pkg.cfile.ofile), self.lmirror))
+        if self.db:
+            for idx, in self.db.query('SELECT idx FROM indices'):
+                if idx not in read and os.path.exists(os.path.join(self.lmirror, idx)):
+                    live.update(r[0] for r in self.db.query('SELECT path FROM refs WHERE idx = ?',
+                        (idx,)))
+        return live
+
+    def stagedDebs(self):
+        '''
+        Return set of the Filenames of the debs other runs are about to publish - those the
+        Package files of snapshots newer than the published one list, staged by a run still
+        going or an interrupted one. A run stages its Package files before it fetches the
+        debs they list, so these include every deb it has fetched.
+        '''
+        staged = set()
+        for d, r in self.relfiles.items():
+            sdir = self.snapshotDir(d)
+            live = os.path.join(self.lmirror, 'dists', d)
+            if not os.path.islink(live) or not os.path.isdir(sdir):
+                continue
+            current = os.path.basename(os.path.realpath(live))
+            for name in os.listdir(sdir):
+                if name <= current:
+                    continue
+                for pkg in r.pkgFiles.values():
+                    path = os.path.join(sdir, name, pkg.name)
+                    if not os.path.exists(path) or \
+                            statSignature(path) == statSignature(os.path.join(live, pkg.name)):
+                        continue # hard linked from the published one
+                    try:
+                        staged.update(e[1] for e in readPkgIndex(path, pkg.ctype))
+                    except (OSError, EOFError, ValueError) as e:
+                        print("Unable to read staged %s: %s" % (path, e))
+        return staged
+
+    def prune(self, grace=None):
+        '''
+        Remove orphaned debs - files under pool/ which no Package file of the mirror uses.
+        Needs checkState() to have read every Package file - refuses if any is missing,
+        if a configured component/architecture has none or if nothing in the pool is used.
+        Debs other runs have staged to publish (stagedDebs()) are in use too.
+        A single walk of pool/ finds the orphans without reading them. They are moved into
+        <lmirror>/.quarantine and deleted once they have been there grace seconds
+        (default prune_grace, 0 => delete at once). A quarantined deb that is used again
+        is moved back. Returns (number, bytes) of files deleted.
+        '''
+        if grace == None:
+            grace = self.prune_grace
+        if self.missing or not all(r.present for r in self.relfiles.values()):
+            print("Not pruning %s - Release or Package files are missing" % self.lmirror)
+            return (0, 0)
+        for r in self.relfiles.values():
+            found = set((pkg.comp, pkg.arch) for pkg in r.pkgFiles.values())
+            none = [c + '/' + a for c in self.comps for a in self.archs if (c, a) not in found]
+            if none:
+                print("Not pruning %s - %s has no Package files for %s" %
+                    (self.lmirror, r.name, ' '.join(none)))
+                return (0, 0)
+        live = self.liveDebs()
+        pool = os.path.join(self.lmirror, 'pool')
+        staged = self.stagedDebs()
+        if not live and any(files for top, dirs, files in os.walk(pool)):
+            print("Not pruning %s - no Package file lists any of the debs in its pool" % self.lmirror)
+            return (0, 0)
+        qdir = os.path.join(self.lmirror, RepositoryMirror.QUARANTINE)
+        nmoved = nfreed = freed = 0
+        for top, dirs, files in os.walk(pool):
+            for f in files:
+                path = os.path.join(top, f)
+                fn = os.path.relpath(path, self.lmirror)
+                if fn in live or fn in staged:
+                    continue
+                size = os.lstat(path).st_size
+                if grace > 0:
+                    if self.options.verbose or self.options.dry_run:
+                        print("quarantine %s" % fn)
+                    if not self.options.dry_run:
+                        qpath = os.path.join(qdir, fn)
+                        os.makedirs(os.path.dirname(qpath), exist_ok=True)
+                        os.rename(path, qpath)
+                        os.utime(qpath) # start of grace period
+                    nmoved += 1
+                else:
+                    if self.options.verbose or self.options.dry_run:
+                        print("rm %s" % fn)
+                    if not self.options.dry_run:
+                        os.unlink(path)
+                    nfreed += 1
+                    freed += size
+                if self.db and not self.options.dry_run:
+                    self.db.forget(path)
+                if self.manifest and not self.options.dry_run:
+                    self.manifest.remove(path)
+
+        now = time.time()
+        for top, dirs, files in os.walk(qdir):
+            for f in files:
+                qpath = os.path.join(top, f)
+                fn = os.path.relpath(qpath, qdir)
+                path = os.path.join(self.lmirror, fn)
+                st = os.lstat(qpath)
+                if (fn in live or fn in staged) and not os.path.exists(path):
+                    print("Restoring %s from quarantine" % fn)
+                    if not self.options.dry_run:
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                        os.rename(qpath, path)
+                        if self.manifest:
+                            self.manifest.put(path, False)
+                elif now - st.st_mtime >= grace:
+                    if self.options.verbose or self.options.dry_run:
+                        print("rm %s" % qpath)
+                    if not self.options.dry_run:
+                        os.unlink(qpath)
+                    nfreed += 1
+                    freed += st.st_size
+
+        print("Pruned %s: %d orphaned debs quarantined, %d files deleted - %d bytes reclaimed" %
+            (self.lmirror, nmoved, nfreed, freed))
+        return (nfreed, freed)
+
+    def scrub(self, timeout=0., period=None, rate=None):
+        '''
+        Re-read the debs the mirror holds and check them against the md5sums in their
+        Package files, a slice per run so that each is verified once every period seconds
+        (default scrub_period). The slice is the share of the mirror's bytes for the time
+        since the last scrub (all of it the first time), least recently verified first,
+        so a run resumes where the last one stopped. Reads at most rate bytes/s (default
+        scrub_rate, 0 => unlimited) in a thread at idle I/O priority and stops at timeout.
+        A corrupt deb is moved into <lmirror>/.quarantine/corrupt and marked missing so
+        it is fetched again. Needs checkState() to have read the Package files.
+        Returns (files, bytes, corrupt).
+        '''
+        import concurrent.futures
+        if period == None:
+            period = self.scrub_period
+        if rate == None:
+            rate = self.scrub_rate
+        if not self.db:
+            print("Not scrubbing %s - no mirror database" % self.lmirror)
+            return (0, 0, 0)
+        held = {}
+        for r in self.relfiles.values():
+            for pkg in r.pkgFiles.values():
+                if not pkg.missing:
+                    held.update((fn, (d, pkg)) for fn, d in pkg.pkgs.items()
+                        if not d.missing and self.inShard(fn))
+        verified = {path: (md5sum, when) for path, md5sum, when in
+            self.db.query('SELECT path, md5sum, verified FROM files WHERE md5sum IS NOT NULL')}
+        def lastVerified(fn):
+            v = verified.get(fn)
+            return v[1] if v and v[0] == held[fn][0].md5sum else 0.
+        now = time.time()
+        last = self.db.query('SELECT max(time) FROM scrubs')[0][0]
+        total = sum(int(d.size) for d, pkg in held.values())
+        budget = total if last == None else total*(now - last)/period
+        due = sorted((fn for fn in held if lastVerified(fn) < now - period), key=lastVerified)
+        print("Scrubbing %s: %d of %d debs due - up to %d of %d bytes%s" % (self.lmirror,
+            len(due), len(held), budget, total, (" at %d bytes/s" % rate) if rate else ""))
+
+        def scrubAll():
+            idleIO()
+            throttle = Throttle(rate)
+            nfiles = nbytes = 0
+            corrupt = []
+            for fn in due:
+                if nbytes >= budget or (timeout and gettime() >= timeout):
+                    break
+                d, pkg = held[fn]
+                path = self.getDebPath(fn)
+                m = hashlib.md5()
+                try:
+                    with open(path, 'rb') as f:
+                        for b in iter(lambda: f.read(CacheFile.SEGBUFSIZE), b''):
+                            m.update(b)
+                            throttle.wait(len(b))
+                except OSError as e:
+                    print("Unable to read %s: %s" % (path, e))
+                    continue
+                nfiles += 1
+                nbytes += int(d.size)
+                if m.hexdigest() == d.md5sum and os.path.getsize(path) == int(d.size):
+                    self.db.recordFile(path, d.md5sum)
+                else:
+                    corrupt.append(fn)
+            return nfiles, nbytes, corrupt
+
+        with concurrent.futures.ThreadPoolExecutor(1) as ex:
+            nfiles, nbytes, corrupt = ex.submit(scrubAll).result()
+
+        for fn in corrupt:
+            d, pkg = held[fn]
+            path = self.getDebPath(fn)
+            print("%s is corrupt - does not match md5sum %s" % (fn, d.md5sum))
+            if not self.options.dry_run:
+                qpath = os.path.join(self.lmirror, RepositoryMirror.QUARANTINE, 'corrupt', fn)
+                os.makedirs(os.path.dirname(qpath), exist_ok=True)
+                os.rename(path, qpath)
+                os.utime(qpath)
+                self.db.forget(path)
+                if self.manifest:
+                    self.manifest.remove(path)
+            d.missing = True
+            d.cfile = CacheFile(self.getDebURL(fn), ofile=path, upstreams=self.upstreams,
+                path=fn, size=int(d.size), mirror=self)
+            pkg.cnt += 1
+            pkg.total_missing += int(d.size)
+            self.updated = True
+            self.cnt += 1
+        if not self.options.dry_run:
+            self.db.recordScrub(nfiles, nbytes, len(corrupt))
+        print("Scrubbed %d debs %d bytes - %d corrupt" % (nfiles, nbytes, len(corrupt)))
+        return (nfiles, nbytes, len(corrupt))
 
     def checkRelease(self, dist, update):
         ''' Read given Release file and return Release object
@@ -490,9 +2262,7 @@ Returns:
     if not present uses InRelease file, if not present fails
         '''
 
-        global args
-
-        if args.verbose:
+        if self.options.verbose:
             print("Looking for Release file for %s ..." % dist)
 
         sig_cfile = self.mkCacheFile(dist, "Release.gpg")
@@ -509,7 +2279,7 @@ Returns:
             rel_name = "Release"
             inrel_cfile = self.mkCacheFile(dist, "InRelease")
             if update:
-                if args.verbose:
+                if self.options.verbose:
                     print(" Fetching InRelease file - %s -> %s..." %
                         (inrel_cfile.url, inrel_cfile.ofile))
                 if inrel_cfile.fetch():
@@ -521,10 +2291,10 @@ Returns:
         #cfile = CacheFile(rURL, self.getReleasePath(dist, rel_name))
         #cRelFile = None
         if has_sig:
-            if args.verbose:
+            if self.options.verbose:
                 print(" Found detached signature using - %s ..." % rel_name)
         else:
-            if args.verbose:
+            if self.options.verbose:
                 print(" No detached signature using - %s ..." % rel_name)
             sig_cfile = None
         #print("has_sig:", has_sig, " rel_name=", rel_name, " update=", update)
@@ -537,67 +2307,739 @@ Returns:
 
 
 
-    def checkReleaseFile(self, dist, cfile, update, sig_cfile):
-        ''' Check release file against latest version in original repository'''
-        try:
-            if update and not cfile.fetch():
-                print("Unable to fetch Release " + dist + " defintion file at " + cfile.url)
-                return None
-            if update and sig_cfile and not sig_cfile.fetch():
-                print("Unable to fetch Release Signature file at " + cfile.url)
+    def checkReleaseFile(self, dist, cfile, update, sig_cfile):
+        ''' Check release file against latest version in original repository'''
+        try:
+            if update and not cfile.fetch():
+                print("Unable to fetch Release " + dist + " defintion file at " + cfile.url)
+                return None
+            if update and sig_cfile and not sig_cfile.fetch():
+                print("Unable to fetch Release Signature file at " + cfile.url)
+                return None
+        except Exception as e:
+            print("Unable to fetch %s: %s" % (cfile.url, e))
+            return None
+
+        if not update or cfile.match():
+            oRelFile = RelFile(self, dist, cfile.ofile, sig_cfile)
+            if update and sig_cfile and not sig_cfile.match():
+                if self.options.verbose:
+                    print("%s updating missing signature file" % dist)
+                    sig_cfile.update()
+            oldPkgs = frozenset(oRelFile.pkgFiles)
+            self.com_pkgs = oldPkgs
+            self.new_pkgs = self.rm_pkgs = frozenset([])
+            if self.options.verbose:
+                print("No Changes in %s - total %d files" % (dist, len(self.com_pkgs)))
+                for p in self.com_pkgs:
+                    print("%s" % p)
+                print()
+            return oRelFile
+
+        if self.options.verbose:
+            print("%s has changed" % dist)
+        oRelFile = RelFile(self, dist, cfile.ofile, sig_cfile)
+        nRelFile = RelFile(self, dist, cfile.tfile, sig_cfile)
+        nRelFile.changed = True
+        newPkgs = frozenset(nRelFile.pkgFiles)
+        oldPkgs = frozenset(oRelFile.pkgFiles)
+        self.new_pkgs = newPkgs - oldPkgs
+        if len(self.new_pkgs) > 0 and self.options.verbose:
+            print("%d new packages:" % len(self.new_pkgs))
+        self.rm_pkgs = oldPkgs - newPkgs
+        if len(self.rm_pkgs) > 0 and self.options.verbose:
+            print("%d packages removed:" % len(self.rm_pkgs))
+        self.com_pkgs = newPkgs & oldPkgs
+        if self.options.verbose:
+            print("%d common packages:" % len(self.com_pkgs))
+        i = 0
+        for p in newPkgs:
+            print("%d: %s" % (i, p))
+            i += 1
+        return nRelFile
+
+    def inShard(self, fname):
+        ''' Return True if the deb with Filename fname is in this process's shard (or not sharding) '''
+        return not self.shard or shardOf(fname, self.shard[1]) == self.shard[0]
+
+    def lockMirror(self, exclusive=True):
+        '''
+        Take the whole mirror lock <lmirror>/.lock - exclusive while Release and Package
+        files are published (or debs pruned), shared while they are only read - waiting
+        for other runs holding it
+        '''
+        self.unlockMirror()
+        if not os.path.isdir(self.lmirror):
+            return
+        path = os.path.join(self.lmirror, RepositoryMirror.LOCK)
+        fd = flockFile(path, exclusive, blocking=False)
+        if fd == None:
+            print("Waiting for another run to release %s" % path)
+            fd = flockFile(path, exclusive)
+        self.mirrorLock = fd
+
+    def unlockMirror(self):
+        if self.mirrorLock != None:
+            os.close(self.mirrorLock)
+            self.mirrorLock = None
+
+    def claimDeb(self, d, wait=False):
+        '''
+        Lock the pool bucket of missing PkgEntry d, and take its lease when sharding, then
+        check it is still missing. Returns True if this process is to fetch it, False if
+        another process has its lease or has fetched it, None if another run has the
+        bucket locked and not wait - d is added to self.deferred
+        '''
+        if not self.poolLocks.acquire(d.fname, wait):
+            with self.lock:
+                self.deferred.append(d)
+            return None
+        if not self.leases or self.leases.acquire(d.fname):
+            if not checkFile(d.cfile.ofile, size=int(d.size), verbose=self.options.verbose):
+                return True
+            if self.leases:
+                self.leases.release(d.fname)
+        self.poolLocks.release(d.fname)
+        with self.lock:
+            self.others += 1
+        if self.options.verbose:
+            print("%s is being or has been fetched by another process" % d.fname)
+        return False
+
+    def releaseDeb(self, d):
+        if self.leases:
+            self.leases.release(d.fname)
+        self.poolLocks.release(d.fname)
+
+    def skipDeb(self, d):
+        ''' Count d as not fetched as the timeout expired '''
+        with self.lock:
+            self.timedout += 1
+
+    def oldVersion(self, d):
+        '''
+        Return (version, path) of the newest deb of the same package, architecture and epoch
+        as PkgEntry d but an older version in d's pool directory, or None if there is none.
+        Pool file names have no epoch - that of a deb a Package file read still lists is
+        its Version's, one no longer listed is taken to have d's.
+        '''
+        version, arch = d.fields.get('Version'), d.fields.get('Architecture')
+        if not version or not arch:
+            return None
+        epoch = version.partition(':')[0] if ':' in version else '0'
+        pdir = os.path.dirname(self.getDebPath(d.fname))
+        old = None
+        try:
+            names = os.listdir(pdir)
+        except OSError:
+            return None
+        for name in names:
+            w = name[:-len('.deb')].split('_') if name.endswith('.deb') else []
+            if len(w) != 3 or w[0] != d.name or w[2] != arch:
+                continue
+            listed = self.listedDeb(os.path.join(os.path.dirname(d.fname), name))
+            v = listed.fields.get('Version') if listed else None
+            if v == None:
+                v = urllib.parse.unquote(w[1])
+                v = v if epoch == '0' else epoch + ':' + v
+            elif (v.partition(':')[0] if ':' in v else '0') != epoch:
+                continue
+            if compareVersions(v, version) < 0 and (old == None or compareVersions(v, old[0]) > 0):
+                old = (v, os.path.join(pdir, name))
+        return old
+
+    def listedDeb(self, fname):
+        ''' Return the PkgEntry of the deb with Filename fname in the Package files read, or None '''
+        for r in self.relfiles.values():
+            for pkg in r.pkgFiles.values():
+                d = pkg.pkgs.get(fname)
+                if d != None:
+                    return d
+        return None
+
+    def fetchDelta(self, d):
+        '''
+        Rebuild missing PkgEntry d in d.cfile.tfile from an older version of it in the pool and
+        the delta between them fetched from delta_source, with debpatch. Returns True if that
+        worked and it matches the Package file, else False - d should be fetched whole
+        '''
+        import subprocess
+        if not self.delta_source or self.options.dry_run:
+            return False
+        old = self.oldVersion(d)
+        if old == None:
+            return False
+        name = '%s_%s_%s_%s.debdelta' % (d.name, old[0].replace(':', '%3a'),
+            d.fields['Version'].replace(':', '%3a'), d.fields['Architecture'])
+        path = os.path.join(os.path.dirname(d.fname), name)
+        cf = CacheFile(self.delta_source + '/' + path, ofile=self.getDebPath(path), mirror=self)
+        try:
+            if not cf.fetch():
+                return False
+            tfile = d.cfile.mkTemp()
+            try:
+                subprocess.run([self.debpatch, cf.tfile, old[1], tfile], check=True,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            except FileNotFoundError:
+                print("%s not found - fetching whole debs" % self.debpatch)
+                self.delta_source = None
+                return False
+            except subprocess.CalledProcessError as e:
+                print("Unable to rebuild %s from %s: %s" % (d.fname, name, e.stderr.decode().strip()))
+                return False
+            if not d.cfile.verify(size=int(d.size), md5sum=d.md5sum):
+                print("%s rebuilt from %s does not match Package file" % (d.fname, name))
+                return False
+            size = os.path.getsize(cf.tfile)
+            with self.lock:
+                self.deltas = [self.deltas[0] + 1, self.deltas[1] + size, self.deltas[2] + int(d.size)]
+            if self.options.verbose:
+                print("Rebuilt %s from %s - %d bytes instead of %s" % (d.fname, name, size, d.size))
+            return True
+        finally:
+            if cf.tfile and os.path.exists(cf.tfile):
+                os.unlink(cf.tfile)
+
+    def fetchDeb(self, d, wait=False):
+        '''
+        Fetch, verify and update one missing .deb PkgEntry - raises OSError on failure
+        It is rebuilt from a delta if possible, else fetched whole.
+        Returns True if fetched, otherwise the result of claimDeb(d, wait)
+        '''
+        claimed = self.claimDeb(d, wait)
+        if not claimed:
+            return claimed
+        try:
+            if not self.fetchDelta(d):
+                if not d.cfile.fetch():
+                    raise OSError("fetch failed")
+                if not d.cfile.verify(size=int(d.size), md5sum=d.md5sum):
+                    raise OSError("%s does not match Package file" % d.fname)
+            if not d.cfile.update():
+                raise OSError("update failed")
+        finally:
+            self.releaseDeb(d)
+        return True
+
+    def fetchMany(self, debs, timeout, engine, wait=False):
+        '''
+        Fetch the missing PkgEntry debs with engine - async or one/self.workers threads.
+        Returns a list with True (fetched), False (failed) or None (not fetched here) for each
+        '''
+        import concurrent.futures
+        if engine == 'async':
+            return AsyncFetcher(self.workers, timeout, self).run(debs)
+        def fetchOne(d):
+            if timeout and gettime() >= timeout:
+                self.skipDeb(d)
+                return None
+            try:
+                return True if self.fetchDeb(d, wait) else None
+            except OSError as e:
+                print("Failed to fetch %s: %s" % (d.name, e))
+                return False
+        workers = 1 if engine == 'serial' else self.workers
+        with concurrent.futures.ThreadPoolExecutor(workers) as ex:
+            return list(ex.map(fetchOne, debs))
+
+    def readAccessLogs(self, files):
+        '''
+        Add the deb requests in web server access logs files since they were last read to
+        the popularity of the packages in the mirror database. A log that has been rotated
+        (it has a new inode) is read from the start, after the rest of the old one if it
+        is now <file>.1
+        '''
+        if self.db == None:
+            print("No mirror database - not reading access logs")
+            return
+        for f in files:
+            try:
+                ino = os.stat(f).st_ino
+            except OSError as e:
+                print("Unable to read access log %s: %s" % (f, e.strerror))
+                continue
+            last_ino, offset = self.db.logOffset(f)
+            counts = {}
+            if last_ino != ino:
+                try:
+                    if last_ino != None and os.stat(f + '.1').st_ino == last_ino:
+                        with open(f + '.1', errors='replace') as fp:
+                            fp.seek(offset)
+                            logRequests(fp, counts)
+                except OSError:
+                    pass
+                offset = 0
+            with open(f, errors='replace') as fp:
+                if offset > os.fstat(fp.fileno()).st_size:
+                    offset = 0 # truncated
+                fp.seek(offset)
+                for line in iter(fp.readline, ''):
+                    if not line.endswith('\n'):
+                        break # being written - read it next time
+                    logRequests([line], counts)
+                    offset = fp.tell()
+            self.db.addRequests(f, ino, offset, counts, self.popularity_half_life)
+            print("%s: %d deb requests for %d packages" % (f, sum(counts.values()), len(counts)))
+
+    def popularDebs(self):
+        '''
+        Return the missing debs of this process's shard of packages requested in the access
+        logs, most popular first
+        '''
+        scores = self.db.popularity(self.popularity_half_life) if self.db else {}
+        if not scores:
+            return []
+        debs = dict((d.fname, d) for r in self.relfiles.values() for p in r.pkgFiles.values()
+            if not p.missing for d in p.pkgs.values()
+            if d.missing and d.name in scores and self.inShard(d.fname))
+        return sorted(debs.values(), key=lambda d: -scores[d.name])
+
+    def fetchPlan(self, update=True):
+        '''
+        Return the plan of a run from the state found by checkState() as a dict to write as
+        JSON: each file which would be fetched with its size and whether it is added or
+        replaces one, in groups by distribution, component and architecture (null for the
+        Release files), with their total count and bytes.
+        unavailable - index files which could not be fetched - their debs are not known
+        throughput - bytes/s of the fetches of earlier runs, None if there were none
+        eta - seconds fetching the files would take at that rate
+        update - checkState() refreshed the Release and Package files from upstream
+        Nothing is hashed - debs are only checked by size and index files by the md5sums
+        the mirror database has recorded for them, else by size.
+        '''
+        groups = {}
+        unavailable = []
+        seen = set()
+        def add(dist, comp, arch, file, size):
+            path = os.path.relpath(self.livePath(file), self.lmirror)
+            if path in seen: # arch all debs are in several Package files
+                return
+            seen.add(path)
+            g = groups.setdefault((dist, comp, arch), { 'dist' : dist, 'comp' : comp,
+                'arch' : arch, 'files' : [], 'count' : 0, 'bytes' : 0 })
+            g['files'].append({ 'path' : path, 'size' : size,
+                'op' : 'replace' if os.path.lexists(file) else 'add' })
+            g['count'] += 1
+            g['bytes'] += size
+
+        for (dist, fname), cfile in self.cfiles.items():
+            if cfile.fetched and not cfile.match():
+                add(dist, None, None, cfile.ofile, os.path.getsize(cfile.tfile))
+        for r in self.relfiles.values():
+            if not r.present:
+                continue
+            for pkg in list(r.pkgFiles.values()) + list(r.otherFiles.values()):
+                if pkg.missing and update:
+                    unavailable.append(os.path.relpath(self.livePath(pkg.cfile.ofile), self.lmirror))
+                elif pkg.missing or pkg.modified:
+                    add(r.name, pkg.comp, pkg.arch, pkg.cfile.ofile, int(pkg.size))
+            for pkg in r.pkgFiles.values():
+                if not pkg.missing:
+                    for d in pkg.pkgs.values():
+                        if d.missing:
+                            add(r.name, pkg.comp, pkg.arch, d.cfile.ofile, int(d.size))
+        plan = [groups[k] for k in sorted(groups, key=lambda k: tuple(x or '' for x in k))]
+        nbytes = sum(g['bytes'] for g in plan)
+        rate = self.db.throughput() if self.db else None
+        return { 'repository' : self.repo, 'mirror' : self.lmirror, 'time' : time.time(),
+            'refreshed' : update, 'groups' : plan, 'unavailable' : unavailable,
+            'count' : sum(g['count'] for g in plan), 'bytes' : nbytes,
+            'throughput' : rate, 'eta' : nbytes/rate if rate else None }
+
+    def fetchDebs(self, update=True, timeout=0.):
+        '''
+        Fetch the missing .deb files of all the Releases using the self.engine :
+            serial - one at a time reporting progress
+            threaded - self.workers at once in a pool of threads
+            async - self.workers at once on an asyncio event loop
+        update - Release signature files are updated
+        timeout - no fetches are started after this time (gettime()), 0. => none
+        With a shard (i, N) the debs of shard i are fetched first and then those of the
+        other shards which their processes have not yet fetched or leased.
+        Debs whose pool bucket another run has locked are fetched last, once it is released.
+        Debs of the packages most requested in the access logs are fetched before any others.
+        Returns the list of PkgEntry's of the debs that failed to be fetched
+        '''
+        if self.shard and not self.leases:
+            self.leases = Leases(self.lmirror)
+        if not self.poolLocks:
+            self.poolLocks = PoolLocks(self.lmirror)
+        self.others, self.timedout, self.deferred = 0, 0, []
+        self.deltas = [0, 0, 0]
+        began = gettime()
+        fetched = 0 # debs fetched by every engine and retry
+        later = [] # debs of other shards
+        failed = [] # debs to retry at the end
+        if self.options.verbose:
+            print("%d releases" % len(self.relfiles))
+            min_time = .1
+            self.report_time = 5.
+        else:
+            min_time = 3.0
+            self.report_time = 60.
+        popular = self.popularDebs()
+        if popular:
+            print("Fetching %d debs of popular packages first - %d bytes" %
+                (len(popular), sum(int(d.size) for d in popular)))
+            for d, ok in zip(popular, self.fetchMany(popular, timeout, self.engine)):
+                if ok:
+                    d.missing = False
+                    fetched += 1
+            self.deferred = [] # those not fetched are still missing and tried again below
+        todo = [] # debs for the concurrent engines
+        for r in self.relfiles.values():
+            if timeout and gettime() >= timeout:
+                print("Time out expired - skipping " + str(r))
+                continue;
+            if update and r.sig:
+                self.lockMirror()
+                r.sig.update()
+                self.unlockMirror()
+            print("Fetching Release %s" % r)
+            if self.options.verbose:
+                print("%d package files:" % len(r.pkgFiles))
+            for p in r.pkgFiles.values():
+                if timeout and gettime() >= timeout:
+                    print("Time out expired skipping Package", p.name," ...")
+                    break
+                print("Checking package %s for missing debs" % (p.cfile.ofile))
+                if p.missing:
+                    print("Skip missing package %s" % (p.cfile.ofile))
+                    continue
+                if self.engine != 'serial':
+                    todo += [d for d in p.pkgs.values() if d.missing]
+                    continue
+                later += [d for d in p.pkgs.values() if d.missing and not self.inShard(d.fname)]
+                p.total_fetched = 0
+                p.last_report = p.fetch_start = gettime()
+                for d in p.pkgs.values():
+                    if timeout and gettime() >= timeout:
+                        print("Time out expired skipping deb " + d.name + " ...")
+                        break
+                    if d.missing and self.inShard(d.fname):
+                        print("Fetching %s - size %s" % (d.name, d.size))
+                        try:
+                            start = gettime()
+                            if not self.fetchDeb(d):
+                                continue
+                            d.missing = False
+                            fetched += 1
+                            elapsed = gettime() - start
+                            p.total_fetched += int(d.size)
+                            if start - p.last_report > self.report_time:
+                                p.last_report = start
+                                av_speed = p.total_fetched/(start - p.fetch_start)
+                                print( "%s %s %s %3.1f%% fetched Estimating %d seconds to complete" %
+                                    (p.name, p.arch, p.comp, 100*p.total_fetched/p.total_missing, (p.total_missing - p.total_fetched)/av_speed) )
+                            elif elapsed > min_time:
+                                speed = (8*int(d.size)/elapsed)/1000.
+                                if speed < 2000.0:
+                                    print("Downloaded in %.1f seconds = %.3f kbit/s" % (elapsed, speed))
+                                elif speed < 2000000.0:
+                                    print("Downloaded in %.3f seconds = %.3f Mbit/s" % (elapsed, speed/1000.))
+                                else:
+                                    print("Downloaded in %.6f seconds = %.3f Gbit/s" % (elapsed, speed/1000000.))
+
+                        except OSError as e:
+                            print("Failed to fetch %s: %s" % (d.name, e))
+                            failed.append(d)
+        if self.shard and self.engine != 'serial':
+            todo = [d for d in todo if self.inShard(d.fname)] + \
+                [d for d in todo if not self.inShard(d.fname)]
+        elif self.shard:
+            todo = later
+            if todo:
+                print("Helping other shards with %d debs" % len(todo))
+        listed = {} # Filename -> its PkgEntry in each Package file listing it
+        for d in todo:
+            listed.setdefault(d.fname, []).append(d)
+        todo = [entries[0] for entries in listed.values()] # arch all debs are in several
+        results = []
+        if len(todo) > 0:
+            print("Fetching %d debs - %d bytes with %s engine" %
+                (len(todo), sum(int(d.size) for d in todo), self.engine))
+            results = self.fetchMany(todo, timeout, self.engine)
+        if len(self.deferred) > 0:
+            deferred = self.deferred
+            print("Waiting for the pool locks of %d debs held by other fetches" % len(deferred))
+            results += self.fetchMany(deferred, timeout, 'threaded', wait=True)
+            todo += deferred
+        for d, ok in zip(todo, results):
+            if ok:
+                for e in listed[d.fname]:
+                    e.missing = False
+        fetched += results.count(True)
+        failed += [d for d, ok in zip(todo, results) if ok == False]
+        if len(failed) > 0:
+            n = len(failed)
+            failed = self.retryDebs(failed, timeout)
+            fetched += n - len(failed)
+        if self.deltas[0]:
+            print("Rebuilt %d debs from deltas - fetched %d bytes instead of %d, saving %d bytes" %
+                (self.deltas[0], self.deltas[1], self.deltas[2], self.deltas[2] - self.deltas[1]))
+        if self.trace.hists:
+            print("HTTP requests:")
+            self.trace.report(self.options.verbose)
+        if self.others:
+            print("Left %d debs to other processes" % self.others)
+        if self.timedout:
+            print("Time out expired skipped %d debs" % self.timedout)
+        if fetched or failed:
+            print("Fetched %d debs in %.1f seconds" % (fetched, gettime() - began))
+        return failed
+
+    def retryDebs(self, debs, timeout):
+        '''
+        Retry the debs which failed once the rest of the fetch is done, waiting first
+        for a paused upstream to be tried again. Returns the list of those which failed again
+        '''
+        wait = self.upstreams.pausedFor()
+        if timeout and gettime() + wait >= timeout:
+            print("Time out expired - not retrying %d failed debs" % len(debs))
+            return debs
+        if wait > 0:
+            print("Waiting %.0f seconds for paused upstreams" % wait)
+            time.sleep(wait)
+        print("Retrying %d failed debs" % len(debs))
+        for d in debs:
+            d.cfile.fetched = None # fetch() again rather than return the failure
+        results = self.fetchMany(debs, timeout, 'serial' if self.engine == 'serial' else 'threaded',
+            wait=True)
+        for d, ok in zip(debs, results):
+            if ok:
+                d.missing = False
+        return [d for d, ok in zip(debs, results) if ok == False]
+
+    def releaseSignature(self):
+        ''' Return the stat signatures of the published Release files of all the distributions '''
+        return [statSignature(os.path.join(self.lmirror, 'dists', d, f))
+            for d in self.dists for f in ('Release', 'InRelease')]
+
+    def servedDebs(self, relfiles):
+        ''' Return {Filename: PkgEntry} of every deb listed by the Package files read of relfiles '''
+        return dict((fn, d) for r in relfiles.values()
+            for pkg in r.pkgFiles.values() if not pkg.missing for fn, d in pkg.pkgs.items())
+
+    def indexDebs(self):
+        ''' Set self.served to the PkgEntry of every deb listed by the Package files read '''
+        with self.indexLock:
+            self.served = self.servedDebs(self.relfiles)
+            self.served_sig = self.releaseSignature()
+            self.served_time = gettime()
+
+    def refreshIndex(self):
+        '''
+        Re-read the Package files for -serve if another run has published new Release files
+        since they were read - checked at most once every SERVE_RECHECK seconds.
+        They are read by a copy of the mirror while the other handler threads carry on
+        with the old index, which is then swapped for the new one under indexLock. Other
+        calls wait for the re-read to finish.
+        '''
+        import copy
+        with self.refreshLock:
+            with self.indexLock:
+                if gettime() - self.served_time < RepositoryMirror.SERVE_RECHECK:
+                    return
+                self.served_time = gettime()
+                sig = self.releaseSignature()
+                if sig == self.served_sig:
+                    return
+            print("Release files have changed - re-reading Package files")
+            fresh = copy.copy(self)
+            fresh.relfiles, fresh.changed_dists, fresh.cnt, fresh.updated = {}, [], 0, False
+            self.lockMirror(False)
+            try:
+                fresh.checkState(False)
+            finally:
+                self.unlockMirror()
+            served = self.servedDebs(fresh.relfiles)
+            with self.indexLock:
+                self.relfiles, self.missing, self.cnt = fresh.relfiles, fresh.missing, fresh.cnt
+                self.served, self.served_sig = served, sig
+
+    def fillDeb(self, fname):
+        '''
+        Fetch the deb with Filename fname for -serve, checked against the Package file listing it.
+        Concurrent requests for the same deb wait for the one fetch.
+        Returns True once it is in the pool, False if it could not be fetched and None if no
+        Package file lists it
+        '''
+        import concurrent.futures
+        with self.indexLock:
+            d = self.served.get(fname)
+        if d == None:
+            self.refreshIndex()
+            with self.indexLock:
+                d = self.served.get(fname)
+            if d == None:
                 return None
-        except:
-            self.cleanUp(1, "Unable to fetch %s - aborting..." % rURL)
-            return None
-
-        if not update or cfile.match():
-            oRelFile = RelFile(self, dist, cfile.ofile, sig_cfile)
-            if update and sig_cfile and not sig_cfile.match():
-                if args.verbose:
-                    print("%s updating missing signature file" % dist)
-                    sig_cfile.update()
-            oldPkgs = frozenset(oRelFile.pkgFiles)
-            self.com_pkgs = oldPkgs
-            self.new_pkgs = self.rm_pkgs = frozenset([])
-            if args.verbose:
-                print("No Changes in %s - total %d files" % (dist, len(self.com_pkgs)))
-                for p in self.com_pkgs:
-                    print("%s" % p)
-                print()
-            return oRelFile
+        with self.lock:
+            f = self.filling.get(fname)
+            if f != None:
+                fetching = False
+            else:
+                fetching = True
+                f = self.filling[fname] = concurrent.futures.Future()
+        if not fetching:
+            return f.result()
+        ok = False
+        try:
+            path = self.getDebPath(fname)
+            d.cfile = CacheFile(self.getDebURL(fname), ofile=path, upstreams=self.upstreams,
+                path=fname, size=int(d.size), mirror=self)
+            start = gettime()
+            if self.fetchDeb(d, wait=True):
+                print("Fetched %s - %s bytes in %.1f seconds" % (fname, d.size, gettime() - start))
+            ok = checkFile(path, size=int(d.size), verbose=self.options.verbose)
+            d.missing = not ok
+        except OSError as e:
+            print("Failed to fetch %s: %s" % (fname, e))
+        finally:
+            with self.lock:
+                del self.filling[fname]
+            f.set_result(ok)
+        return ok
+
+    def serve(self, address):
+        '''
+        Serve the mirror over HTTP at address (host, port) until interrupted, fetching each
+        missing deb the first time it is requested (-serve)
+        '''
+        import http.server
+        if not self.poolLocks:
+            self.poolLocks = PoolLocks(self.lmirror)
+        self.unlockMirror()
+        self.indexDebs()
+        handler = type('MirrorHandler', (MirrorHandler, http.server.SimpleHTTPRequestHandler), {})
+        server = http.server.ThreadingHTTPServer(address,
+            functools.partial(handler, directory=self.lmirror))
+        server.daemon_threads = True
+        server.mirror = self
+        print("Serving %s on %s port %d - %d debs listed, %d missing" % (self.lmirror,
+            address[0] or '*', server.server_address[1], len(self.served),
+            sum(1 for d in self.served.values() if d.missing)))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("Stopped serving %s" % self.lmirror)
+        finally:
+            server.server_close()
 
-        if args.verbose:
-            print("%s has changed" % dist)
-        oRelFile = RelFile(self, dist, cfile.ofile, sig_cfile)
-        nRelFile = RelFile(self, dist, cfile.tfile, sig_cfile)
-        nRelFile.changed = True
-        newPkgs = frozenset(nRelFile.pkgFiles)
-        oldPkgs = frozenset(oRelFile.pkgFiles)
-        self.new_pkgs = newPkgs - oldPkgs
-        if len(self.new_pkgs) > 0 and args.verbose:
-            print("%d new packages:" % len(self.new_pkgs))
-        self.rm_pkgs = oldPkgs - newPkgs
-        if len(self.rm_pkgs) > 0 and args.verbose:
-            print("%d packages removed:" % len(self.rm_pkgs))
-        self.com_pkgs = newPkgs & oldPkgs
-        if args.verbose:
-            print("%d common packages:" % len(self.com_pkgs))
-        i = 0
-        for p in newPkgs:
-            print("%d: %s" % (i, p))
-            i += 1
-        return nRelFile
+    def applyManifests(self):
+        '''
+        Bring the mirror up to date with an upstream mirror which writes manifests by applying
+        the ones listed in its manifests/index which have not been applied yet, oldest first
+        (-apply-manifest). The pool files of each are fetched first, then its index files,
+        each checked against its size and SHA256 before it is put in place, and then the files
+        it removes are deleted. Files which already match are not fetched. A manifest is only
+        recorded as applied once all its files are - a failure stops before any index file is
+        put in place after it. Returns the number of files which failed.
+        A manifest with a path which is absolute, has a '..' part or is not under dists/ or
+        pool/ is not applied, so an upstream cannot write outside the mirror's trees.
+        Needs the mirror database to record which manifests have been applied.
+        '''
+        def fetchSet(entries):
+            todo = []
+            for e in entries:
+                path = os.path.join(self.lmirror, e['path'])
+                if checkFile(path, size=e['size']) and sha256File(path) == e['sha256']:
+                    continue
+                todo.append((e, CacheFile(self.repo + '/' + e['path'], ofile=path,
+                    upstreams=self.upstreams, path=e['path'], size=e['size'], mirror=self)))
+            fetched = fetchAll([cf for e, cf in todo], self.workers)
+            nfails = 0
+            for (e, cf), ok in zip(todo, fetched):
+                if not ok or not checkFile(cf.tfile, size=e['size']) or \
+                        sha256File(cf.tfile) != e['sha256'] or not cf.update():
+                    print("Failed to apply %s %s" % (e['op'], e['path']))
+                    nfails += 1
+            return len(todo), nfails
+
+        if self.db == None:
+            print("No mirror database in %s to record the manifests applied in - not applying them"
+                % self.lmirror)
+            return 1
+        cf = CacheFile(self.repo + '/' + Manifest.DIR + '/' + Manifest.INDEX,
+            upstreams=self.upstreams, path=Manifest.DIR + '/' + Manifest.INDEX, mirror=self)
+        if not cf.fetch():
+            print("Unable to fetch the manifest index of %s" % self.repo)
+            return 1
+        with open(cf.tfile) as f:
+            names = f.read().split()
+        applied = self.db.appliedManifests()
+        todo = [n for n in names if n not in applied]
+        if not todo:
+            print("%s: all %d manifests of %s are applied" % (self.lmirror, len(names), self.repo))
+            return 0
+        for name in todo:
+            cf = CacheFile(self.repo + '/' + Manifest.DIR + '/' + name,
+                upstreams=self.upstreams, path=Manifest.DIR + '/' + name, mirror=self)
+            try:
+                if not cf.fetch():
+                    raise OSError("fetch failed")
+                with open(cf.tfile) as f:
+                    manifest = json.load(f)
+                files = manifest['files']
+                for e in files:
+                    path = os.path.normpath(e['path'])
+                    parts = path.split(os.sep)
+                    if os.path.isabs(path) or '..' in parts or len(parts) < 2 or \
+                            parts[0] not in ('dists', 'pool'):
+                        raise ValueError("path %s is not in dists/ or pool/" % e['path'])
+                    e['path'] = path
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                print("Unable to read manifest %s: %s" % (name, e))
+                return 1
+            previous = manifest.get('previous')
+            if applied and previous and previous not in applied:
+                print("Warning: manifest %s follows %s which expired at %s before it was applied"
+                    " - the files it changed may be out of date" % (name, previous, self.repo))
+            nfetched = 0
+            for pool in (True, False):
+                n, nfails = fetchSet([e for e in files if e['op'] != 'remove' and
+                    e['path'].startswith('pool/') == pool])
+                nfetched += n
+                if nfails:
+                    print("Stopped applying manifest %s - %d files failed" % (name, nfails))
+                    return nfails
+            nremoved = 0
+            for e in files:
+                path = os.path.join(self.lmirror, e['path'])
+                if e['op'] == 'remove' and os.path.lexists(path):
+                    if not self.options.dry_run:
+                        os.unlink(path)
+                        self.db.forget(path)
+                        if self.manifest:
+                            self.manifest.remove(path)
+                    nremoved += 1
+            if not self.options.dry_run:
+                self.db.recordManifest(name, len(files))
+            applied.add(name)
+            print("Applied manifest %s - %d files fetched, %d removed, %d already present" %
+                (name, nfetched, nremoved, len(files) - nfetched - nremoved))
+        return 0
 
     def cleanUp(self, ret=0, msg=None):
-        '''Remove all temporary files/directories'''
+        '''Remove all temporary files/directories - returns ret, the exit status of a run'''
 
         if msg:
             print(msg)
+        self.discardStaged()
+        if self.manifest:
+            try:
+                self.manifest.write(self.repo)
+            except OSError as e:
+                print("Unable to write manifest in %s: %s" % (self.manifest.dir, e))
+        if self.journal:
+            self.journal.close()
+        self.trace.close()
         try:
             self.tempDir.cleanup()
         except:
             print("Nothing to remove")
-        sys.exit(ret)
+        if self.db:
+            self.db.close()
+        return ret
 
     def __repr__(self):
         return "RepositoryMirror(repo='{}', dists={}, comps={}, archs={}, lmirror='{}')".format(
@@ -605,6 +3047,7 @@ Returns:
     def __str__(self):
         s = "Configuration file: " + self.cfgFile + "\n" + \
             "Repository: " + str(self.repo) + "\n" + \
+            ("Upstreams:\n" + str(self.upstreams) if len(self.upstreams.urls) > 1 else "") + \
             "distributions: " + str(self.dists) + "\n" + \
             "components: " + str(self.comps) + "\n" + \
             "architectures: " + str(self.archs) + "\n" + \
@@ -623,6 +3066,8 @@ Holds summary of a Release file including:
    name - Release name
    info - dict of parameters from head of release file
    pkgFiles - dict of PkgFile index by pkgfile names matching RepositoryMirror's parameters
+   sha256 - dict of the SHA256 of every file listed in the Release
+   byHash - the Release says its index files can be fetched by-hash (Acquire-By-Hash: yes)
     '''
 
     def __init__(self, rep, name, rfile, sig_cfile):
@@ -640,6 +3085,8 @@ Holds summary of a Release file including:
         self.info = {}
         self.pkgFiles = {}
         self.otherFiles = {}
+        self.sha256 = {}
+        self.byHash = False
         self.changed = False
         self.present = False
         if name in rep.debList:
@@ -662,10 +3109,11 @@ Holds summary of a Release file including:
             if l.startswith('Hash:'):
                 fp.readline() # skip blank line
             else:
-                if verbose:
+                if rep.options.verbose:
                     print("Found Signature Hash line")
 
         self.present = True
+        section = None
         for l in fp:
             if l.startswith('-----BEGIN PGP SIGNATURE-----'):
                 break
@@ -674,41 +3122,54 @@ Holds summary of a Release file including:
             #print('%s - w=%s' % (repr(l), repr(w)))
             if len(w) <= 0: continue
             if w[0] in { 'MD5Sum:', 'SHA1:', 'SHA256:' }:
+                section = w[0]
                 break
             if w[0][-1] == ':':
                 self.info[w[0][0:-1]] = ' '.join(w[1:])
                 continue
             print("RelFile: %s Ignoring strange word %s" % (rfile, w[0]))
+        first = section # the checksums of the Package files are from the first list
 
         for l in fp:
             l = l.lstrip().rstrip()
             w = l.split()
-            if w[0] in { 'MD5Sum:', 'SHA1:', 'SHA256:' }:
+            if len(w) <= 0: continue
+            if l.startswith('-----BEGIN PGP SIGNATURE-----'):
                 break
+            if w[0] in { 'MD5Sum:', 'SHA1:', 'SHA256:', 'SHA512:' }:
+                section = w[0]
+                continue
+            if section == 'SHA256:' and len(w) > 2:
+                self.sha256[w[2]] = w[0]
+            if section != first:
+                continue
             if len(w) > 2 and 'Packages' in w[2]:
                 f = w[2]
                 (comp, arch, ctype) = PkgFile.parsePfile(f)
                 if ctype == 'gzip' \
-                    and comp in RepositoryMirror.components \
-                    and arch in RepositoryMirror.architectures :
+                    and comp in rep.comps \
+                    and arch in rep.archs :
                     self.pkgFiles[f] = PkgFile(rep, f, md5sum=w[0], size=w[1], relfile=self)
-                    if verbose:
+                    if rep.options.verbose:
                         print("Grab package %s" % (f))
                 continue
             if len(w) > 2 and 'Translation' in w[2]:
                 f = w[2]
                 (comp, arch, bzctype) = PkgFile.parsePfile(f)
-                if comp in RepositoryMirror.components \
+                if comp in rep.comps \
                     and arch == 'Translation' and f.endswith('-en.bz2') :
                     self.otherFiles[f] = PkgFile(rep, f, md5sum=w[0], size=w[1], relfile=self)
-                    if verbose:
+                    if rep.options.verbose:
                         print("Grab Translation %s" % (f))
                 continue
-            if verbose:
+            if rep.options.verbose:
                 print("RelFile '%s' %d unknown package line: %s" % (rfile, len(w), l))
         fp.close()
+        for f in list(self.pkgFiles.values()) + list(self.otherFiles.values()):
+            f.sha256 = self.sha256.get(f.name)
 
         fields = self.info
+        self.byHash = fields.get('Acquire-By-Hash', 'no').lower() == 'yes'
         self.suite = fields.get('Suite', None)
         self.codename = fields.get('Codename', None)
         self.version = fields.get('Version', None)
@@ -721,7 +3182,7 @@ Holds summary of a Release file including:
         if self.archs:
             self.archs = self.archs.split()
 
-        if verbose:
+        if rep.options.verbose:
             print("%d packages found in RelFile %s" % (len(self.pkgFiles), rfile))
 
     def __repr__(self):
@@ -734,12 +3195,17 @@ Holds summary of a Release file including:
 
 class PkgEntry():
     ''' Package file entry - usually detailing a .deb file '''
-    def __init__(self, name, fname, md5sum, size):
+
+    # Other fields of the entry that are kept in fields
+    FIELDS = ('Version', 'Architecture', 'Pre-Depends', 'Depends', 'Recommends', 'Provides')
+
+    def __init__(self, name, fname, md5sum, size, fields=None):
         ''' Package file entry defining a .deb file '''
         self.name = name
         self.fname = fname
         self.md5sum = md5sum
         self.size = size
+        self.fields = fields if fields != None else {}
 
     def getPkgEntry(fp):
         '''Return a Package Entry or None from Package file fp'''
@@ -749,7 +3215,8 @@ class PkgEntry():
                     return None
 
             #print("getPkgEntry() = %s" % repr(p))
-            return PkgEntry(p['Package'], p['Filename'], p['MD5sum'], p['Size'])
+            return PkgEntry(p['Package'], p['Filename'], p['MD5sum'], p['Size'],
+                dict((f, p[f]) for f in PkgEntry.FIELDS if f in p))
 
         except OSError as e:
             print('getPkgEntry() failed: %s' % e.strerror)
@@ -779,10 +3246,8 @@ class PkgEntry():
             if len(w) >= 2:
                 k, v = w[0], w[1].strip()
             else:
-                print("Error rdPkgDetails - parse error line:", l, "w = ", w)
-                for i in [ 1, 2, 3 ]:
-                    print(fp)
-                sys.exit(2)
+                raise MirrorError("rdPkgDetails - parse error in %s line: %s" %
+                    (getattr(fp, 'name', fp), l.rstrip()))
 
         return p
 
@@ -809,27 +3274,26 @@ class PkgFile():
         self.ctype = ctype
         self.md5sum = md5sum
         self.size = size
+        self.sha256 = None # from the Release's SHA256 list
         p = PkgFile.parsePfile(name)
         self.comp, self.arch = p[0], p[1]
         self.ignored = 0
 
-    def rdPkgFile(self, rfile):
+    def rdPkgFile(self, rfile, entries=None):
         '''
         Read in from a Package file, update state of .deb files
           - Restricted by any pkglist associated with that release
+        entries - (Package, Filename, MD5sum, Size, fields) list already read from rfile
+                  by readPkgIndex(), if None rfile is read here
         '''
 
-        global args
+        options = self.repMirror.options
         self.total_missing = 0
-        if self.ctype.endswith('bz2'):
-            fp = bz2.BZ2File(rfile, 'r')
-        elif self.ctype.endswith('gzip'):
-            fp = gzip.open(rfile, 'r')
-        else:
-            fp = open(rfile, 'rt')
+        if entries == None:
+            entries = readPkgIndex(rfile, self.ctype)
 
         # read in Package entry seperated by blank lines
-        if args.verbose:
+        if options.verbose:
             print("Reading %s " % (rfile))
             st_time = gettime() + 60
         self.pkgs = {}
@@ -837,11 +3301,9 @@ class PkgFile():
         self.cnt = 0
         self.total = 0
         deblist = self.relfile.deblist if self.relfile else None
-        while True:
-            p = PkgEntry.getPkgEntry(fp)
-            if p == None:
-                break;
-            if args.verbose:
+        for e in entries:
+            p = PkgEntry(*e)
+            if options.verbose:
                 if st_time < gettime():
                     st_time = gettime() + 60
                     print("Processed ", self.total, " Up to", p.name)
@@ -856,10 +3318,11 @@ class PkgFile():
             f = self.repMirror.getDebPath(fn)
             u = self.repMirror.getDebURL(fn)
             s = int(p.size)
-            if extra_verbose:
+            if options.extra_verbose:
                 print("rdPkgFile() Want ", p.name, " ofile=", f)
-            cfile = CacheFile(u, ofile=f)
-            if args.onlypkgs:
+            cfile = CacheFile(u, ofile=f, upstreams=self.repMirror.upstreams, path=fn, size=s,
+                mirror=self.repMirror)
+            if options.onlypkgs:
                 md5 = None
             else:
                 md5 = p.md5sum
@@ -868,7 +3331,7 @@ class PkgFile():
                 p.cfile = cfile
                 self.total_missing += s
                 self.cnt += 1
-                if args.verbose or self.cnt < 5:
+                if options.verbose or self.cnt < 5:
                     print(' Missing %s  size %d, md5sum=%s' % (fn, s, p.md5sum))
             else:
                 p.missing = False
@@ -876,10 +3339,9 @@ class PkgFile():
             self.pkgs[p.fname] = p
             self.pkgfiles[p.fname] = p
 
-        fp.close()
-        if not args.verbose and self.cnt >= 5:
+        if not options.verbose and self.cnt >= 5:
             print(' .... Total %d missing debs' % self.cnt)
-        if not args.verbose:
+        if not options.verbose:
             return
         if self.total_missing > 0:
             if  self.total_missing < 1024*1024:
@@ -916,6 +3378,615 @@ class PkgFile():
 
         return (l[0], arch, ctype)
 
+class MirrorDB:
+    ''' SQLite database of the state of a local mirror kept in <lmirror>/.mirror.db
+Paths are relative to the mirror directory. Tables:
+    files - every file put in place or verified: size, md5sum, the mtime/inode it
+            had then and when it was last verified
+    indices - Package files read: distribution, component, architecture and md5sum
+    refs - the .deb Filenames each Package file references with size and md5sum
+    fetches - history of fetches: URL, bytes, seconds, success and when
+    scrubs - history of -scrub runs: when, files and bytes re-verified, corrupt files
+    popularity - requests for each package in the access logs, decaying with time
+    applied - manifests of an upstream mirror applied by -apply-manifest
+    logs - how far each access log has been read
+A file whose size, mtime and inode still match its files row is known to have
+that md5sum without reading it again. Opened readonly (-plan) it must exist and is
+neither created nor changed.
+    '''
+
+    NAME = '.mirror.db'
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER,
+            md5sum TEXT, mtime_ns INTEGER, ino INTEGER, verified REAL);
+        CREATE TABLE IF NOT EXISTS indices (idx TEXT PRIMARY KEY, dist TEXT, comp TEXT,
+            arch TEXT, md5sum TEXT, entries INTEGER, read REAL);
+        CREATE TABLE IF NOT EXISTS refs (idx TEXT, path TEXT, package TEXT, size INTEGER,
+            md5sum TEXT, PRIMARY KEY (idx, path));
+        CREATE INDEX IF NOT EXISTS refs_path ON refs (path);
+        CREATE TABLE IF NOT EXISTS fetches (id INTEGER PRIMARY KEY, path TEXT, url TEXT,
+            bytes INTEGER, seconds REAL, ok INTEGER, time REAL);
+        CREATE INDEX IF NOT EXISTS fetches_time ON fetches (time);
+        CREATE TABLE IF NOT EXISTS scrubs (time REAL, files INTEGER, bytes INTEGER,
+            corrupt INTEGER);
+        CREATE TABLE IF NOT EXISTS popularity (package TEXT PRIMARY KEY, score REAL, time REAL);
+        CREATE TABLE IF NOT EXISTS logs (path TEXT PRIMARY KEY, ino INTEGER, offset INTEGER);
+        CREATE TABLE IF NOT EXISTS applied (name TEXT PRIMARY KEY, files INTEGER, time REAL);
+    '''
+
+    def __init__(self, lmirror, readonly=False):
+        self.lmirror = lmirror
+        self.path = os.path.join(lmirror, MirrorDB.NAME)
+        self.lock = threading.Lock()
+        if readonly:
+            self.con = sqlite3.connect('file:%s?mode=ro' % urllib.parse.quote(self.path),
+                uri=True, timeout=60., check_same_thread=False)
+            return
+        self.con = sqlite3.connect(self.path, timeout=60., check_same_thread=False)
+        self.con.execute('PRAGMA journal_mode=WAL')
+        self.con.execute('PRAGMA synchronous=NORMAL')
+        self.con.executescript(MirrorDB.SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.con.close()
+
+    def rel(self, file):
+        ''' Return path of file relative to the mirror '''
+        return os.path.relpath(file, self.lmirror)
+
+    def verified(self, file, size=None, md5sum=None):
+        ''' Return True if file is unchanged since it was verified to have md5sum (and size) '''
+        try:
+            st = os.stat(file)
+        except OSError:
+            return False
+        with self.lock:
+            r = self.con.execute('SELECT size, md5sum, mtime_ns, ino FROM files WHERE path = ?',
+                (self.rel(file),)).fetchone()
+        return r != None and r[1] != None and r[1] == md5sum \
+            and r[0] == st.st_size and (size == None or int(size) == st.st_size) \
+            and r[2] == st.st_mtime_ns and r[3] == st.st_ino
+
+    def recordFile(self, file, md5sum=None):
+        ''' Record file as present with its current stat and the md5sum it was verified against '''
+        try:
+            st = os.stat(file)
+        except OSError:
+            return
+        with self.lock, self.con:
+            self.con.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                (self.rel(file), st.st_size, md5sum, st.st_mtime_ns, st.st_ino, time.time()))
+
+    def recordFetch(self, file, url, size, seconds, ok):
+        with self.lock, self.con:
+            self.con.execute('INSERT INTO fetches (path, url, bytes, seconds, ok, time) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (self.rel(file), url, size, seconds, 1 if ok else 0, time.time()))
+
+    def recordScrub(self, files, size, corrupt):
+        with self.lock, self.con:
+            self.con.execute('INSERT INTO scrubs VALUES (?, ?, ?, ?)',
+                (time.time(), files, size, corrupt))
+
+    def logOffset(self, path):
+        ''' Return (inode, offset) the access log path was last read up to, or (None, 0) '''
+        r = self.query('SELECT ino, offset FROM logs WHERE path = ?', (path,))
+        return tuple(r[0]) if r else (None, 0)
+
+    def addRequests(self, path, ino, offset, counts, half_life):
+        '''
+        Add {package: requests} counts read from access log path up to offset of inode ino
+        to the popularity of the packages, after decaying it by half every half_life seconds
+        '''
+        now = time.time()
+        with self.lock, self.con:
+            for name, n in counts.items():
+                r = self.con.execute('SELECT score, time FROM popularity WHERE package = ?',
+                    (name,)).fetchone()
+                score = r[0] * 0.5 ** ((now - r[1])/half_life) if r else 0.
+                self.con.execute('INSERT OR REPLACE INTO popularity VALUES (?, ?, ?)',
+                    (name, score + n, now))
+            self.con.execute('INSERT OR REPLACE INTO logs VALUES (?, ?, ?)', (path, ino, offset))
+
+    def popularity(self, half_life):
+        ''' Return {package: requests decayed by half every half_life seconds} '''
+        now = time.time()
+        return dict((name, score * 0.5 ** ((now - t)/half_life))
+            for name, score, t in self.query('SELECT package, score, time FROM popularity'))
+
+    def appliedManifests(self):
+        return set(r[0] for r in self.query('SELECT name FROM applied'))
+
+    def recordManifest(self, name, files):
+        with self.lock, self.con:
+            self.con.execute('INSERT OR REPLACE INTO applied VALUES (?, ?, ?)',
+                (name, files, time.time()))
+
+    def throughput(self, since=30*24*3600):
+        '''
+        Return the bytes/s debs were fetched at in the last since seconds over the time
+        fetches were running - concurrent fetches overlap - or None if there were none
+        '''
+        busy, nbytes, end = 0., 0, None
+        for start, stop, n in self.query('SELECT time - seconds, time, bytes FROM fetches '
+            "WHERE ok AND path LIKE 'pool/%' AND time > ? ORDER BY time - seconds",
+            (time.time() - since,)):
+            nbytes += n
+            if end == None or start > end:
+                busy += stop - start
+                end = stop
+            elif stop > end:
+                busy += stop - end
+                end = stop
+        return nbytes/busy if busy > 0 else None
+
+    def setRefs(self, dist, pkg, entries, path=None):
+        ''' Record the (Package, Filename, MD5sum, Size) entries of PkgFile pkg of
+        distribution dist unless that version of it is already recorded
+        path - where pkg is published if not pkg.cfile.ofile '''
+        idx = self.rel(path or pkg.cfile.ofile)
+        with self.lock:
+            r = self.con.execute('SELECT md5sum FROM indices WHERE idx = ?', (idx,)).fetchone()
+            if r != None and r[0] == pkg.md5sum:
+                return
+            with self.con:
+                self.con.execute('DELETE FROM refs WHERE idx = ?', (idx,))
+                self.con.executemany('INSERT OR REPLACE INTO refs VALUES (?, ?, ?, ?, ?)',
+                    ((idx, e[1], e[0], int(e[3]), e[2]) for e in entries))
+                self.con.execute('INSERT OR REPLACE INTO indices VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (idx, dist, pkg.comp, pkg.arch, pkg.md5sum, len(entries), time.time()))
+
+    def refPaths(self, file):
+        ''' Return the sorted Filenames of the debs Package file file references '''
+        return [r[0] for r in self.query('SELECT path FROM refs WHERE idx = ? ORDER BY path',
+            (self.rel(file),))]
+
+    def forget(self, file):
+        ''' Remove the record of file which has been deleted '''
+        with self.lock, self.con:
+            self.con.execute('DELETE FROM files WHERE path = ?', (self.rel(file),))
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.con.execute(sql, params).fetchall()
+
+    def report(self, half_life=7*24*3600):
+        ''' Print summary of the mirror's state - packages' popularity decays with half_life seconds '''
+        n, size, nv, oldest = self.query('SELECT count(*), total(size), count(md5sum), '
+            'min(verified) FROM files')[0]
+        print("Mirror database %s" % self.path)
+        print(" %d files %d bytes - %d verified by md5sum" % (n, size, nv))
+        if oldest:
+            print(" Oldest verification %s" % time.ctime(oldest))
+        for dist, nidx, nrefs, rsize, npresent, psize in self.query(
+            'SELECT i.dist, count(DISTINCT i.idx), count(r.path), total(r.size), '
+            'count(f.path), total(f.size) FROM indices i JOIN refs r ON r.idx = i.idx '
+            'LEFT JOIN files f ON f.path = r.path GROUP BY i.dist'):
+            print(" %s: %d Package files reference %d debs %d bytes - %d debs %d bytes recorded present"
+                % (dist, nidx, nrefs, rsize, npresent, psize))
+        nok, nfail, fbytes, secs, last = self.query('SELECT total(ok), count(*) - total(ok), '
+            'total(bytes), total(seconds), max(time) FROM fetches')[0]
+        if last:
+            print(" %d fetches (%d failed) %d bytes in %.1f seconds%s - last %s" % (nok + nfail,
+                nfail, fbytes, secs, (" = %.0f bytes/s" % (fbytes/secs)) if secs > 0 else "",
+                time.ctime(last)))
+        nruns, nfiles, sbytes, ncorrupt, last = self.query('SELECT count(*), total(files), '
+            'total(bytes), total(corrupt), max(time) FROM scrubs')[0]
+        if last:
+            print(" %d scrubs re-verified %d debs %d bytes - %d corrupt - last %s" %
+                (nruns, nfiles, sbytes, ncorrupt, time.ctime(last)))
+        top = sorted(self.popularity(half_life).items(),
+            key=lambda p: -p[1])[:10]
+        if top:
+            print(" Most requested packages: " + ' '.join('%s (%.1f)' % p for p in top))
+
+class UpstreamPool:
+    ''' Set of equivalent upstream repositories
+Tracks the latency, throughput and health of each upstream. Metadata is fetched
+from the fastest() one, while .deb files are spread over all the healthy ones
+in proportion to their measured throughput by order(). Each upstream has a
+circuit breaker: one which fails DEMOTE_FAILS times in a row is paused - allow()
+refuses requests to it for DEMOTE_TIME seconds - then one trial request is let
+through which either closes the breaker or pauses it again.
+    '''
+
+    DEMOTE_FAILS = 3
+    DEMOTE_TIME = 300.
+    ALPHA = 0.3 # weight of the newest measurement in the running averages
+
+    def __init__(self, urls):
+        self.urls = list(urls)
+        self.speed = dict((u, None) for u in self.urls) # bytes/second
+        self.latency = dict((u, None) for u in self.urls) # seconds
+        self.fails = dict((u, 0) for u in self.urls)
+        self.demoted = dict((u, 0.) for u in self.urls) # paused until this time
+        self.trial = dict((u, False) for u in self.urls) # trial request in progress
+        self.lock = threading.Lock()
+
+    def healthy(self):
+        ''' Return list of upstreams that are not demoted '''
+        now = gettime()
+        return [u for u in self.urls if self.demoted[u] <= now]
+
+    def probe(self, path):
+        ''' Time fetching path from every upstream concurrently and return fastest() '''
+        import concurrent.futures
+        import urllib.error
+        import urllib.request
+        def timeOne(u):
+            try:
+                start = gettime()
+                with HostLimits.of(u), urllib.request.urlopen(u + '/' + path,
+                        timeout=CacheFile.timeout or None) as uf:
+                    latency = gettime() - start
+                    size = len(uf.read())
+                self.report(u, True, size, gettime() - start, latency)
+            except OSError as e:
+                if isinstance(e, urllib.error.HTTPError):
+                    e.close()
+                self.report(u, False)
+        if len(self.urls) > 1:
+            with concurrent.futures.ThreadPoolExecutor(len(self.urls)) as ex:
+                list(ex.map(timeOne, self.urls))
+        return self.fastest()
+
+    def allow(self, url):
+        '''
+        Circuit breaker - return True if a request may be sent to upstream url:
+        always while it is healthy, never while it is paused and only for one
+        trial request at a time once its pause is over
+        '''
+        with self.lock:
+            if self.fails[url] < UpstreamPool.DEMOTE_FAILS:
+                return True
+            if self.demoted[url] > gettime() or self.trial[url]:
+                return False
+            self.trial[url] = True
+            return True
+
+    def pausedFor(self):
+        ''' Return seconds until a request may be sent to an upstream - 0. if one is healthy '''
+        now = gettime()
+        with self.lock:
+            return min(0. if self.fails[u] < UpstreamPool.DEMOTE_FAILS else
+                max(0., self.demoted[u] - now) for u in self.urls)
+
+    def fastest(self):
+        ''' Return the healthy upstream with the highest throughput '''
+        ups = self.healthy() or self.urls
+        return max(ups, key=lambda u: self.speed[u] or 0.)
+
+    def order(self):
+        ''' Return all upstreams in the order to try them for one file
+        The first is chosen at random weighted by throughput from the healthy upstreams,
+        then the rest of the healthy ones fastest first and demoted ones last '''
+        with self.lock:
+            ups = self.healthy()
+            known = [self.speed[u] for u in ups if self.speed[u]]
+            default = sum(known)/len(known) if known else 1.
+            rest = sorted(ups, key=lambda u: -(self.speed[u] or default))
+            if len(ups) > 1:
+                first = random.choices(ups, [self.speed[u] or default for u in ups])[0]
+                rest.remove(first)
+                rest.insert(0, first)
+            return rest + [u for u in self.urls if u not in ups]
+
+    def report(self, url, ok, size=0, elapsed=0., latency=None):
+        ''' Record the outcome of fetching size bytes in elapsed seconds from url '''
+        a = UpstreamPool.ALPHA
+        with self.lock:
+            self.trial[url] = False
+            if not ok:
+                self.fails[url] += 1
+                if self.fails[url] >= UpstreamPool.DEMOTE_FAILS:
+                    if self.demoted[url] <= gettime():
+                        print("Pausing upstream %s for %d seconds after %d failures" %
+                            (url, UpstreamPool.DEMOTE_TIME, self.fails[url]))
+                    self.demoted[url] = gettime() + UpstreamPool.DEMOTE_TIME
+                return
+            self.fails[url] = 0
+            if latency != None:
+                old = self.latency[url]
+                self.latency[url] = latency if old == None else (1 - a)*old + a*latency
+            if elapsed > 0. and size > 0:
+                speed = size/elapsed
+                old = self.speed[url]
+                self.speed[url] = speed if old == None else (1 - a)*old + a*speed
+
+    def __str__(self):
+        s = ''
+        for u in self.urls:
+            s += "  %s: %s latency %s %s\n" % (u,
+                '-' if self.speed[u] == None else '%.0f bytes/s' % self.speed[u],
+                '-' if self.latency[u] == None else '%.3fs' % self.latency[u],
+                'paused' if self.demoted[u] > gettime() else 'ok')
+        return s
+
+class AsyncFetcher:
+    ''' asyncio engine - fetches many CacheFiles concurrently on one event loop
+Implements just enough HTTP/1.1 (keep-alive, Content-Length, chunked and redirects)
+on asyncio streams that only the standard library is needed. Files from file:
+repositories, hashing the fetched files, the pool locks and putting the files in
+place are run in the default executor so the event loop never waits on the disk.
+    '''
+
+    MAX_REDIRECTS = 5
+    USER_AGENT = 'RepositoryMirror'
+
+    def __init__(self, connections, timeout=0., mirror=None):
+        ''' connections - maximum concurrent requests
+            timeout - time (gettime()) after which no new fetches are started
+            mirror - RepositoryMirror to claim each deb from before it is fetched '''
+        self.connections = connections
+        self.timeout = timeout
+        self.mirror = mirror
+        self.trace = mirror.trace if mirror else None
+        self.idle = {} # (scheme, host, port) -> idle keep-alive connections
+        self.slots = {} # HostLimits -> asyncio.Semaphore of its connections
+
+    def run(self, debs):
+        ''' Fetch, verify and update all the PkgEntry's debs
+        Returns a list with True (fetched), False (failed) or None (timed out or left
+        to another process) for each '''
+        import asyncio
+        return asyncio.run(self.fetchAll(debs))
+
+    async def fetchAll(self, debs):
+        import asyncio
+        sem = asyncio.Semaphore(self.connections)
+        async def fetchOne(d):
+            async with sem:
+                return await self.fetchDeb(d)
+        try:
+            results = await asyncio.gather(*[fetchOne(d) for d in debs], return_exceptions=True)
+            for d, r in zip(debs, results):
+                if isinstance(r, BaseException):
+                    print("Failed to fetch %s: %s" % (d.name, r))
+            return [False if isinstance(r, BaseException) else r for r in results]
+        finally:
+            for conns in self.idle.values():
+                for reader, writer in conns:
+                    writer.close()
+            self.idle = {}
+
+    async def fetchDeb(self, d):
+        import asyncio
+        if self.timeout and gettime() >= self.timeout:
+            if self.mirror:
+                self.mirror.skipDeb(d)
+            return None
+        loop = asyncio.get_running_loop()
+        if self.mirror and not await loop.run_in_executor(None, self.mirror.claimDeb, d):
+            return None
+        cf = d.cfile
+        try:
+            if not (self.mirror and self.mirror.delta_source and
+                    await loop.run_in_executor(None, self.mirror.fetchDelta, d)):
+                if not await self.fetch(cf):
+                    raise OSError("fetch failed")
+                if not await loop.run_in_executor(None, cf.verify, int(d.size), d.md5sum):
+                    raise OSError("%s does not match Package file" % d.fname)
+            if not await loop.run_in_executor(None, cf.update):
+                raise OSError("update failed")
+            return True
+        except OSError as e:
+            print("Failed to fetch %s: %s" % (d.name, e))
+            return False
+        finally:
+            if self.mirror:
+                await loop.run_in_executor(None, self.mirror.releaseDeb, d)
+
+    async def fetch(self, cf):
+        ''' Equivalent of CacheFile.fetch() on the event loop '''
+        import asyncio
+        tfile = cf.mkTemp()
+        if cf.options.verbose:
+            print("Fetching %s -> %s" % (cf.url, tfile))
+        if cf.options.dry_run:
+            open(tfile, 'wb').close()
+            cf.fetched = True
+            return True
+        loop = asyncio.get_running_loop()
+        error = None
+        for attempt in range(CacheFile.retries + 1):
+            if attempt > 0:
+                await asyncio.sleep(max(retryDelay(attempt, error), cf.pausedFor()))
+            tried = False
+            for base, url in cf.sources():
+                if base != None and not cf.upstreams.allow(base):
+                    continue
+                tried = True
+                start = gettime()
+                try:
+                    src = localPath(url)
+                    if src != None:
+                        await loop.run_in_executor(None, cf.copyLocal, src)
+                        size = os.path.getsize(tfile)
+                    else:
+                        size = await self.limitedGet(url, tfile)
+                except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+                    if cf.options.verbose:
+                        print("Fetching %s failed: %s" % (url, e))
+                    error = e
+                    cf.fetchDone(base, url, False)
+                    continue
+                cf.source = base
+                cf.fetchDone(base, url, True, size, gettime() - start)
+                cf.fetched = True
+                return True
+            if not tried:
+                if attempt < CacheFile.retries and cf.pausedFor() <= CacheFile.retry_max:
+                    continue
+                break
+            if not transient(error):
+                break
+        cf.fetched = False
+        return False
+
+    async def limitedGet(self, url, tfile):
+        ''' get() url into tfile within the HostLimits of its host '''
+        import asyncio
+        limits = HostLimits.of(url)
+        slots = self.slots.get(limits)
+        if slots == None and HostLimits.connections > 0:
+            slots = self.slots[limits] = asyncio.Semaphore(HostLimits.connections)
+        if slots:
+            await slots.acquire()
+        try:
+            await asyncio.sleep(limits.throttle.delay(1))
+            return await self.get(url, tfile)
+        finally:
+            if slots:
+                slots.release()
+
+    async def connect(self, key, timing):
+        ''' Return (reader, writer, reused) connection to key = (scheme, host, port)
+        adding the seconds of a new connection's 'dns' lookup and 'connect' to dict timing '''
+        import asyncio
+        import socket
+        conns = self.idle.get(key)
+        if conns:
+            reader, writer = conns.pop()
+            return reader, writer, True
+        scheme, host, port = key
+        start = gettime()
+        infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        resolved = gettime()
+        timing['dns'] = timing.get('dns', 0.) + resolved - start
+        try:
+            for i, info in enumerate(infos):
+                try:
+                    reader, writer = await self.wait(asyncio.open_connection(info[4][0], port,
+                        ssl=True if scheme == 'https' else None,
+                        server_hostname=host if scheme == 'https' else None))
+                    return reader, writer, False
+                except OSError:
+                    if i == len(infos) - 1:
+                        raise
+        finally:
+            timing['connect'] = timing.get('connect', 0.) + gettime() - resolved
+
+    async def get(self, url, tfile, redirects=0):
+        ''' GET url into tfile and return the number of bytes '''
+        import asyncio
+        import urllib.error
+        u = urllib.parse.urlsplit(url)
+        if u.scheme not in ('http', 'https'):
+            raise OSError("unsupported URL %s" % url)
+        key = (u.scheme, u.hostname, u.port or (443 if u.scheme == 'https' else 80))
+        path = (u.path or '/') + ('?' + u.query if u.query else '')
+        request = ('GET %s HTTP/1.1\r\nHost: %s\r\nUser-Agent: %s\r\n'
+            'Accept-Encoding: identity\r\n\r\n' %
+            (path, u.netloc, AsyncFetcher.USER_AGENT)).encode('latin-1')
+        status, size, timing = None, 0, {}
+        try:
+            while True:
+                reader, writer, reused = await self.connect(key, timing)
+                start = gettime()
+                try:
+                    writer.write(request)
+                    await writer.drain()
+                    status, headers = await self.wait(self.readHeaders(reader))
+                    timing['ttfb'] = gettime() - start
+                    break
+                except (OSError, ValueError, asyncio.IncompleteReadError):
+                    writer.close()
+                    if not reused:
+                        raise
+                    # an idle connection closed by the server - retry on a new one
+        except:
+            if self.trace:
+                self.trace.record(url, status, size, timing)
+            raise
+
+        try:
+            if status in (301, 302, 303, 307, 308) and 'location' in headers:
+                writer.close()
+                if redirects >= AsyncFetcher.MAX_REDIRECTS:
+                    raise OSError("too many redirects %s" % url)
+                return await self.get(urllib.parse.urljoin(url, headers['location']),
+                    tfile, redirects + 1)
+            if status != 200:
+                writer.close()
+                raise urllib.error.HTTPError(url, status, "HTTP error %d" % status, headers, None)
+            start = gettime()
+            with open(tfile, 'wb') as of:
+                size, keep = await self.readBody(reader, headers, of, timing)
+            timing['transfer'] = gettime() - start
+        except:
+            writer.close()
+            raise
+        finally:
+            if self.trace:
+                self.trace.record(url, status, size, timing, reused)
+        if keep:
+            self.idle.setdefault(key, []).append((reader, writer))
+        else:
+            writer.close()
+        return size
+
+    async def wait(self, aw):
+        ''' Await aw - raising TimeoutError if it takes more than CacheFile.timeout seconds '''
+        import asyncio
+        try:
+            return await asyncio.wait_for(aw, CacheFile.timeout or None)
+        except asyncio.TimeoutError:
+            raise TimeoutError("timed out after %g seconds" % CacheFile.timeout)
+
+    async def readHeaders(self, reader):
+        ''' Return (status, headers) of a HTTP response '''
+        line = await reader.readuntil(b'\r\n')
+        w = line.decode('latin-1').split(None, 2)
+        if len(w) < 2 or not w[0].startswith('HTTP/'):
+            raise ValueError("bad HTTP status line %r" % line)
+        status = int(w[1])
+        headers = { 'http-version' : w[0] }
+        while True:
+            line = (await reader.readuntil(b'\r\n')).decode('latin-1').strip()
+            if not line:
+                return status, headers
+            k, sep, v = line.partition(':')
+            headers[k.strip().lower()] = v.strip()
+
+    async def readBody(self, reader, headers, of, timing):
+        ''' Copy response body to of adding the seconds spent writing it to timing['write']
+        - returns (bytes, connection can be reused) '''
+        import asyncio
+        def write(b):
+            start = gettime()
+            of.write(b)
+            timing['write'] = timing.get('write', 0.) + gettime() - start
+        size = 0
+        keep = headers.get('connection', '').lower() != 'close' and \
+            headers['http-version'] != 'HTTP/1.0'
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                n = int((await self.wait(reader.readuntil(b'\r\n'))).split(b';')[0], 16)
+                if n == 0:
+                    while (await self.wait(reader.readuntil(b'\r\n'))) != b'\r\n':
+                        pass # skip trailers
+                    return size, keep
+                write(await self.wait(reader.readexactly(n)))
+                await self.wait(reader.readexactly(2))
+                size += n
+        if 'content-length' in headers:
+            left = int(headers['content-length'])
+            while left > 0:
+                b = await self.wait(reader.read(min(left, CacheFile.SEGBUFSIZE)))
+                if not b:
+                    raise asyncio.IncompleteReadError(b'', left)
+                write(b)
+                left -= len(b)
+                size += len(b)
+            return size, keep
+        while True: # body ends when the connection closes
+            b = await self.wait(reader.read(CacheFile.SEGBUFSIZE))
+            if not b:
+                return size, False
+            write(b)
+            size += len(b)
+
 class CacheFile:
     ''' Cache a file locally from a URL allowing comparisons and updates of the local version '''
 
@@ -923,71 +3994,331 @@ class CacheFile:
     tfile = 'tmp.txt'
     ofile = 'orig.txt'
     BUFSIZE = 4024
-
-    def __init__(self, url, ofile=None, tfile=None):
+    COPYSIZE = 1 << 30 # max bytes per in-kernel copy call
+    SEGBUFSIZE = 1 << 16 # read size for segmented downloads
+    retries = 3 # times a transient fetch failure is retried
+    retry_base = 1. # seconds before the first retry, doubling for each after it
+    retry_max = 60. # most seconds between retries
+    timeout = 60. # seconds a connect or read from upstream may block before it fails
+    hardlink = True # hard link files from file: repositories when possible
+    db = None # MirrorDB recording the state of files
+    trace = None # Trace of the HTTP requests made
+    journal = None # Journal of the files put in place by this run
+    manifest = None # Manifest of the changes this run makes to the mirror
+    segment_min = 64*1024*1024 # fetch files this big in segments (0 => never)
+    segments = 4 # number of concurrent segments
+    options = Options() # of a CacheFile without a mirror
+    opener = None # tracedOpener() of a CacheFile without a mirror
+    openerLock = threading.Lock() # held while a mirror's opener is made
+
+    def __init__(self, url, ofile=None, tfile=None, upstreams=None, path=None, size=None,
+            mirror=None):
         ''' URL and local original file of object to cache
 
             url : URL of object we cache locally
             ofile : original (local) version of file
             tfile : temporary fresh copy from URL
+            upstreams : UpstreamPool the file can be fetched from instead of url
+            path : path of the file relative to each of the upstreams
+            size : expected size of the file if known
+            mirror : RepositoryMirror whose temporary directory, database, journal, manifest,
+                     trace and options are used - CacheFile's own if None
         '''
+        self.mirror = mirror if mirror else CacheFile
+        self.options = self.mirror.options
         self.url = url
+        self.upstreams = upstreams
+        self.path = path
+        self.size = size
+        self.source = None # upstream the file was fetched from
+        self.md5sum = None # md5sum the fetched copy was verified against
         if ofile:
             self.ofile = ofile
         else:
-            self.ofile = os.path.join(CacheFile.tdir, CacheFile.ofile)
+            self.ofile = os.path.join(self.mirror.tdir, CacheFile.ofile)
         self.tfile = tfile
+        self.fetched = None # result of fetch() into tfile if done
 
     def fetch(self, tfile=None):
-        ''' fetch a fresh copy of the file into tfile '''
+        ''' fetch a fresh copy of the file into tfile
+        Only fetched once unless tfile is given or update() has used the copy '''
 
-        global args
+        if tfile == None and self.fetched != None:
+            return self.fetched
+        self.fetched = self.fetchFile(tfile)
+        return self.fetched
 
-        try:
-            if tfile:
-                self.tfile = tfile
-                of = open(tfile, 'wb')
-            elif self.tfile:
-                tfile = self.tfile
-                of = open(tfile, 'wb')
-            else:
-                of = tempfile.NamedTemporaryFile(dir=CacheFile.tdir,
-                    prefix=os.path.basename(self.ofile) + '_',
-                    delete=False)
-                self.tfile = of.name
+    def fetchFile(self, tfile=None):
+        ''' fetch a fresh copy of the file into tfile
+        With a set of upstreams the file is fetched from the one they choose,
+        falling back to each of the others in turn, skipping those that are paused.
+        A transient failure is retried up to CacheFile.retries times after retryDelay()'''
+        import urllib.error
 
-            if args.verbose:
+        try:
+            tfile = self.mkTemp(tfile)
+            if self.options.verbose:
                 print("Fetching %s -> %s" % (self.url, self.tfile))
 
-            # Note: supports non-standard syntax for local
-            # file "file:abc/def" means file at abd/def
-            if args.dry_run:
-                of.close()
+            if self.options.dry_run:
+                open(tfile, 'wb').close()
                 return True
-            uf = urllib.request.urlopen(self.url)
-
-            while True:
-                b = uf.read(CacheFile.BUFSIZE)
-                if not b: break
-                of.write(b)
-
-            uf.close()
-            of.close()
-            return True
+            sources = self.sources()
+            if self.size and CacheFile.segment_min and self.size >= CacheFile.segment_min \
+                and localPath(sources[0][1]) == None and self.fetchSegments(sources):
+                return True
+            error = None
+            for attempt in range(CacheFile.retries + 1):
+                if attempt > 0:
+                    delay = max(retryDelay(attempt, error), self.pausedFor())
+                    if self.options.verbose:
+                        print("Retrying %s in %.1f seconds: %s" % (self.url, delay, error))
+                    time.sleep(delay)
+                    sources = self.sources()
+                tried = False
+                for base, url in sources:
+                    if base != None and not self.upstreams.allow(base):
+                        continue
+                    tried = True
+                    start = gettime()
+                    try:
+                        size = self.fetchURL(url)
+                    except OSError as e:
+                        error = e
+                        self.fetchDone(base, url, False)
+                        continue
+                    self.source = base
+                    self.fetchDone(base, url, True, size, gettime() - start)
+                    return True
+                if not tried:
+                    if attempt < CacheFile.retries and self.pausedFor() <= CacheFile.retry_max:
+                        continue
+                    print("Not fetching %s - its upstreams are paused" % self.url)
+                    return False
+                if not transient(error):
+                    break
+            raise error
 
-        except urllib.error.HTTPError:
-            print("urllib.error.HTTPError:", self.url)
+        except urllib.error.HTTPError as e:
+            print("urllib.error.HTTPError:", self.url, e.code)
             return False
 
         except OSError:
             print("OSError:", tfile)
             return False
 
+    def pausedFor(self):
+        ''' Return seconds until one of the file's upstreams can be used again '''
+        return self.upstreams.pausedFor() if self.upstreams and self.path != None else 0.
+
+    def mkTemp(self, tfile=None):
+        ''' Set and return the temporary file to fetch into - tfile if given
+        else any already set or a new file in the mirror's tdir '''
+        import tempfile
+        if tfile:
+            self.tfile = tfile
+        elif not self.tfile:
+            of = tempfile.NamedTemporaryFile(dir=self.mirror.tdir,
+                prefix=os.path.basename(self.ofile) + '_',
+                delete=False)
+            of.close()
+            self.tfile = of.name
+        return self.tfile
+
+    def localSource(self):
+        ''' Return the file of a file: repository the file was fetched from, None if not local '''
+        if self.source != None and self.path != None:
+            return localPath(self.source + '/' + self.path)
+        return localPath(self.url)
+
+    def sources(self):
+        ''' Return list of (upstream, URL) to try fetching the file from in turn '''
+        if self.upstreams and self.path != None:
+            return [(u, u + '/' + self.path) for u in self.upstreams.order()]
+        return [(None, self.url)]
+
+    def open(self, req, timing):
+        ''' tracedOpen() req with the mirror's tracedOpener() - made the first time it is needed '''
+        with CacheFile.openerLock:
+            if self.mirror.opener == None:
+                self.mirror.opener = tracedOpener()
+        return tracedOpen(self.mirror.opener, req, timing, CacheFile.timeout or None)
+
+    def fetchURL(self, url):
+        ''' Copy url into tfile and return its size in bytes
+        Note: supports non-standard syntax for local
+        file "file:abc/def" means file at abd/def'''
+        import urllib.error
+        src = localPath(url)
+        if src != None:
+            self.copyLocal(src)
+            return os.path.getsize(self.tfile)
+
+        size, status, timing = 0, None, {}
+        with HostLimits.of(url):
+            try:
+                with self.open(url, timing) as uf, open(self.tfile, 'wb') as of:
+                    status = uf.status
+                    start = gettime()
+                    while True:
+                        b = uf.read(CacheFile.BUFSIZE)
+                        if not b: break
+                        w = gettime()
+                        of.write(b)
+                        timing['write'] = timing.get('write', 0.) + gettime() - w
+                        size += len(b)
+                    timing['transfer'] = gettime() - start
+            except urllib.error.HTTPError as e:
+                status = e.code
+                e.close() # the response it holds - its code and headers are kept
+                raise
+            finally:
+                if self.mirror.trace:
+                    self.mirror.trace.record(url, status, size, timing)
+        return size
+
+    def fetchSegments(self, sources):
+        '''
+        Fetch the file as CacheFile.segments concurrent byte ranges into a preallocated tfile.
+        The segments are spread over the (upstream, url) sources, a failed segment is retried
+        from the next source. Returns False if the file could not be fetched this way,
+        e.g. an upstream does not support ranges
+        '''
+        import concurrent.futures
+        import urllib.error
+        import urllib.request
+        step = -(-self.size // CacheFile.segments)
+        ranges = [(first, min(first + step, self.size) - 1) for first in range(0, self.size, step)]
+        if self.options.verbose:
+            print("Fetching %s in %d segments" % (self.path or self.url, len(ranges)))
+        fd = os.open(self.tfile, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o644)
+        try:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, self.size)
+            else:
+                os.ftruncate(fd, self.size)
+
+            def fetchRange(k):
+                first, last = ranges[k]
+                k %= len(sources)
+                for base, url in sources[k:] + sources[:k]:
+                    if base != None and not self.upstreams.allow(base):
+                        continue
+                    req = urllib.request.Request(url,
+                        headers={ 'Range' : 'bytes=%d-%d' % (first, last) })
+                    start = gettime()
+                    status, timing = None, {}
+                    try:
+                        pos = first
+                        with HostLimits.of(url), self.open(req, timing) as uf:
+                            status = uf.status
+                            if uf.status != 206:
+                                if base != None:
+                                    self.upstreams.report(base, True)
+                                continue # upstream does not support ranges
+                            transfer = gettime()
+                            while pos <= last:
+                                b = uf.read(min(CacheFile.SEGBUFSIZE, last + 1 - pos))
+                                if not b: break
+                                w = gettime()
+                                os.pwrite(fd, b, pos)
+                                timing['write'] = timing.get('write', 0.) + gettime() - w
+                                pos += len(b)
+                            timing['transfer'] = gettime() - transfer
+                        if pos != last + 1:
+                            raise OSError("short segment %d-%d of %s" % (first, last, url))
+                    except OSError as e:
+                        status = getattr(e, 'code', status)
+                        if isinstance(e, urllib.error.HTTPError):
+                            e.close()
+                        if base != None:
+                            self.upstreams.report(base, False)
+                        continue
+                    finally:
+                        if self.mirror.trace:
+                            self.mirror.trace.record(url, status, pos - first, timing,
+                                file_size=self.size)
+                    if base != None:
+                        self.upstreams.report(base, True, last + 1 - first, gettime() - start)
+                    return True
+                return False
+
+            start = gettime()
+            with concurrent.futures.ThreadPoolExecutor(len(ranges)) as ex:
+                ok = all(list(ex.map(fetchRange, range(len(ranges)))))
+            if ok and self.mirror.db and not self.options.plan:
+                self.mirror.db.recordFetch(self.ofile, sources[0][1], self.size,
+                    gettime() - start, True)
+        finally:
+            os.close(fd)
+        if ok:
+            self.source = None
+        return ok
+
+    def fetchDone(self, base, url, ok, size=0, elapsed=0.):
+        ''' Record the outcome of fetching url from upstream base (None if not an upstream) '''
+        if base != None:
+            self.upstreams.report(base, ok, size, elapsed)
+        if self.mirror.db and not self.options.plan:
+            self.mirror.db.recordFetch(self.ofile, url, size, elapsed, ok)
+
+    def verify(self, size=None, md5sum=None):
+        '''
+        Return True if the fetched copy tfile matches given size and md5sum if not None
+        A mismatch counts as a failure of the upstream it was fetched from
+        '''
+        if self.options.dry_run:
+            return True
+        if checkFile(self.tfile, size=size, md5sum=md5sum, verbose=self.options.verbose):
+            self.md5sum = md5sum
+            return True
+        if self.source != None:
+            self.upstreams.report(self.source, False)
+        return False
+
+    def copyLocal(self, src):
+        '''
+        Fast path for file: repositories - hard link src into tfile if it is on
+        the same file system otherwise copy it without passing through user space.
+        Raises FileNotFoundError, leaving tfile as it is, if src is missing
+        '''
+        if not os.path.isfile(src):
+            raise FileNotFoundError("No such file %s" % src)
+        if CacheFile.hardlink:
+            try:
+                if os.path.lexists(self.tfile):
+                    os.unlink(self.tfile)
+                os.link(src, self.tfile)
+                return
+            except OSError:
+                pass
+        with open(src, 'rb') as sf, open(self.tfile, 'wb') as df:
+            copyData(sf, df)
+
     def check(self, size=None, md5sum=None):
         '''
         Return True if the cached file is present and matches given size and md5sum if not None
+        A file hard linked to its file: repository source is the source's copy so its
+        md5sum is trusted without re-reading it. -plan only reads the mirror database -
+        a file it has not verified is checked by its size.
         '''
-        return checkFile(self.ofile, size=size, md5sum=md5sum)
+        src = localPath(self.url)
+        if src != None and md5sum != None:
+            try:
+                if os.path.samefile(src, self.ofile):
+                    return checkFile(self.ofile, size=size, verbose=self.options.verbose)
+            except OSError:
+                pass
+        db = self.mirror.db
+        if md5sum != None and db and db.verified(self.ofile, size, md5sum):
+            return True
+        if self.options.plan:
+            return checkFile(self.ofile, size=size, verbose=self.options.verbose)
+        if not checkFile(self.ofile, size=size, md5sum=md5sum, verbose=self.options.verbose):
+            return False
+        if md5sum != None and db:
+            db.recordFile(self.ofile, md5sum)
+        return True
 
     def match(self, ofile=None, tfile=None):
         '''Return True if the cached file matches the original file
@@ -1022,24 +4353,38 @@ class CacheFile:
         except OSError:
             return False
 
+    def record(self, ofile, existed=True):
+        ''' Record ofile put in place (replacing a file if existed) in the mirror database,
+        the journal and the manifest '''
+        if self.mirror.db:
+            self.mirror.db.recordFile(ofile, self.md5sum)
+        if self.mirror.journal:
+            self.mirror.journal.record(ofile, self.md5sum)
+        if self.mirror.manifest:
+            self.mirror.manifest.put(ofile, existed)
+
     def update(self, ofile=None, tfile=None):
         '''Replace the original file with the cached file tfile
         ofile = over write this file instead of currently set original file
         tfile = use this for the new file to replace the original file with
         '''
 
-        global args
         if ofile == None:
             ofile = self.ofile
         if tfile == None:
             tfile = self.tfile
+        if self.options.plan:
+            return True # only planning - the mirror is left as it is
         try:
-            if args.verbose: print('rename %s => %s' % (tfile, ofile))
-            if args.dry_run:
+            if self.options.verbose: print('rename %s => %s' % (tfile, ofile))
+            self.fetched = None
+            if self.options.dry_run:
                 print('mv %s %s' % (tfile, ofile))
             else:
+                existed = os.path.lexists(ofile)
                 os.rename(tfile, ofile)
-                os.chmod(ofile, stat.S_IRUSR|stat.S_IRGRP|stat.S_IROTH)
+                setReadOnly(ofile, self.localSource())
+                self.record(ofile, existed)
             return True
 
         except OSError as e:
@@ -1047,12 +4392,13 @@ class CacheFile:
             if os.path.isdir(dname) == False:
                 print("%s missing - creating" % dname)
                 try:
-                    if args.dry_run:
+                    if self.options.dry_run:
                         print("mkdirs %s" % dname)
                     else:
-                        os.makedirs(dname)
+                        os.makedirs(dname, exist_ok=True)
                         os.rename(tfile, ofile)
-                        os.chmod(ofile, stat.S_IRUSR|stat.S_IRGRP|stat.S_IROTH)
+                        setReadOnly(ofile, self.localSource())
+                        self.record(ofile, False)
                         if os.access(ofile, os.R_OK):
                             print("Created %s" % ofile)
                             return True
@@ -1063,106 +4409,6 @@ class CacheFile:
             print('mv %s %s failed: %s' % (tfile, ofile, e.strerror))
             return False
 
-class TestRepositoryMirror(unittest.TestCase):
-    v = False
-
-    def setUp(self):
-        global args
-        if args.verbose: TestRepositoryMirror.v = True
-        else: TestRepositoryMirror.v = False
-
-        self.repMirror = RepositoryMirror()
-        self.pURL = self.repMirror.getPackageURL()
-        self.rURL = self.repMirror.getReleaseURL()
-        os.makedirs(RepositoryMirror.tdir)
-        self.cf = CacheFile(self.pURL)
-
-    def tearDown(self):
-        shutil.rmtree(RepositoryMirror.tdir)
-
-    def test_RepositoryMirror(self):
-        if TestRepositoryMirror.v: print("RepositoryMirror Tests")
-        if TestRepositoryMirror.v: print("getPackageURL() = " + self.pURL)
-        if TestRepositoryMirror.v:("getReleaseURL() = " + self.rURL)
-        self.assertTrue(self.repMirror.skeletonCheck(create=True))
-
-    def test_CacheFile(self):
-        if TestRepositoryMirror.v:("CacheFile Tests")
-
-        if self.cf:
-            self.assertTrue(self.cf)
-            if TestRepositoryMirror.v: print("Created CacheFile(cf)")
-
-        tfile = '/tmp/release.txt_new'
-        # Remove any existing original
-        try:
-            os.unlink(tfile)
-        except OSError:
-            pass # ignore if file is missing
-
-        if self.cf.fetch(tfile):
-            self.assertTrue(True)
-            if TestRepositoryMirror.v: print("CacheFile - test fetch file to " + tfile)
-        else:
-            self.assertTrue(False)
-
-        ofile = '/tmp/release.txt'
-        # Remove any existing original
-        try :
-            os.unlink(ofile)
-        except OSError:
-            pass
-        # Test match will fail with no original
-        if self.cf.match(ofile):
-            if TestRepositoryMirror.v: print("Failure: Testing Match against missing file succeeded!- should have failed!")
-            self.assertTrue(False)
-        else:
-            self.assertTrue(True)
-            if TestRepositoryMirror.v: print("Passed: Match against missing file - failed!")
-
-        # Test update will work create original when it doesn't exist
-        if self.cf.update(ofile):
-            self.assertTrue(True)
-            if TestRepositoryMirror.v: print("Passed: Update of missing file worked")
-        else:
-            self.assertTrue(False)
-
-
-        # Test re-fetch will now match
-        if self.cf.fetch(tfile):
-            if TestRepositoryMirror.v: print("Passed: Re-fetching original file worked")
-            self.assertTrue(True)
-        else:
-            self.assertTrue(False)
-
-        if self.cf.match(ofile):
-            if TestRepositoryMirror.v: print("Passed: Matching original file with newly updated works!")
-            self.assertTrue(True)
-        else:
-            if TestRepositoryMirror.v: print("Failed: Matching original file with newly updated failed!")
-            self.assertTrue(False)
-
-    def test_RelFile(self):
-        if TestRepositoryMirror.v: print("RelFile Tests")
-        r = 'Release'
-        self.assertTrue(os.access(r, os.R_OK))
-        rf = RelFile(self, r)
-        if TestRepositoryMirror.v:
-            print("RelFile Tests")
-            for k in rf.info.keys():
-                print('%s - %s' % (k, rf.info[k]))
-
-        print("Reading Release file %s : %d Package files" % (r, len(rf.pkgFiles)))
-
-    def test_PkgFile(self):
-        if TestRepositoryMirror.v: print("Package File Tests")
-        r = 'Packages.gz'
-        self.assertTrue(os.access(r, os.R_OK))
-        pf = PkgFile(r)
-        pf.rdPkgFile(r)
-
-        print("Reading Package file %s - %d Package definitions" % (r, len(pf.pkgs)))
-
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Mirror A Debian Repository')
 
@@ -1188,55 +4434,157 @@ if __name__ == '__main__':
         help='do not refresh status from original repository')
     parser.add_argument('-T', '--Timeout', dest='timeout', default=None,
         help='give up after this many seconds|mins|hours|days - N[smhd] ')
+    parser.add_argument('-shard', '--shard', dest='shard', type=parseShard, default=None,
+        help='i/N - fetch shard i of N processes sharing the mirror first then help the others')
+    parser.add_argument('-j', dest='workers', type=int, default=None,
+        help='number of concurrent fetches and Package file readers')
+    parser.add_argument('-engine', dest='engine', choices=RepositoryMirror.engines, default=None,
+        help='how to fetch missing packages - one at a time, in threads or with asyncio')
+    parser.add_argument('-quick', dest='quick', action='store_true',
+        help='report status from the last run\'s snapshot if still current (implies -norefresh)')
+    parser.add_argument('-prune', dest='prune', action='store_true',
+        help='quarantine debs no longer in any Package file and delete them after prune_grace')
+    parser.add_argument('-scrub', dest='scrub', action='store_true',
+        help='re-verify the md5sums of the next slice of debs at idle I/O priority')
+    parser.add_argument('-serve', dest='serve', type=parseAddress, default=None,
+        help='[host:]port - serve the mirror over HTTP fetching missing debs when requested')
+    parser.add_argument('-access-log', dest='access_logs', action='append', default=[],
+        help='web server access log of the mirror - popular packages are fetched first (repeatable)')
+    parser.add_argument('-apply-manifest', dest='apply_manifest', action='store_true',
+        help='apply the manifests of changes written by the upstream mirror, then exit')
+    parser.add_argument('-trace', dest='trace_file', default=None,
+        help='append the timing of every HTTP request to this file as JSON lines')
+    parser.add_argument('-plan', dest='plan', default=None,
+        help='write the files a run would fetch and how long it would take as JSON to FILE (- for stdout), then exit')
+    parser.add_argument('-closure', dest='closure', action='store_true',
+        help='add the dependencies of the packages in packages-<dist> lists')
+    parser.add_argument('-report', dest='report', action='store_true',
+        help='Print summary of the mirror database and exit')
     parser.add_argument('-only-pkgs-md5sum', dest='onlypkgs', action='store_false',
         help='only check package file md5sums')
 
     args = parser.parse_args()
-    verbose, dry_run, very_dry_run  = args.verbose, args.dry_run, args.very_dry_run
+    planOut = None
+    if args.plan == '-': # progress goes to stderr leaving stdout for the plan
+        planOut, sys.stdout = sys.stdout, sys.stderr
 
     if args.run_tests:
-        verbose = 2 if args.verbose else 1
-        suite = unittest.TestLoader().loadTestsFromTestCase(TestRepositoryMirror)
-        unittest.TextTestRunner(verbosity=verbose).run(suite)
-        sys.exit(0)
+        import unittest
+        try:
+            import TestRepositoryMirror
+        except ImportError:
+            print("The unit tests are not installed - run -run_tests in the source tree, "
+                "beside TestRepositoryMirror.py")
+            sys.exit(1)
+        TestRepositoryMirror.TestRepositoryMirror.v = args.verbose
+        suite = unittest.TestLoader().loadTestsFromModule(TestRepositoryMirror)
+        result = unittest.TextTestRunner(verbosity=2 if args.verbose else 1).run(suite)
+        sys.exit(0 if result.wasSuccessful() else 1)
 
     if args.timeout:
-        str2unit = { 's' : 1, 'm' : 60, 'h' : 3600, 'd' : 3600*24 }
-        unit = args.timeout[-1:]
-        if unit in str2unit:
-            args.timeout = gettime() + int(args.timeout[:-1]) * str2unit[unit]
-        else:
-            args.timeout = gettime() + int(args.timeout) * 3600
+        args.timeout = gettime() + parseDuration(args.timeout)
     else:
         args.timeout = 0.
 
     RepositoryMirror.cfgFile = args.cfgFile
-    RepositoryMirror.config()
-    repM = RepositoryMirror()
+    options = Options.read(args.cfgFile, verbose=args.verbose, dry_run=args.dry_run,
+        very_dry_run=args.very_dry_run, onlypkgs=args.onlypkgs, plan=bool(args.plan))
+    options.apply()
+    if args.workers != None:
+        options.settings['workers'] = args.workers
+    if args.engine != None:
+        options.settings['engine'] = args.engine
+    if args.closure:
+        options.settings['closure'] = set(options.settings.get('distributions',
+            RepositoryMirror.distributions))
+    if args.shard:
+        options.settings['shard'] = args.shard
+    if args.trace_file:
+        options.settings['trace_file'] = args.trace_file
+    try:
+        repM = RepositoryMirror(options=options)
+    except MirrorError as e:
+        print(e)
+        sys.exit(1)
 
     if args.info:
         repM.dump_info()
-        repM.cleanUp()
+        sys.exit(repM.cleanUp())
 
     nfails = 0
     if repM.skeletonCheck(args.create) != True:
         print("Unable to set up repository mirror for %s at %s"
             % (repM.repository, repM.lmirror))
         sys.exit(1)
-    if repM.checkState(args.update) == False:
+    if args.report:
+        if repM.db == None:
+            sys.exit(repM.cleanUp(1, "%s: no mirror database to report on" % repM.lmirror))
+        repM.db.report(repM.popularity_half_life)
+        sys.exit(repM.cleanUp())
+    if args.apply_manifest:
+        repM.lockMirror()
+        nfails = repM.applyManifests()
+        repM.unlockMirror()
+        sys.exit(repM.cleanUp(1 if nfails else 0))
+    if args.plan:
+        repM.lockMirror(False)
+        repM.checkState(args.update)
+        repM.unlockMirror()
+        plan = repM.fetchPlan(args.update)
+        try:
+            of = planOut if planOut else open(args.plan, 'w')
+            json.dump(plan, of, indent=1)
+            of.write('\n')
+            if not planOut:
+                of.close()
+        except OSError as e:
+            sys.exit(repM.cleanUp(1, "Unable to write plan to %s: %s" % (args.plan, e)))
+        print("Plan: %d files %d bytes to fetch%s" % (plan['count'], plan['bytes'],
+            (" - about %.0f seconds at %.0f bytes/s" % (plan['eta'], plan['throughput']))
+            if plan['eta'] != None else ""))
+        sys.exit(repM.cleanUp(1 if plan['unavailable'] else 0))
+    if args.prune or args.scrub or args.fetch:
+        args.quick = False # needs every Package file read
+    repM.lockMirror((args.update and not args.quick) or args.prune)
+    if args.quick and repM.quickStatus():
+        updated = repM.updated
+        args.update = False
+    else:
+        if args.quick:
+            print("No current status snapshot - checking mirror")
+            args.update = False
+        updated = repM.checkState(args.update)
+    repM.publishDists(changed_only=True)
+    if args.prune and not repM.staging:
+        repM.prune()
+    if args.scrub:
+        repM.scrub(args.timeout)
+        updated = repM.updated
+    if not updated:
         for r in repM.relfiles.values():
             if r.present:
                 print("Release %s" % r)
             else:
                 print('Skipping Release %s : Release file %s is missing' % (r.name, r.cfile.ofile))
-        if repM.missing:
+        published = True
+        if repM.staging: # resumed from an interrupted run
+            repM.lockMirror()
+            published = repM.publishDists(lazy=bool(args.serve))
+            repM.unlockMirror()
+        if len(repM.relfiles) > 0:
+            repM.saveStatus()
+        if args.serve:
+            repM.serve(args.serve)
+        if repM.missing or not published:
             print("%s: Repository Mirror at %s is incomplete"
                 % (repM.repository, repM.lmirror))
-            repM.cleanUp(1)
+            sys.exit(repM.cleanUp(1))
         else:
             print("%s: Repository Mirror at %s is up to date"
                 % (repM.repository, repM.lmirror))
-            repM.cleanUp(0)
+            if repM.journal:
+                repM.journal.compact()
+            sys.exit(repM.cleanUp(0))
 
     repM.cnt += len(repM.changed_dists)
     if repM.cnt > 0:
@@ -1258,65 +4606,28 @@ if __name__ == '__main__':
             else:
                 print('update failed!')
                 nfails += 1
+    repM.unlockMirror()
 
     if args.fetch:
-        if args.verbose:
-            print("%d releases" % len(repM.relfiles))
-            min_time = .1
-            repM.report_time = 5.
-        else:
-            min_time = 3.0
-            repM.report_time = 60.
-        for r in repM.relfiles.values():
-            if args.timeout and gettime() >= args.timeout:
-                print("Time out expired - skipping " + str(r))
-                continue;
-            if args.update and r.sig:
-                r.sig.update()
-            print("Fetching Release %s" % r)
-            if args.verbose:
-                print("%d package files:" % len(r.pkgFiles))
-            for p in r.pkgFiles.values():
-                if args.timeout and gettime() >= args.timeout:
-                    print("Time out expired skipping Package", p.name," ...")
-                    break
-                print("Checking package %s for missing debs" % (p.cfile.ofile))
-                if p.missing:
-                    print("Skip missing package %s" % (p.cfile.ofile))
-                    continue
-                for d in p.pkgs.values():
-                    if args.timeout and gettime() >= args.timeout:
-                        print("Time out expired skipping deb " + d.name + " ...")
-                        break
-                    p.total_fetched = 0
-                    p.last_report = p.fetch_start = gettime()
-                    if d.missing:
-                        print("Fetching %s - size %s" % (d.name, d.size))
-                        try:
-                            start = gettime()
-                            d.cfile.fetch()
-                            d.cfile.update()
-                            elapsed = gettime() - start
-                            p.total_fetched += int(d.size)
-                            if start - p.last_report > repM.report_time:
-                                av_speed = p.total_fetched/(start - p.fetch_start)
-                                print( "%s %s %s %3.1f % fetched Estimating %d seconds to complete" %
-                                    (p.name, p.arch, p.comp, 100*p.total_fetched/p.total_missing, (p.total_missing - p.total_fetched)/av_speed) )
-                            elif elapsed > min_time:
-                                speed = (8*int(d.size)/elapsed)/1000.
-                                if speed < 2000.0:
-                                    print("Downloaded in %.1f seconds = %.3f kbit/s" % (elapsed, speed))
-                                elif speed < 2000000.0:
-                                    print("Downloaded in %.3f seconds = %.3f Mbit/s" % (elapsed, speed/1000.))
-                                else:
-                                    print("Downloaded in %.6f seconds = %.3f Gbit/s" % (elapsed, speed/1000000.))
-
-                        except OSError:
-                            print("Failed to fetch %s" % d.name)
-                            nfails += 1
+        if args.access_logs or repM.access_logs: # for the popular debs to fetch first
+            repM.readAccessLogs(args.access_logs + repM.access_logs)
+        nfails += len(repM.fetchDebs(args.update, args.timeout))
+    if repM.staging:
+        repM.lockMirror()
+        if not repM.publishDists(lazy=bool(args.serve)):
+            nfails += 1
+        elif args.prune:
+            repM.prune()
+        repM.unlockMirror()
+    if len(repM.relfiles) > 0:
+        repM.saveStatus()
+    if args.serve:
+        repM.serve(args.serve)
 
     if nfails == 0:
-        repM.cleanUp(0)
-    repM.cleanUp(1)
+        if repM.journal and not repM.timedout:
+            repM.journal.compact()
+        sys.exit(repM.cleanUp(0))
     if args.timeout and gettime() >= args.timeout:
         print("Timed out expired - incomplete download");
+    sys.exit(repM.cleanUp(1))
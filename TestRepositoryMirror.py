@@ -1,15 +1,214 @@
 #! /usr/bin/python3
 
-import RepositoryMirror
+import os
+import io
+import sys
+import gzip
+import json
+import stat
+import time
+import hashlib
+import tempfile
+import threading
+import functools
+import contextlib
+import subprocess
+import http.server
 import unittest
+from RepositoryMirror import RepositoryMirror, CacheFile, RelFile, PkgFile, Options, UpstreamPool, \
+    MirrorDB, Throttle, PoolLocks, PkgEntry, flockFile, HostLimits, MirrorHandler, transient, \
+    retryDelay
 
 # dummy test repository
-drep = 'file:///test/dmirror'
+drep = 'file:test/dmirror'
 ddists = 'wheezy'.split()
 dcomp = 'main contrib'.split()
 darch = 'amd64'.split()
 dmirror = 'test/tmp-mirror'
 
+def mkRepository(top, dist='synth', npkgs=3, versions=1, size=4096, archs=('amd64', 'all'),
+        depends={}):
+    '''
+    Create a synthetic repository at top, as BenchRepositoryMirror.mkRepository does, with
+    distribution dist of npkgs packages in versions versions for each of archs in main.
+    depends - {package: its Depends field}
+    The Release file has MD5Sum and SHA256 lists and Acquire-By-Hash, a deb's contents
+    only depend on its Filename so a repository can be rebuilt with more versions.
+    Returns {Filename: contents} of the debs
+    '''
+    debs = {}
+    rel = []
+    for arch in archs:
+        entries = ''
+        for i in range(npkgs):
+            for v in range(versions):
+                name = 'pkg-%s-%d' % (arch, i)
+                fname = 'pool/main/p/%s/%s_1.%d-1_%s.deb' % (name, name, v, arch)
+                data = (fname.encode() * (size // len(fname) + 1))[:size - 100*i - v]
+                debs[fname] = data
+                os.makedirs(os.path.join(top, os.path.dirname(fname)), exist_ok=True)
+                with open(os.path.join(top, fname), 'wb') as f:
+                    f.write(data)
+                entries += ('Package: %s\nVersion: 1.%d-1\nArchitecture: %s\n%s'
+                    'Filename: %s\nSize: %d\nMD5sum: %s\n\n' %
+                    (name, v, arch, 'Depends: %s\n' % depends[name] if name in depends else '',
+                    fname, len(data), hashlib.md5(data).hexdigest()))
+        pname = 'main/binary-%s/Packages.gz' % arch
+        data = gzip.compress(entries.encode(), mtime=0)
+        path = os.path.join(top, 'dists', dist, pname)
+        hdir = os.path.join(os.path.dirname(path), 'by-hash', 'SHA256')
+        os.makedirs(hdir, exist_ok=True)
+        for p in (path, os.path.join(hdir, hashlib.sha256(data).hexdigest())):
+            with open(p, 'wb') as f:
+                f.write(data)
+        rel.append((pname, data))
+    with open(os.path.join(top, 'dists', dist, 'Release'), 'w') as f:
+        f.write('Origin: Test\nSuite: %s\nCodename: %s\nArchitectures: amd64\n'
+            'Components: main\nAcquire-By-Hash: yes\nDescription: Synthetic test repository\n'
+            % (dist, dist) + 'MD5Sum:\n' + ''.join(' %s %8d %s\n' %
+            (hashlib.md5(data).hexdigest(), len(data), pname) for pname, data in rel) +
+            'SHA256:\n' + ''.join(' %s %8d %s\n' %
+            (hashlib.sha256(data).hexdigest(), len(data), pname) for pname, data in rel))
+    with open(os.path.join(top, 'dists', dist, 'Release.gpg'), 'w') as f:
+        f.write('unsigned\n')
+    return debs
+
+class Upstream(http.server.SimpleHTTPRequestHandler):
+    '''
+    Serve a repository supporting single byte ranges (unless server.ranges is False)
+    after server.delay seconds. A path in server.fail gets its [status, count] response
+    count times (None => always), '*' matches every path. A path in server.stall sends
+    half its body and then stalls for a second, the next count times. The server records
+    the (path, Range) of each request and the peak number of requests waiting at once.
+    '''
+
+    def log_message(self, *a):
+        pass
+
+    def do_GET(self):
+        s = self.server
+        with s.lock:
+            s.requests.append((self.path, self.headers.get('Range')))
+            s.active += 1
+            s.peak = max(s.peak, s.active)
+            fail = s.fail.get(self.path) or s.fail.get('*')
+            if fail and fail[1] != None:
+                fail[1] -= 1
+                if fail[1] == 0:
+                    s.fail.pop(self.path, None) or s.fail.pop('*', None)
+            stall = s.stall.get(self.path, 0)
+            if stall:
+                s.stall[self.path] = stall - 1
+        try:
+            time.sleep(s.delay)
+        finally:
+            with s.lock:
+                s.active -= 1
+        rng = self.headers.get('Range')
+        if fail:
+            self.send_error(fail[0])
+        elif stall:
+            with open(self.translate_path(self.path), 'rb') as f:
+                data = f.read()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data[:len(data) // 2])
+            self.wfile.flush()
+            time.sleep(1.)
+        elif rng and s.ranges and os.path.isfile(self.translate_path(self.path)):
+            with open(self.translate_path(self.path), 'rb') as f:
+                data = f.read()
+            first, last = (int(x) for x in rng.split('=')[1].split('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (first, last, len(data)))
+            self.send_header('Content-Length', str(last + 1 - first))
+            self.end_headers()
+            self.wfile.write(data[first:last + 1])
+        else:
+            super().do_GET()
+
+def serve(top):
+    ''' Start serving directory top with Upstream in a thread - returns the server with its url '''
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+        functools.partial(Upstream, directory=top))
+    server.daemon_threads = True
+    server.requests, server.fail, server.ranges, server.delay = [], {}, True, 0.
+    server.stall = {}
+    server.active = server.peak = 0
+    server.lock = threading.Lock()
+    server.url = 'http://127.0.0.1:%d' % server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class SyntheticRepository(unittest.TestCase):
+    ''' Mirror a synthetic repository served over HTTP into a temporary directory '''
+
+    def setUp(self):
+        if not TestRepositoryMirror.v:
+            out = contextlib.redirect_stdout(io.StringIO())
+            out.__enter__()
+            self.addCleanup(out.__exit__, None, None, None)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.upstream = os.path.join(self.tmp.name, 'upstream')
+        self.debs = mkRepository(self.upstream)
+        self.server = serve(self.upstream)
+        self.lmirror = os.path.join(self.tmp.name, 'mirror')
+        self.mirrors = []
+        self.retry_base = CacheFile.retry_base
+        CacheFile.retry_base = 0.01
+
+    def tearDown(self):
+        CacheFile.retry_base = self.retry_base
+        for m in self.mirrors:
+            m.cleanUp()
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def mirror(self, create=True, options={}, **settings):
+        ''' Return a RepositoryMirror of the synthetic repository with settings and Options
+        options - its skeletonCheck() done if create '''
+        s = { 'repository' : self.server.url, 'distributions' : ['synth'],
+            'components' : ['main'], 'architectures' : ['amd64', 'all'],
+            'lmirror' : self.lmirror }
+        s.update(settings)
+        m = RepositoryMirror(options=Options(settings=s, **options))
+        self.mirrors.append(m)
+        if create:
+            self.assertTrue(m.skeletonCheck(create=True))
+        return m
+
+    def sync(self, m, fetch=True):
+        ''' Refresh mirror m and fetch its debs as a -fetch run does - returns the debs which failed '''
+        m.lockMirror()
+        m.checkState(True)
+        m.publishDists(changed_only=True)
+        for d, cfile in m.changed_dists:
+            self.assertTrue(cfile.update())
+        m.unlockMirror()
+        failed = m.fetchDebs(True) if fetch else []
+        for r in m.relfiles.values():
+            if not fetch and r.sig and r.sig.tfile and os.path.exists(r.sig.tfile):
+                r.sig.update() # as fetchDebs() does
+        if m.staging:
+            m.lockMirror()
+            m.publishDists()
+            m.unlockMirror()
+        return failed
+
+    def mirrorPath(self, path):
+        return os.path.join(self.lmirror, path)
+
+    def assertSame(self, path):
+        ''' Check file path of the mirror is the same as upstream's '''
+        with open(self.mirrorPath(path), 'rb') as f, open(os.path.join(self.upstream, path), 'rb') as u:
+            self.assertEqual(f.read(), u.read(), path)
+
+    def assertMirrored(self, debs=None):
+        for fname in (debs if debs != None else self.debs):
+            self.assertSame(fname)
+
 
 class TestRelFile(unittest.TestCase):
     ''' Read in a Release file and parse it correctly '''
@@ -35,5 +234,1357 @@ class TestPkgFile(unittest.TestCase):
         self.dist = ddists[0]
         self.rfile = self.rep.getReleasePath(self.dist)
 
+class TestRepositoryMirror(unittest.TestCase):
+    ''' Fetch, match and update the dummy repository's Release file into a fresh mirror '''
+    v = False
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.repMirror = RepositoryMirror(drep, ddists, dcomp, darch,
+            lmirror=os.path.join(self.tmp.name, 'mirror'))
+        self.pURL = self.repMirror.getPackageURL(ddists[0],
+            PkgFile(self.repMirror, 'main/binary-amd64/Packages.gz'))
+        self.rURL = self.repMirror.getReleaseURL(ddists[0])
+        self.cf = CacheFile(self.rURL, mirror=self.repMirror)
+
+    def tearDown(self):
+        self.repMirror.cleanUp()
+        self.tmp.cleanup()
+
+    def test_RepositoryMirror(self):
+        if TestRepositoryMirror.v: print("RepositoryMirror Tests")
+        if TestRepositoryMirror.v: print("getPackageURL() = " + self.pURL)
+        if TestRepositoryMirror.v: print("getReleaseURL() = " + self.rURL)
+        self.assertTrue(self.repMirror.skeletonCheck(create=True))
+
+    def test_CacheFile(self):
+        if TestRepositoryMirror.v: print("CacheFile Tests")
+        self.assertTrue(self.repMirror.skeletonCheck(create=True))
+
+        tfile = os.path.join(self.tmp.name, 'release.txt_new')
+        self.assertTrue(self.cf.fetch(tfile))
+        if TestRepositoryMirror.v: print("CacheFile - test fetch file to " + tfile)
+
+        # Test match will fail with no original
+        ofile = os.path.join(self.tmp.name, 'release.txt')
+        self.assertFalse(self.cf.match(ofile))
+
+        # Test update will work create original when it doesn't exist
+        self.assertTrue(self.cf.update(ofile))
+
+        # Test re-fetch will now match
+        self.assertTrue(self.cf.fetch(tfile))
+        self.assertTrue(self.cf.match(ofile))
+
+    def test_RelFile(self):
+        if TestRepositoryMirror.v: print("RelFile Tests")
+        r = 'test/dmirror/dists/wheezy/Release'
+        self.assertTrue(os.access(r, os.R_OK))
+        rf = RelFile(self.repMirror, ddists[0], r, None)
+        if TestRepositoryMirror.v:
+            for k in rf.info.keys():
+                print('%s - %s' % (k, rf.info[k]))
+        self.assertEqual(rf.codename, 'wheezy')
+        self.assertIn('contrib/binary-amd64/Packages.gz', rf.pkgFiles)
+
+    def test_PkgFile(self):
+        if TestRepositoryMirror.v: print("Package File Tests")
+        self.assertTrue(self.repMirror.skeletonCheck(create=True))
+        r = os.path.join(self.tmp.name, 'Packages.gz')
+        deb = b'not really a deb'
+        with gzip.open(r, 'wb') as f:
+            f.write(b'Package: hello\nVersion: 1.0\nArchitecture: amd64\n'
+                b'Filename: pool/main/h/hello/hello_1.0_amd64.deb\n'
+                b'Size: %d\nMD5sum: %s\n\n' % (len(deb), hashlib.md5(deb).hexdigest().encode()))
+        pf = PkgFile(self.repMirror, 'main/binary-amd64/Packages.gz')
+        pf.rdPkgFile(r)
+        self.assertEqual(list(pf.pkgs), ['pool/main/h/hello/hello_1.0_amd64.deb'])
+        self.assertEqual(pf.cnt, 1) # missing from the mirror
+
+class TestLocalFetch(unittest.TestCase):
+    ''' Fetch a file from a file: repository by hard linking or copying it '''
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmp.name, 'upstream', 'x.deb')
+        os.makedirs(os.path.dirname(self.src))
+        with open(self.src, 'wb') as f:
+            f.write(b'a deb')
+        os.chmod(self.src, 0o644)
+        self.repMirror = RepositoryMirror(drep, ddists, dcomp, darch,
+            lmirror=os.path.join(self.tmp.name, 'mirror'))
+        self.assertTrue(self.repMirror.skeletonCheck(create=True))
+        self.cf = CacheFile('file:' + self.src, mirror=self.repMirror,
+            ofile=os.path.join(self.repMirror.lmirror, 'x.deb'))
+
+    def tearDown(self):
+        CacheFile.hardlink = True
+        self.repMirror.cleanUp()
+        self.tmp.cleanup()
+
+    def test_link(self):
+        self.assertTrue(self.cf.fetch())
+        self.assertTrue(self.cf.update())
+        self.assertTrue(os.path.samefile(self.src, self.cf.ofile))
+        # the upstream's file is not made read only
+        self.assertEqual(stat.S_IMODE(os.stat(self.src).st_mode), 0o644)
+
+    def test_copy(self):
+        CacheFile.hardlink = False
+        self.assertTrue(self.cf.fetch())
+        self.assertTrue(self.cf.update())
+        self.assertFalse(os.path.samefile(self.src, self.cf.ofile))
+        with open(self.cf.ofile, 'rb') as f:
+            self.assertEqual(f.read(), b'a deb')
+        self.assertEqual(stat.S_IMODE(os.stat(self.cf.ofile).st_mode), 0o444)
+
+    def test_missing(self):
+        os.remove(self.src)
+        tfile = self.cf.mkTemp()
+        self.assertFalse(self.cf.fetch())
+        self.assertTrue(os.path.exists(tfile))
+        self.assertFalse(os.path.exists(self.cf.ofile))
+
+class TestMetadata(SyntheticRepository):
+    ''' Release and Package files of all the distributions are fetched and read concurrently '''
+
+    def test_refresh(self):
+        m = self.mirror(workers=4)
+        self.assertEqual(self.sync(m), [])
+        for p in ('Release', 'main/binary-amd64/Packages.gz', 'main/binary-all/Packages.gz'):
+            self.assertSame('dists/synth/' + p)
+        self.assertMirrored()
+        # a second run finds nothing to update
+        self.assertFalse(self.mirror(workers=4).checkState(True))
+
+    def test_update(self):
+        self.sync(self.mirror(workers=4))
+        debs = mkRepository(self.upstream, versions=2)
+        m = self.mirror(workers=4)
+        state = m.checkState(True)
+        self.assertTrue(state)
+        new = [fn for fn in debs if fn not in self.debs]
+        self.assertEqual((state.changed, state.failed, state.missing, state.missing_bytes),
+            (3, 0, len(new), sum(len(debs[fn]) for fn in new)))
+        self.assertEqual(sorted(p.name for p in m.relfiles['synth'].pkgFiles.values() if p.modified),
+            ['main/binary-all/Packages.gz', 'main/binary-amd64/Packages.gz'])
+        self.assertEqual(sum(p.cnt for p in m.relfiles['synth'].pkgFiles.values()), 6)
+        self.assertEqual(self.sync(self.mirror(workers=4)), [])
+        self.assertSame('dists/synth/Release')
+        self.assertMirrored(debs)
+
+    def test_serial(self):
+        self.assertEqual(self.sync(self.mirror(workers=1)), [])
+        self.assertMirrored()
+
+class TestOptions(SyntheticRepository):
+    ''' Each RepositoryMirror has its own Options - mirrors with different ones can run side by side '''
+
+    def test_failed(self):
+        os.unlink(os.path.join(self.upstream, 'dists/synth/main/binary-all/Packages.gz'))
+        import shutil
+        shutil.rmtree(os.path.join(self.upstream, 'dists/synth/main/binary-all/by-hash'))
+        state = self.mirror().checkState(True)
+        self.assertTrue(state)
+        self.assertEqual((state.changed, state.failed, state.missing), (2, 1, 3))
+
+    def test_threads(self):
+        dry = os.path.join(self.tmp.name, 'dry')
+        self.mirror(lmirror=dry) # its skeleton, for the dry run to check
+        mirrors = [self.mirror(options={ 'verbose' : True }, workers=2),
+            self.mirror(options={ 'dry_run' : True }, lmirror=dry)]
+        failed = {}
+        threads = [threading.Thread(target=lambda m=m: failed.update({m.lmirror : self.sync(m)}))
+            for m in mirrors]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(failed, { self.lmirror : [], dry : [] })
+        self.assertMirrored()
+        self.assertFalse(os.path.exists(os.path.join(dry, 'dists/synth/Release')))
+        for fname in self.debs:
+            self.assertFalse(os.path.exists(os.path.join(dry, fname)))
+        self.assertTrue(mirrors[0].options.verbose and not mirrors[0].options.dry_run)
+        self.assertTrue(mirrors[1].options.dry_run and not mirrors[1].options.verbose)
+
+class TestMirrorDB(SyntheticRepository):
+    ''' The mirror database records what is in the mirror so it need not be read again '''
+
+    def test_sync(self):
+        m = self.mirror()
+        self.sync(m)
+        for fname, data in self.debs.items():
+            self.assertTrue(m.db.verified(self.mirrorPath(fname), len(data),
+                hashlib.md5(data).hexdigest()))
+        self.assertEqual(m.db.query('SELECT count(*) FROM refs')[0][0], len(self.debs))
+        self.assertEqual(m.db.query("SELECT count(*) FROM fetches WHERE ok AND path LIKE 'pool/%'")[0][0],
+            len(self.debs))
+
+    def test_verified(self):
+        db = MirrorDB(self.tmp.name)
+        self.addCleanup(db.close)
+        f = os.path.join(self.tmp.name, 'x.deb')
+        with open(f, 'w') as of:
+            of.write('abc')
+        self.assertFalse(db.verified(f, md5sum='m'))
+        db.recordFile(f, 'm')
+        self.assertTrue(db.verified(f, 3, 'm'))
+        self.assertFalse(db.verified(f, 4, 'm'))
+        self.assertFalse(db.verified(f, 3, 'other'))
+        os.utime(f, ns=(0, 0)) # changed since
+        self.assertFalse(db.verified(f, 3, 'm'))
+        db.recordFile(f, 'm')
+        db.forget(f)
+        self.assertFalse(db.verified(f, 3, 'm'))
+
+    def test_info(self):
+        os.makedirs(self.mirrorPath('dists/synth'))
+        m = self.mirror(create=False)
+        m.dump_info()
+        m.cleanUp()
+        self.assertEqual(sorted(os.listdir(self.lmirror)), ['dists'])
+
+class TestQuick(SyntheticRepository):
+    ''' -quick repeats the last check's answer from its status snapshot by only stat'ing files '''
+
+    def setUp(self):
+        super().setUp()
+        m = self.mirror()
+        self.sync(m)
+        m.saveStatus()
+        self.status = self.mirrorPath(RepositoryMirror.STATUS)
+
+    def test_hit(self):
+        m = self.mirror()
+        self.assertTrue(m.quickStatus())
+        self.assertEqual((m.updated, m.missing, m.cnt), (False, False, 0))
+        with open(self.status) as f:
+            status = f.read()
+        for fname in self.debs: # the database has the Filenames
+            self.assertNotIn(fname, status)
+
+    def test_missing(self):
+        fname = sorted(self.debs)[0]
+        os.unlink(self.mirrorPath(fname))
+        m = self.mirror()
+        m.checkState(False)
+        m.saveStatus()
+        m = self.mirror()
+        self.assertTrue(m.quickStatus())
+        self.assertEqual((m.updated, m.cnt), (True, 1))
+
+    def test_stale(self):
+        with open(self.status) as f:
+            status = json.load(f)
+        status['time'] -= RepositoryMirror.status_max_age + 1
+        with open(self.status, 'w') as f:
+            json.dump(status, f)
+        self.assertFalse(self.mirror().quickStatus())
+
+    def test_changed(self):
+        pkg = self.mirrorPath('dists/synth/main/binary-all/Packages.gz')
+        st = os.stat(pkg)
+        os.utime(pkg, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        self.assertFalse(self.mirror().quickStatus())
+        os.utime(pkg, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertTrue(self.mirror().quickStatus())
+        os.unlink(self.mirrorPath(sorted(self.debs)[0]))
+        self.assertFalse(self.mirror().quickStatus())
+
+    def test_no_database(self):
+        self.assertFalse(self.mirror(options={ 'very_dry_run' : True }).quickStatus())
+
+class TestPrune(SyntheticRepository):
+    ''' -prune quarantines debs no Package file uses and deletes them after prune_grace '''
+
+    def prune(self, grace, **settings):
+        m = self.mirror(**settings)
+        self.sync(m, fetch=False)
+        return m.prune(grace)
+
+    def quarantined(self):
+        qdir = self.mirrorPath(RepositoryMirror.QUARANTINE)
+        return sorted(os.path.relpath(os.path.join(top, f), qdir)
+            for top, dirs, files in os.walk(qdir) for f in files)
+
+    def test_shared_mirror(self):
+        # two configurations mirror different architectures of a distribution into one mirror
+        self.sync(self.mirror(architectures=['amd64']))
+        self.sync(self.mirror(architectures=['all']))
+        self.assertEqual(self.prune(0, architectures=['amd64']), (0, 0))
+        self.assertEqual(self.prune(0, architectures=['all']), (0, 0))
+        self.assertMirrored()
+
+    def test_missing_architecture(self):
+        self.sync(self.mirror())
+        self.assertEqual(self.prune(0, architectures=['amd64', 'i386']), (0, 0))
+        self.assertEqual(self.quarantined(), [])
+        self.assertMirrored()
+
+    def test_nothing_live(self):
+        self.sync(self.mirror())
+        mkRepository(self.upstream, npkgs=0)
+        self.assertEqual(self.prune(0), (0, 0))
+        self.assertMirrored()
+
+    def test_quarantine(self):
+        debs = mkRepository(self.upstream, versions=2)
+        self.sync(self.mirror())
+        mkRepository(self.upstream)
+        old = sorted(fn for fn in debs if fn not in self.debs)
+        self.assertEqual(self.prune(3600), (0, 0))
+        self.assertEqual(self.quarantined(), old)
+        for fn in old:
+            self.assertFalse(os.path.exists(self.mirrorPath(fn)))
+        self.assertMirrored()
+
+        # used again - moved back into the pool
+        mkRepository(self.upstream, versions=2)
+        self.assertEqual(self.prune(3600), (0, 0))
+        self.assertEqual(self.quarantined(), [])
+        self.assertMirrored(debs)
+
+        # deleted once the grace period is over
+        mkRepository(self.upstream)
+        self.prune(3600)
+        qdir = self.mirrorPath(RepositoryMirror.QUARANTINE)
+        os.utime(os.path.join(qdir, old[0]), (0, 0))
+        self.assertEqual(self.prune(3600), (1, len(debs[old[0]])))
+        self.assertEqual(self.quarantined(), old[1:])
+        self.assertMirrored()
+
+    def pkgList(self, *names):
+        ''' Return settings for a packages-synth list of names extended by their dependencies '''
+        path = os.path.join(self.tmp.name, 'pkg-list')
+        with open(path, 'w') as f:
+            f.write('\n'.join(names) + '\n')
+        return { 'pkgLists' : { 'synth' : path }, 'closure' : {'synth'} }
+
+    def test_closure(self):
+        debs = mkRepository(self.upstream, depends={ 'pkg-amd64-0' : 'pkg-all-1 (>= 1.0)' })
+        self.sync(self.mirror())
+        self.assertMirrored(debs)
+        closure = [fn for fn in debs if '/pkg-amd64-0/' in fn or '/pkg-all-1/' in fn]
+        self.assertEqual(len(closure), 2)
+        self.assertEqual(self.prune(0, **self.pkgList('pkg-amd64-0')),
+            (len(debs) - 2, sum(len(debs[fn]) for fn in debs if fn not in closure)))
+        self.assertMirrored(closure)
+        for fn in debs:
+            self.assertEqual(os.path.exists(self.mirrorPath(fn)), fn in closure, fn)
+
+    def test_keep_versions(self):
+        debs = mkRepository(self.upstream, versions=3)
+        self.sync(self.mirror())
+        self.assertMirrored(debs)
+        kept = [fn for fn in debs if '_1.0-1_' not in fn]
+        self.assertEqual(self.prune(0, keep_versions={ 'synth' : 2 }),
+            (len(debs) - len(kept), sum(len(debs[fn]) for fn in debs if fn not in kept)))
+        self.assertMirrored(kept)
+        self.assertEqual(self.prune(0, keep_versions={ 'synth' : 2 }), (0, 0))
+        self.assertMirrored(kept)
+
+    def test_staged(self):
+        # another run has fetched the debs of a new version but not yet published its snapshot
+        self.sync(self.mirror(snapshots=True))
+        debs = mkRepository(self.upstream, versions=2)
+        m = self.mirror(snapshots=True)
+        m.lockMirror(False)
+        m.checkState(True)
+        m.publishDists(changed_only=True)
+        m.unlockMirror()
+        self.assertEqual(m.fetchDebs(True), [])
+        p = self.mirror(snapshots=True)
+        p.lockMirror()
+        p.checkState(False) # -prune -norefresh reads the published Package files
+        self.assertEqual(p.prune(0), (0, 0))
+        p.unlockMirror()
+        m.lockMirror()
+        self.assertTrue(m.publishDists())
+        m.unlockMirror()
+        self.assertEqual(m.published.keys(), {'synth'})
+        self.assertMirrored(debs)
+
+class TestScrub(SyntheticRepository):
+    ''' -scrub re-verifies a slice of the pool at a limited rate and refetches corrupt debs '''
+
+    def setUp(self):
+        super().setUp()
+        m = self.mirror()
+        self.sync(m)
+        with m.db.con: # verified long ago when fetched
+            m.db.con.execute('UPDATE files SET verified = 0')
+        self.total = sum(len(data) for data in self.debs.values())
+
+    def scrubber(self):
+        m = self.mirror()
+        self.sync(m, fetch=False)
+        return m
+
+    def test_throttle(self):
+        self.assertEqual(Throttle(0).delay(10**9), 0.)
+        t = Throttle(1000)
+        self.assertLess(t.delay(500), 0.01)
+        self.assertTrue(0.4 < t.delay(500) <= 0.5)
+
+    def test_corrupt(self):
+        fname = sorted(self.debs)[0]
+        path = self.mirrorPath(fname)
+        os.chmod(path, 0o644)
+        with open(path, 'r+b') as f:
+            f.write(b'X') # same size
+        m = self.scrubber()
+        self.assertEqual(m.scrub(), (len(self.debs), self.total, 1))
+        self.assertTrue(os.path.exists(os.path.join(self.mirrorPath(RepositoryMirror.QUARANTINE),
+            'corrupt', fname)))
+        self.assertEqual(m.fetchDebs(True), [])
+        self.assertMirrored()
+
+    def test_slices(self):
+        self.assertEqual(self.scrubber().scrub(), (len(self.debs), self.total, 0))
+        # all of them were just verified
+        self.assertEqual(self.scrubber().scrub(), (0, 0, 0))
+
+    def test_rate(self):
+        start = time.time()
+        self.assertEqual(self.scrubber().scrub(rate=2*self.total), (len(self.debs), self.total, 0))
+        self.assertGreater(time.time() - start, 0.4)
+
+class TestLocks(SyntheticRepository):
+    ''' Runs against one mirror share it through the mirror lock and the pool bucket locks '''
+
+    def test_pool_locks(self):
+        os.makedirs(self.lmirror)
+        a, b = PoolLocks(self.lmirror), PoolLocks(self.lmirror)
+        fname = sorted(self.debs)[0]
+        self.assertTrue(a.acquire(fname))
+        self.assertFalse(b.acquire(fname))
+        a.release(fname)
+        self.assertTrue(b.acquire(fname))
+        b.release(fname)
+        # debs of one bucket fetched by threads of one run - and one deb twice
+        other = next(fn for fn in ('pool/x/x%d.deb' % i for i in range(10000))
+            if a.bucket(fn) == a.bucket(fname))
+        self.assertTrue(a.acquire(fname))
+        self.assertTrue(a.acquire(other))
+        self.assertTrue(a.acquire(other))
+        self.assertEqual(len(a.held), 1)
+        a.release(other)
+        a.release(fname)
+        self.assertFalse(b.acquire(fname))
+        a.release(other)
+        self.assertEqual(a.held, {})
+        self.assertTrue(b.acquire(other))
+        b.release(other)
+
+    def test_mirror_lock(self):
+        m = self.mirror()
+        path = self.mirrorPath(RepositoryMirror.LOCK)
+        def locked(exclusive):
+            fd = flockFile(path, exclusive, blocking=False)
+            if fd != None:
+                os.close(fd)
+            return fd == None
+        m.lockMirror(False)
+        self.assertFalse(locked(False))
+        self.assertTrue(locked(True))
+        m.lockMirror(True)
+        self.assertTrue(locked(False))
+        m.unlockMirror()
+        self.assertFalse(locked(True))
+
+    def test_deferred(self):
+        fname = sorted(self.debs)[0]
+        m = self.mirror(engine='threaded')
+        other = PoolLocks(self.lmirror) # another run is fetching into fname's bucket
+        self.assertTrue(other.acquire(fname))
+        out = io.StringIO()
+        def release():
+            ''' Release the bucket once the run waits for it, however long it took to get there '''
+            for i in range(200):
+                if "Waiting for the pool locks of" in out.getvalue():
+                    break
+                time.sleep(0.05)
+            other.release(fname)
+        threading.Thread(target=release, daemon=True).start()
+        with contextlib.redirect_stdout(out):
+            self.assertEqual(self.sync(m), [])
+        self.assertIn("Waiting for the pool locks of", out.getvalue())
+        self.assertMirrored()
+
+    def test_concurrent_runs(self):
+        self.server.delay = 0.05
+        mirrors = [self.mirror(engine='threaded') for i in range(2)]
+        runs = [threading.Thread(target=self.sync, args=(m,)) for m in mirrors]
+        for t in runs:
+            t.start()
+        for t in runs:
+            t.join()
+        self.assertMirrored()
+        fetched = [p for p, r in self.server.requests if p.startswith('/pool/')]
+        self.assertEqual(sorted(fetched), sorted('/' + fn for fn in self.debs))
+
+class TestRetry(SyntheticRepository):
+    ''' Transient failures are retried with backoff, requests per host are limited and
+    failing upstreams are paused '''
+
+    def requests(self, fname):
+        return [p for p, r in self.server.requests if p == '/' + fname]
+
+    def test_transient(self):
+        import urllib.error
+        self.assertTrue(transient(urllib.error.HTTPError('u', 503, 'busy', {}, None)))
+        self.assertFalse(transient(urllib.error.HTTPError('u', 404, 'missing', {}, None)))
+        self.assertTrue(transient(ConnectionResetError()))
+        self.assertFalse(transient(FileNotFoundError()))
+
+    def test_delay(self):
+        import urllib.error
+        CacheFile.retry_base = 1.
+        self.assertTrue(all(0 <= retryDelay(a) <= min(CacheFile.retry_max, 2**(a - 1))
+            for a in range(1, 12) for i in range(20)))
+        busy = urllib.error.HTTPError('u', 503, 'busy', {'retry-after' : '5'}, None)
+        self.assertGreaterEqual(retryDelay(1, busy), 5.)
+
+    def test_retried(self):
+        fname = sorted(self.debs)[0]
+        self.server.fail['/' + fname] = [503, 2]
+        self.assertEqual(self.sync(self.mirror()), [])
+        self.assertMirrored()
+        self.assertEqual(len(self.requests(fname)), 3)
+
+    def test_not_retried(self):
+        fname = sorted(self.debs)[0]
+        self.server.fail['/' + fname] = [404, None]
+        failed = self.sync(self.mirror())
+        self.assertEqual([d.fname for d in failed], [fname])
+        self.assertLess(len(self.requests(fname)), 1 + CacheFile.retries)
+        self.assertMirrored(fn for fn in self.debs if fn != fname)
+
+    def test_breaker(self):
+        pool = UpstreamPool(['http://a'])
+        for i in range(UpstreamPool.DEMOTE_FAILS):
+            self.assertTrue(pool.allow('http://a'))
+            pool.report('http://a', False)
+        self.assertFalse(pool.allow('http://a'))
+        self.assertGreater(pool.pausedFor(), 0.)
+        pool.demoted['http://a'] = 0. # pause over
+        self.assertTrue(pool.allow('http://a')) # one trial request
+        self.assertFalse(pool.allow('http://a'))
+        pool.report('http://a', True, 100, 1.)
+        self.assertTrue(pool.allow('http://a'))
+        self.assertTrue(pool.allow('http://a'))
+
+    def limited(self, engine):
+        connections = HostLimits.connections
+        HostLimits.connections = 2
+        self.addCleanup(setattr, HostLimits, 'connections', connections)
+        self.server.delay = 0.05
+        self.assertEqual(self.sync(self.mirror(engine=engine, workers=8)), [])
+        self.assertMirrored()
+        self.assertEqual(self.server.peak, 2)
+
+    def test_host_limits(self):
+        self.limited('threaded')
+
+    def stalled(self, engine):
+        timeout = CacheFile.timeout
+        CacheFile.timeout = 0.2
+        self.addCleanup(setattr, CacheFile, 'timeout', timeout)
+        fname = sorted(self.debs)[0]
+        self.server.stall['/' + fname] = 1
+        start = time.time()
+        self.assertEqual(self.sync(self.mirror(engine=engine)), [])
+        self.assertLess(time.time() - start, 1.)
+        self.assertMirrored()
+        self.assertEqual(len(self.requests(fname)), 2)
+
+    def test_stalled(self):
+        self.stalled('threaded')
+
+    def test_stalled_async(self):
+        self.stalled('async')
+
+    def test_host_limits_async(self):
+        self.limited('async')
+
+class TestJournal(SyntheticRepository):
+    ''' A run after one that was interrupted replays its journal rather than redo its work '''
+
+    def test_resume(self):
+        failed = sorted(self.debs)[:2]
+        fetched = sorted(fn for fn in self.debs if fn not in failed)
+        for fname in failed:
+            self.server.fail['/' + fname] = [404, None]
+        m = self.mirror()
+        self.assertEqual(sorted(d.fname for d in self.sync(m)), failed)
+        # killed - so the journal is not emptied, and the mirror database lost its last writes
+        self.mirrors.remove(m)
+        m.cleanUp()
+        db = MirrorDB(self.lmirror)
+        with db.con:
+            db.con.execute('DELETE FROM files')
+        db.close()
+        self.server.fail.clear()
+        m = self.mirror()
+        self.assertLessEqual(set(fetched), set(m.resumed))
+        self.assertTrue(all(m.db.verified(self.mirrorPath(fn), md5sum=m.resumed[fn])
+            for fn in fetched))
+        self.assertEqual(self.sync(m), [])
+        self.assertMirrored()
+        self.assertEqual(sorted(p for p, r in self.server.requests if p[1:] in fetched),
+            ['/' + fn for fn in fetched])
+
+class TestSnapshots(SyntheticRepository):
+    ''' Release and Package files are staged in a snapshot and published by switching a symlink '''
+
+    def live(self):
+        return os.path.realpath(self.mirrorPath('dists/synth'))
+
+    def snapshots(self):
+        return sorted(os.listdir(self.mirrorPath('.snapshots/synth')))
+
+    def done(self, m):
+        ''' End the run of mirror m as it would exit - releasing its journal '''
+        self.mirrors.remove(m)
+        m.cleanUp()
+
+    def test_stage(self):
+        self.assertEqual(self.sync(self.mirror(snapshots=True)), [])
+        self.assertTrue(os.path.islink(self.mirrorPath('dists/synth')))
+        self.assertEqual(os.path.dirname(self.live()), self.mirrorPath('.snapshots/synth'))
+        self.assertSame('dists/synth/Release')
+        self.assertSame('dists/synth/main/binary-amd64/Packages.gz')
+        self.assertMirrored()
+
+    def test_publish(self):
+        self.sync(self.mirror(snapshots=True))
+        old, before = self.live(), self.snapshots()
+        self.debs = mkRepository(self.upstream, versions=2)
+        self.assertEqual(self.sync(self.mirror(snapshots=True)), [])
+        self.assertNotEqual(self.live(), old)
+        self.assertSame('dists/synth/Release')
+        self.assertMirrored()
+        # the old one is kept for clients part way through reading it
+        self.assertEqual(self.snapshots(), sorted(before + [os.path.basename(self.live())]))
+
+    def test_expire(self):
+        self.sync(self.mirror(snapshots=True))
+        mkRepository(self.upstream, versions=2)
+        self.sync(self.mirror(snapshots=True, snapshot_keep=0))
+        self.assertEqual(self.snapshots(), [os.path.basename(self.live())])
+
+    def test_unchanged(self):
+        self.sync(self.mirror(snapshots=True))
+        old, before = self.live(), self.snapshots()
+        self.sync(self.mirror(snapshots=True))
+        self.assertEqual(self.live(), old)
+        self.assertEqual(self.snapshots(), before)
+
+    def test_missing_pool(self):
+        m = self.mirror(snapshots=True)
+        self.sync(m)
+        m.journal.compact()
+        self.done(m)
+        old, before = self.live(), self.snapshots()
+        self.debs = mkRepository(self.upstream, versions=2)
+        gone = sorted(self.debs)[-1]
+        data = self.debs[gone]
+        os.unlink(os.path.join(self.upstream, gone))
+        m = self.mirror(snapshots=True)
+        self.assertEqual([deb.name for deb in self.sync(m)], [gone.split('/')[3]])
+        self.assertEqual(self.live(), old)
+        self.assertEqual(len(self.snapshots()), len(before) + 1)
+        self.done(m)
+        self.assertEqual(len(self.snapshots()), len(before) + 1)
+        # the next run carries on with the snapshot left
+        with open(os.path.join(self.upstream, gone), 'wb') as f:
+            f.write(data)
+        m = self.mirror(snapshots=True)
+        self.assertEqual(self.sync(m), [])
+        self.assertNotEqual(self.live(), old)
+        self.assertEqual(self.snapshots(), sorted(before + [os.path.basename(self.live())]))
+        self.assertMirrored()
+
+    def test_cleanup(self):
+        self.sync(self.mirror(snapshots=True))
+        before = self.snapshots()
+        m = self.mirror(snapshots=True)
+        m.checkState(True)
+        self.done(m)
+        self.assertEqual(self.snapshots(), before)
+        mkRepository(self.upstream, versions=2)
+        m = self.mirror(snapshots=True)
+        m.checkState(True)
+        self.done(m) # a failed run keeps the changes it staged
+        self.assertEqual(len(self.snapshots()), len(before) + 1)
+
+class TestByHash(SyntheticRepository):
+    ''' Package files of a Release with Acquire-By-Hash are fetched and published by-hash '''
+
+    PKG = 'dists/synth/main/binary-amd64/Packages.gz'
+
+    def byHash(self):
+        with open(os.path.join(self.upstream, TestByHash.PKG), 'rb') as f:
+            return os.path.join(os.path.dirname(TestByHash.PKG), 'by-hash', 'SHA256',
+                hashlib.sha256(f.read()).hexdigest())
+
+    def published(self):
+        return sorted(os.listdir(self.mirrorPath(os.path.dirname(self.byHash()))))
+
+    def test_fetch(self):
+        self.assertEqual(self.sync(self.mirror()), [])
+        paths = [p for p, r in self.server.requests]
+        self.assertIn('/' + self.byHash(), paths)
+        self.assertNotIn('/' + TestByHash.PKG, paths)
+        self.assertSame(TestByHash.PKG)
+        self.assertMirrored()
+
+    def test_fallback(self):
+        import shutil
+        shutil.rmtree(os.path.join(self.upstream, os.path.dirname(self.byHash())))
+        self.assertEqual(self.sync(self.mirror()), [])
+        self.assertIn('/' + TestByHash.PKG, [p for p, r in self.server.requests])
+        self.assertSame(TestByHash.PKG)
+
+    def test_publish(self):
+        self.sync(self.mirror())
+        first = self.byHash()
+        self.assertTrue(os.path.samefile(self.mirrorPath(first), self.mirrorPath(TestByHash.PKG)))
+        mkRepository(self.upstream, versions=2)
+        self.sync(self.mirror())
+        second = self.byHash()
+        self.assertTrue(os.path.samefile(self.mirrorPath(second), self.mirrorPath(TestByHash.PKG)))
+        # clients with the old Release can still fetch the old Package file
+        self.assertEqual(self.published(), sorted(os.path.basename(p) for p in (first, second)))
+        self.sync(self.mirror(snapshot_keep=0))
+        self.assertEqual(self.published(), [os.path.basename(second)])
+
+class TestServe(SyntheticRepository):
+    ''' -serve fetches each missing deb the first time it is requested '''
+
+    def setUp(self):
+        super().setUp()
+        self.m = self.serving()
+        handler = type('Handler', (MirrorHandler, http.server.SimpleHTTPRequestHandler),
+            {'log_message' : lambda self, *args: None})
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+            functools.partial(handler, directory=self.lmirror))
+        self.httpd.daemon_threads = True
+        self.httpd.mirror = self.m
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.recheck = RepositoryMirror.SERVE_RECHECK
+
+    def tearDown(self):
+        RepositoryMirror.SERVE_RECHECK = self.recheck
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        super().tearDown()
+
+    def serving(self):
+        ''' Return a mirror with its Package files read and none of its debs, as serve() has it '''
+        m = self.mirror()
+        self.sync(m, fetch=False)
+        m.poolLocks = PoolLocks(self.lmirror)
+        m.indexDebs()
+        return m
+
+    def get(self, path):
+        import urllib.request, urllib.error
+        try:
+            with urllib.request.urlopen('http://127.0.0.1:%d/%s' % (self.httpd.server_address[1], path)) as r:
+                return r.status, r.read()
+        except urllib.error.HTTPError as e:
+            e.close()
+            return e.code, None
+
+    def test_serve(self):
+        for fname, data in self.debs.items():
+            self.assertEqual(self.get(fname), (200, data))
+        self.assertMirrored()
+        self.assertEqual(self.get('dists/synth/Release')[0], 200)
+
+    def test_not_served(self):
+        self.assertEqual(self.get('pool/main/p/none/none_1.0-1_amd64.deb')[0], 404)
+        self.assertEqual(self.get('.mirror.db')[0], 404)
+        os.unlink(os.path.join(self.upstream, sorted(self.debs)[0]))
+        self.assertEqual(self.get(sorted(self.debs)[0])[0], 502)
+
+    def test_fill_once(self):
+        fname = sorted(self.debs)[0]
+        self.server.delay = 0.2
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.m.fillDeb(fname)))
+            for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [True] * 4)
+        self.assertEqual([p for p, r in self.server.requests].count('/' + fname), 1)
+        self.assertMirrored([fname])
+
+    def test_refresh(self):
+        RepositoryMirror.SERVE_RECHECK = 0
+        self.debs = mkRepository(self.upstream, versions=2)
+        self.sync(self.mirror(), fetch=False) # another run publishes new Package files
+        new = [fn for fn in self.debs if fn not in self.m.served]
+        self.assertTrue(new)
+        results, errors = [], []
+        def fill(fname):
+            try:
+                results.append(self.m.fillDeb(fname))
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=fill, args=(fn,)) for fn in sorted(self.debs)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(results, [True] * len(self.debs))
+        self.assertEqual(sorted(self.m.served), sorted(self.debs))
+        self.assertMirrored()
+
+class TestDeltas(SyntheticRepository):
+    ''' New versions of debs in the pool are rebuilt from the old ones and deltas '''
+
+    # debpatch DELTA OLD NEW - the deltas made below are the new deb itself
+    DEBPATCH = '#!/bin/sh\ntest -f "$2" || exit 1\ncat "$1" > "$3"\n'
+
+    def setUp(self):
+        super().setUp()
+        self.debpatch = os.path.join(self.tmp.name, 'debpatch')
+        with open(self.debpatch, 'w') as f:
+            f.write(TestDeltas.DEBPATCH)
+        os.chmod(self.debpatch, 0o755)
+        self.sync(self.mirror())
+        self.old = self.debs
+        self.debs = mkRepository(self.upstream, versions=2)
+        self.new = sorted(fn for fn in self.debs if fn not in self.old)
+
+    def mkDeltas(self, data=None):
+        ''' Put a delta from the old to the new version of each deb upstream - data if given '''
+        for fn in self.new:
+            name, version, arch = os.path.basename(fn)[:-len('.deb')].split('_')
+            path = os.path.join(self.upstream, 'deltas', os.path.dirname(fn),
+                '%s_1.0-1_%s_%s.debdelta' % (name, version, arch))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(self.debs[fn] if data == None else data)
+
+    def fetched(self):
+        ''' Return the debs fetched whole from upstream '''
+        return sorted(p[1:] for p, r in self.server.requests if p[1:] in self.debs)
+
+    def deltaMirror(self, **settings):
+        return self.mirror(delta_source=self.server.url + '/deltas', debpatch=self.debpatch,
+            **settings)
+
+    def test_rebuild(self):
+        self.mkDeltas()
+        self.server.requests = []
+        m = self.deltaMirror()
+        self.assertEqual(self.sync(m), [])
+        self.assertEqual(m.deltas[0], len(self.new))
+        self.assertEqual(self.fetched(), [])
+        self.assertMirrored()
+
+    def test_bad_delta(self):
+        self.mkDeltas(b'not the deb')
+        self.server.requests = []
+        m = self.deltaMirror()
+        self.assertEqual(self.sync(m), [])
+        self.assertEqual(m.deltas[0], 0)
+        self.assertEqual(self.fetched(), self.new)
+        self.assertMirrored()
+
+    def test_no_delta(self):
+        self.server.requests = []
+        m = self.deltaMirror()
+        self.assertEqual(self.sync(m), [])
+        self.assertEqual(self.fetched(), self.new)
+        self.assertMirrored()
+
+    def test_debpatch_fails(self):
+        self.mkDeltas()
+        with open(self.debpatch, 'w') as f:
+            f.write('#!/bin/sh\necho corrupt delta >&2\nexit 2\n')
+        self.server.requests = []
+        self.assertEqual(self.sync(self.deltaMirror()), [])
+        self.assertEqual(self.fetched(), self.new)
+        self.assertMirrored()
+
+    def test_no_debpatch(self):
+        self.mkDeltas()
+        self.server.requests = []
+        m = self.mirror(delta_source=self.server.url + '/deltas',
+            debpatch=os.path.join(self.tmp.name, 'none'))
+        self.assertEqual(self.sync(m), [])
+        self.assertEqual(m.delta_source, None)
+        self.assertEqual(self.fetched(), self.new)
+        self.assertMirrored()
+
+    def entry(self, version, name='foo'):
+        v = version.partition(':')[2] if ':' in version else version
+        return PkgEntry(name, 'pool/main/f/foo/%s_%s_amd64.deb' % (name, v), '', '0',
+            { 'Version' : version, 'Architecture' : 'amd64' })
+
+    def pool(self, *names):
+        ''' Put debs names in pool/main/f/foo of the mirror '''
+        pdir = self.mirrorPath('pool/main/f/foo')
+        os.makedirs(pdir, exist_ok=True)
+        for name in names:
+            open(os.path.join(pdir, name), 'w').close()
+
+    def base(self, m, version):
+        old = m.oldVersion(self.entry(version))
+        return (old[0], os.path.basename(old[1])) if old else None
+
+    def test_old_version(self):
+        m = self.mirror()
+        self.pool('foo_1.0-1_amd64.deb', 'foo_1.0-1+b9_amd64.deb', 'foo_1.0-1+b10_amd64.deb',
+            'foo_1.0-3_amd64.deb', 'foo_1.0-1_i386.deb', 'foo-doc_1.0-1+b11_amd64.deb')
+        self.assertEqual(self.base(m, '1.0-2'), ('1.0-1+b10', 'foo_1.0-1+b10_amd64.deb'))
+        self.assertEqual(self.base(m, '1.0-1+b11'), ('1.0-1+b10', 'foo_1.0-1+b10_amd64.deb'))
+        self.assertEqual(self.base(m, '1.0-1'), None)
+        self.assertEqual(self.base(m, '1.0~rc1-1'), None)
+
+    def test_epoch(self):
+        m = self.mirror()
+        self.pool('foo_2.0-1_amd64.deb', 'foo_0.7-1_amd64.deb', 'foo_0.5-1_amd64.deb')
+        # 2.0-1 and 1:0.7-1 are still listed - 0.5-1 is taken to have the new one's epoch
+        pkg = PkgFile(m, 'main/binary-amd64/Packages')
+        pkg.pkgs = { e.fname : e for e in (self.entry('2.0-1'), self.entry('1:0.7-1')) }
+        m.relfiles = { 'synth' : type('Rel', (), { 'pkgFiles' : { pkg.name : pkg } }) }
+        self.assertEqual(self.base(m, '1:3.0-1'), ('1:0.7-1', 'foo_0.7-1_amd64.deb'))
+        self.assertEqual(self.base(m, '1:0.6-1'), ('1:0.5-1', 'foo_0.5-1_amd64.deb'))
+        self.assertEqual(self.base(m, '3.0-1'), ('2.0-1', 'foo_2.0-1_amd64.deb'))
+        self.assertEqual(self.base(m, '2:0.4-1'), None)
+
+class TestManifests(SyntheticRepository):
+    ''' A downstream mirror applies the manifests of changes written by the mirror it is fed from '''
+
+    def setUp(self):
+        super().setUp()
+        m = self.mirror(manifests=True)
+        self.sync(m)
+        self.mirrors.remove(m)
+        m.cleanUp() # writes the manifest
+        self.feed = serve(self.lmirror)
+        self.downstream = os.path.join(self.tmp.name, 'downstream')
+
+    def tearDown(self):
+        self.feed.shutdown()
+        self.feed.server_close()
+        super().tearDown()
+
+    def fed(self, **options):
+        ''' Return a mirror of the one served by self.feed with Options options (dry_run...) '''
+        return self.mirror(options=options, repository=self.feed.url, lmirror=self.downstream,
+            manifests=False)
+
+    def test_apply(self):
+        self.assertEqual(self.fed().applyManifests(), 0)
+        for path in list(self.debs) + ['dists/synth/Release', 'dists/synth/main/binary-all/Packages.gz']:
+            with open(os.path.join(self.downstream, path), 'rb') as f, \
+                    open(self.mirrorPath(path), 'rb') as u:
+                self.assertEqual(f.read(), u.read(), path)
+        m = self.fed()
+        self.assertEqual(m.applyManifests(), 0)
+        self.assertEqual(len(m.db.appliedManifests()), 1)
+
+    def test_unsafe_paths(self):
+        self.assertEqual(self.fed().applyManifests(), 0)
+        with open(self.mirrorPath('dists/synth/Release'), 'rb') as f:
+            data = f.read()
+        outside = os.path.join(self.tmp.name, 'x') # rather than /etc/x should the check fail
+        # where the feed serves each of the paths from
+        for path in ('x', outside.lstrip('/')):
+            os.makedirs(os.path.dirname(self.mirrorPath(path)), exist_ok=True)
+            with open(self.mirrorPath(path), 'wb') as f:
+                f.write(data)
+        for i, path in enumerate(('../x', outside, 'pool/../../x', 'x')):
+            name = 'unsafe-%d.json' % i
+            with open(self.mirrorPath('manifests/' + name), 'w') as f:
+                json.dump({ 'files' : [{ 'op' : 'add', 'path' : path, 'size' : len(data),
+                    'sha256' : hashlib.sha256(data).hexdigest() }] }, f)
+            with open(self.mirrorPath('manifests/index'), 'a') as f:
+                f.write(name + '\n')
+            m = self.fed()
+            self.assertEqual(m.applyManifests(), 1, path)
+            self.assertNotIn(name, m.db.appliedManifests())
+            self.assertFalse(os.path.exists(outside))
+            self.assertFalse(os.path.exists(os.path.join(self.downstream, 'x')))
+            with open(self.mirrorPath('manifests/index')) as f:
+                index = f.read()
+            with open(self.mirrorPath('manifests/index'), 'w') as f:
+                f.write(index.replace(name + '\n', ''))
+
+    def test_dry_run(self):
+        self.fed()
+        m = self.fed(dry_run=True)
+        self.assertEqual(m.applyManifests(), 0)
+        self.assertFalse(os.path.exists(os.path.join(self.downstream, 'dists/synth/Release')))
+        self.assertEqual(m.db.appliedManifests(), set())
+
+    def test_no_database(self):
+        m = self.fed(very_dry_run=True)
+        self.assertEqual(m.db, None)
+        self.assertEqual(m.applyManifests(), 1)
+        self.assertFalse(os.path.exists(os.path.join(self.downstream, MirrorDB.NAME)))
+
+class TestPlan(SyntheticRepository):
+    ''' -plan says what a run would fetch without changing the mirror or its database '''
+
+    def setUp(self):
+        super().setUp()
+        self.sync(self.mirror())
+
+    def dump(self):
+        ''' Return the rows of every table of the mirror database '''
+        db = MirrorDB(self.lmirror)
+        try:
+            return dict((t, sorted(db.query('SELECT * FROM %s' % t))) for t in
+                ('files', 'indices', 'refs', 'fetches', 'popularity', 'logs', 'applied'))
+        finally:
+            db.close()
+
+    def plan(self, **settings):
+        ''' Return the plan of a -plan run with settings and the files it md5 hashed in the mirror '''
+        mod = sys.modules[RepositoryMirror.__module__]
+        hashed = []
+        checkFile = mod.checkFile
+        def check(file, size=None, md5sum=None, verbose=False):
+            if md5sum != None and file.startswith(self.lmirror + os.sep + 'dists'):
+                hashed.append(file)
+            return checkFile(file, size, md5sum, verbose)
+        mod.checkFile = check
+        try:
+            m = self.mirror(options={ 'plan' : True }, **settings)
+            m.checkState(True)
+            return m.fetchPlan(True), hashed
+        finally:
+            mod.checkFile = checkFile
+
+    def debsPlanned(self, plan):
+        return sorted(f['path'] for g in plan['groups'] for f in g['files']
+            if f['path'].startswith('pool/'))
+
+    def test_plan(self):
+        before = self.dump()
+        with open(self.mirrorPath('dists/synth/Release'), 'rb') as f:
+            release = f.read()
+        debs = mkRepository(self.upstream, versions=2)
+        plan, hashed = self.plan()
+        self.assertEqual(hashed, [])
+        self.assertEqual(plan['unavailable'], [])
+        new = [fn for fn in debs if fn not in self.debs]
+        self.assertEqual(plan['count'], len(new) + 3) # the Release file and 2 Package files
+        self.assertEqual(self.dump(), before)
+        with open(self.mirrorPath('dists/synth/Release'), 'rb') as f:
+            self.assertEqual(f.read(), release)
+        for fn in new:
+            self.assertFalse(os.path.exists(self.mirrorPath(fn)))
+
+    def test_closure(self):
+        path = os.path.join(self.tmp.name, 'pkg-list')
+        with open(path, 'w') as f:
+            f.write('pkg-amd64-0\n')
+        debs = mkRepository(self.upstream, versions=2,
+            depends={ 'pkg-amd64-0' : 'pkg-all-1 | pkg-all-2, pkg-amd64-2' })
+        plan = self.plan(pkgLists={ 'synth' : path }, closure={'synth'})[0]
+        self.assertEqual(self.debsPlanned(plan), sorted(fn for fn in debs if '_1.1-1_' in fn and
+            ('/pkg-amd64-0/' in fn or '/pkg-all-1/' in fn or '/pkg-amd64-2/' in fn)))
+
+    def test_keep_versions(self):
+        debs = mkRepository(self.upstream, versions=3)
+        plan = self.plan(keep_versions={ 'synth' : 1 })[0]
+        self.assertEqual(self.debsPlanned(plan), sorted(fn for fn in debs if '_1.2-1_' in fn))
+
+    def test_unverified(self):
+        db = MirrorDB(self.lmirror)
+        db.query('DELETE FROM files')
+        db.close()
+        before = self.dump()
+        plan, hashed = self.plan()
+        self.assertEqual(hashed, [])
+        self.assertEqual(plan['count'], 0)
+        self.assertEqual(self.dump(), before)
+
+    def test_no_database(self):
+        os.unlink(self.mirrorPath(MirrorDB.NAME))
+        debs = mkRepository(self.upstream, versions=2)
+        plan, hashed = self.plan()
+        self.assertEqual(self.debsPlanned(plan), sorted(fn for fn in debs if fn not in self.debs))
+        self.assertFalse(os.path.exists(self.mirrorPath(MirrorDB.NAME)))
+
+class TestTrace(SyntheticRepository):
+    ''' Every HTTP request is timed by connection and handler subclasses of one opener per mirror '''
+
+    def test_opener(self):
+        import http.client
+        m = self.mirror(engine='threaded')
+        self.assertEqual(self.sync(m), [])
+        self.assertMirrored()
+        opener = m.opener
+        self.assertIsNotNone(opener)
+        url = self.server.url + '/dists/synth/Release'
+        CacheFile(url, mirror=m).open(url, {}).close()
+        self.assertIs(m.opener, opener)
+        self.assertNotIn('_create_connection', vars(http.client.HTTPConnection))
+        h = m.trace.hists[('host', '127.0.0.1:%d' % self.server.server_address[1])]
+        self.assertGreaterEqual(h['requests'], len(self.debs))
+        self.assertIsNone(h['reused']) # urllib does not tell
+        for t in ('dns', 'connect', 'ttfb'):
+            self.assertGreater(h[t], 0., t)
+
+    def test_timing(self):
+        import urllib.error
+        self.addCleanup(setattr, CacheFile, 'opener', CacheFile.opener)
+        url = self.server.url + '/dists/synth/Release'
+        timing = {}
+        with CacheFile(url).open(url, timing) as f:
+            self.assertEqual(f.status, 200)
+        self.assertEqual(sorted(timing), ['connect', 'dns', 'ttfb'])
+        self.assertTrue(all(v > 0. for v in timing.values()), timing)
+        opener = CacheFile.opener
+        self.server.fail['/missing'] = [404, None]
+        timing = {}
+        with self.assertRaises(urllib.error.HTTPError) as e:
+            CacheFile(url).open(self.server.url + '/missing', timing)
+        e.exception.close()
+        self.assertEqual(sorted(timing), ['connect', 'dns', 'ttfb'])
+        self.assertIs(CacheFile.opener, opener)
+
+class TestCommandLine(SyntheticRepository):
+    ''' Run RepositoryMirror.py against the synthetic repository as cron would '''
+
+    def setUp(self):
+        super().setUp()
+        self.cfg = os.path.join(self.tmp.name, 'synth.cfg')
+        with open(self.cfg, 'w') as f:
+            f.write("[setup]\nrepository: %s\ndistributions: synth\ncomponents: main\n"
+                "architectures: amd64 all\nlmirror: %s\n" % (self.server.url, self.lmirror))
+        self.log = os.path.join(self.tmp.name, 'access.log')
+        with open(self.log, 'w') as f:
+            for fname in sorted(self.debs):
+                f.write('127.0.0.1 - - [19/Oct/2026:10:00:00 +0000] "GET /%s HTTP/1.1" 200 %d\n'
+                    % (fname, len(self.debs[fname])))
+
+    def start(self, *args):
+        ''' Start RepositoryMirror.py with args - returns its Popen '''
+        return subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+            'RepositoryMirror.py'), '-c', self.cfg] + list(args), cwd=self.tmp.name,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+    def invoke(self, *args):
+        ''' Return the exit status and output of RepositoryMirror.py with args '''
+        with self.start(*args) as p:
+            out = p.communicate()[0]
+        self.assertNotIn('Traceback', out)
+        return p.returncode, out
+
+    def logOffset(self):
+        db = MirrorDB(self.lmirror)
+        try:
+            return db.logOffset(self.log)
+        finally:
+            db.close()
+
+    def test_fetch(self):
+        rc, out = self.invoke('-create', '-fetch', '-access-log', self.log)
+        self.assertEqual(rc, 0, out)
+        self.assertIn('up to date', self.invoke()[1])
+        self.assertMirrored()
+
+    def test_quick_fetch(self):
+        self.assertEqual(self.invoke('-create')[0], 0)
+        self.assertIn('Status from snapshot', self.invoke('-quick')[1])
+        rc, out = self.invoke('-quick', '-fetch')
+        self.assertEqual(rc, 0, out)
+        self.assertNotIn('Status from snapshot', out)
+        self.assertIn('Fetched %d debs' % len(self.debs), out)
+        self.assertMirrored()
+
+    def test_shards(self):
+        self.debs = mkRepository(self.upstream, npkgs=8)
+        self.assertEqual(self.invoke('-create')[0], 0)
+        self.server.delay = 0.02
+        runs = [self.start('-fetch', '-shard', '%d/3' % i) for i in (1, 2, 3)]
+        outs = []
+        for p in runs:
+            with p:
+                outs.append(p.communicate()[0])
+        self.assertEqual([p.returncode for p in runs], [0, 0, 0], outs)
+        fetched = [p for p, r in self.server.requests if p.startswith('/pool/')]
+        self.assertEqual(sorted(fetched), sorted('/' + fn for fn in self.debs)) # each fetched once
+        self.assertMirrored()
+        self.assertIn('up to date', self.invoke()[1])
+
+    def test_access_logs(self):
+        self.assertEqual(self.invoke('-create', '-access-log', self.log)[0], 0)
+        self.assertEqual(self.logOffset(), (None, 0))
+        self.invoke('-quick', '-access-log', self.log)
+        self.invoke('-report', '-access-log', self.log)
+        self.assertEqual(self.logOffset(), (None, 0))
+        rc, out = self.invoke('-fetch', '-access-log', self.log)
+        self.assertEqual(rc, 0, out)
+        self.assertIn('%d deb requests' % len(self.debs), out)
+        self.assertEqual(self.logOffset()[1], os.path.getsize(self.log))
+
+    def test_no_database(self):
+        self.assertEqual(self.invoke('-create', '-fetch')[0], 0)
+        os.unlink(os.path.join(self.lmirror, MirrorDB.NAME))
+        rc, out = self.invoke('-N', '-access-log', self.log, '-quick')
+        self.assertEqual(rc, 0, out)
+        rc, out = self.invoke('-N', '-report')
+        self.assertEqual(rc, 1)
+        self.assertIn('no mirror database', out)
+        self.assertFalse(os.path.exists(os.path.join(self.lmirror, MirrorDB.NAME)))
+
+class TestUpstreams(SyntheticRepository):
+    ''' Fetches are spread over equivalent upstreams and fall back to another when one fails '''
+
+    def serveAnother(self):
+        other = serve(self.upstream)
+        self.addCleanup(other.server_close)
+        self.addCleanup(other.shutdown)
+        return other
+
+    def test_order(self):
+        pool = UpstreamPool(['http://a', 'http://b'])
+        pool.report('http://a', True, 1000, 1.)
+        pool.report('http://b', True, 3000, 1.)
+        self.assertEqual(pool.fastest(), 'http://b')
+        first = [pool.order()[0] for i in range(1000)]
+        self.assertTrue(600 < first.count('http://b') < 900) # in proportion to throughput
+        for i in range(UpstreamPool.DEMOTE_FAILS):
+            pool.report('http://b', False)
+        self.assertEqual(pool.healthy(), ['http://a'])
+        self.assertEqual(pool.order(), ['http://a', 'http://b'])
+        self.assertEqual(pool.fastest(), 'http://a')
+
+    def test_spread(self):
+        other = self.serveAnother()
+        m = self.mirror(upstreams=[self.server.url, other.url], engine='threaded')
+        self.assertEqual(self.sync(m), [])
+        self.assertMirrored()
+        debs = [p for s in (self.server, other) for p, r in s.requests if p.startswith('/pool/')]
+        self.assertEqual(sorted(debs), sorted('/' + fn for fn in self.debs))
+
+    def test_failover(self):
+        broken = self.serveAnother()
+        broken.fail['*'] = [500, None]
+        m = self.mirror(upstreams=[broken.url, self.server.url], engine='threaded')
+        self.assertEqual(self.sync(m), [])
+        self.assertMirrored()
+        self.assertGreater(m.upstreams.fails[broken.url], 0)
+        self.assertIsNone(m.upstreams.speed[broken.url])
+
+class TestSegments(SyntheticRepository):
+    ''' Large debs are fetched as concurrent byte ranges, falling back to fetching them whole '''
+
+    def setUp(self):
+        super().setUp()
+        self.segment_min = CacheFile.segment_min
+        CacheFile.segment_min = 1024
+
+    def tearDown(self):
+        CacheFile.segment_min = self.segment_min
+        super().tearDown()
+
+    def ranges(self, fname):
+        return sorted(r for p, r in self.server.requests if p == '/' + fname and r)
+
+    def test_segments(self):
+        self.assertEqual(self.sync(self.mirror(engine='threaded')), [])
+        self.assertMirrored()
+        fname = sorted(self.debs)[0]
+        size = len(self.debs[fname])
+        step = -(-size // CacheFile.segments)
+        self.assertEqual(self.ranges(fname), sorted('bytes=%d-%d' % (first, min(first + step, size) - 1)
+            for first in range(0, size, step)))
+
+    def test_no_ranges(self):
+        self.server.ranges = False
+        self.assertEqual(self.sync(self.mirror()), [])
+        self.assertMirrored()
+
+    def test_failed_segment(self):
+        fname = sorted(self.debs)[0]
+        self.server.fail['/' + fname] = [500, 1]
+        self.assertEqual(self.sync(self.mirror()), [])
+        self.assertMirrored()
+        self.assertIn(('/' + fname, None), self.server.requests) # then fetched whole
+
+class TestEngines(SyntheticRepository):
+    ''' Every fetch engine fills the mirror and counts what it fetched '''
+
+    def fetch(self, engine):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.assertEqual(self.sync(self.mirror(engine=engine)), [])
+        self.assertMirrored()
+        self.assertIn("Fetched %d debs" % len(self.debs), out.getvalue())
+
+    def test_serial(self):
+        self.fetch('serial')
+
+    def test_threaded(self):
+        self.fetch('threaded')
+
+    def test_async(self):
+        self.fetch('async')
+
+    def test_async_exception(self):
+        m = self.mirror(engine='async')
+        m.checkState(True)
+        for r in m.changed_dists:
+            r[1].update()
+        bad = m.relfiles['synth'].pkgFiles['main/binary-all/Packages.gz'].pkgs[
+            'pool/main/p/pkg-all-0/pkg-all-0_1.0-1_all.deb']
+        def update(*a):
+            del bad.cfile.update # so the retry works
+            raise RuntimeError("not an OSError")
+        bad.cfile.update = update # raises in the middle of the batch
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.assertEqual(m.fetchDebs(True), [])
+        self.assertIn("Failed to fetch pkg-all-0: not an OSError", out.getvalue())
+        self.assertIn("Fetched %d debs" % len(self.debs), out.getvalue())
+        self.assertMirrored()
+
+class TestStartup(unittest.TestCase):
+    ''' Short invocations (-info, -quick, ...) must not pay for modules only some paths use '''
+
+    LAZY = ('unittest', 'urllib.request', 'http.server', 'asyncio', 'tempfile', 'gzip',
+        'concurrent.futures', 'subprocess')
+    BUDGET = 0.05 # seconds python -X importtime may report for importing RepositoryMirror
+
+    def importTimes(self):
+        ''' Return {module: cumulative seconds} of a fresh interpreter importing RepositoryMirror '''
+        p = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import RepositoryMirror'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.PIPE,
+            universal_newlines=True, check=True)
+        times = {}
+        for l in p.stderr.splitlines():
+            w = l.split('|')
+            if len(w) == 3 and w[1].strip().isdigit():
+                times[w[2].strip()] = int(w[1]) / 1e6
+        return times
+
+    def test_lazy_imports(self):
+        times = self.importTimes()
+        self.assertIn('RepositoryMirror', times)
+        for m in TestStartup.LAZY:
+            self.assertNotIn(m, times, "%s is imported at startup" % m)
+
+    def test_startup_time(self):
+        best = min(self.importTimes()['RepositoryMirror'] for i in range(3))
+        if TestRepositoryMirror.v: print("import RepositoryMirror %.1f ms" % (best * 1000))
+        self.assertLess(best, TestStartup.BUDGET)
+
 if __name__ == '__main__':
+    TestRepositoryMirror.v = '-v' in sys.argv
     unittest.main()
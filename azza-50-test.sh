@@ -33,7 +33,7 @@ check_norefresh() {
     check_RM "$1" "$2"
 }
 check_uptodate() {
-    if ./RepositoryMirror.py -c azza-50.cfg -norefresh \
+    if ./RepositoryMirror.py -c azza-50.cfg -quick \
       | grep 'azza-updates-50 is up to date'; then
         echo "Release up to date - ok"
     else